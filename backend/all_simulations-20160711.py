@@ -33,14 +33,15 @@ GPL
 """
 
 import sys
-import math
+import time
 import json
 import random
 import itertools
 import networkx as nx
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mtick
 from operator import itemgetter
+from render import save_aggregates, render_figures
+from runstats import summarise_runs
+from telemetry import Telemetry
 
 
 OUTPUT_FILENAME_BY_TARGET = ['CutSet', 'MaxDegree', 'MaxBetweenness', 'Money',
@@ -50,12 +51,6 @@ OUTPUT_FILENAME_BY_TARGET = ['CutSet', 'MaxDegree', 'MaxBetweenness', 'Money',
                              'MoneyNoAdapt', 'PrecursorsNoAdapt',
                              'RandomNoAdapt']
 
-OUTPUT_FILENAME_BY_MEASURE = ['DegreeCentralities', 'BetweennessCentralities',
-                              'ConnectedComponents', 'MaximalComponentSize']
-
-Y_AXIS_LABEL = ['Degree centralization', 'Betweenness centralization',
-                'Number of components', 'Maximal component size']
-
 
 def initialise_network(filename):
     """
@@ -625,13 +620,9 @@ def main():
 
     # number of runs per targeting method
     nn = 100
-    # For debugging purposes, makes it quicker!!  But keep padding at 200.
+    # For debugging purposes, makes it quicker!!
     # nn = 5
 
-    # used to pad out all runs to have at least the same length as the
-    # longest actual run
-    padding = 200
-
     # reset the random seed using the system time
     random.seed()
     # [2016-07-09:MT] Need repeatable results for comparison with old version
@@ -649,255 +640,71 @@ def main():
 
     # Used to say range(9) here, which could be range(13) now, but let's
     # use ntarget?
+    # Progress (strategy, runs done, rate and ETA) on the terminal, and
+    # rates, latencies and memory in sweep.prom (see telemetry.py)
+    telemetry = Telemetry('sweep.prom', total=ntarget*nn)
+
     for tar in range(ntarget):
-        # CSG 16.7.2015, added as a check that program is progressing
-        print(OUTPUT_FILENAME_BY_TARGET[tar])
         for i in range(nn):
-            print('Run number ', i)
-
             # No-adaptation strategies
             if tar in (6, 9, 10, 11, 12, 13):
                 adaptation = False
             else:
                 adaptation = True
 
+            start = time.perf_counter()
             RunValues = intervention_adaptation_simulation(
                 G, node_attributes, tar, adaptation, 0.5, ignoreEquip)
+            telemetry.observe_run(tar, time.perf_counter() - start, steps=len(RunValues))
 
-            # Adding zeros here makes averaging easier
-            SS[tar][i] = RunValues + [[0, 0, 0, 0, 0] for j in range(padding)]
+            SS[tar][i] = RunValues
 
-    # Averages
-    nmin = [min([len(SS[tartemp][i])-padding for i in range(nn)]) for tartemp in range(ntarget)]
-    nmax = [max([len(SS[tartemp][i])-padding for i in range(nn)]) for tartemp in range(ntarget)]
+    telemetry.close()
+
+    # Averages, frequencies and the mean and SD of the run lengths, with
+    # bootstrap confidence intervals (see runstats.py)
     Sfreq = [0 for i in range(ntarget)]
     SSav = [0 for i in range(ntarget)]
+    lengths = [0 for i in range(ntarget)]
+    bands = [0 for i in range(ntarget)]
 
     for tar in range(ntarget):
-        SSav[tar] = [[sum([SS[tar][i][j][k] for i in range(nn)])*1.00/nn for k in [1, 2, 3, 4]] for j in range(nmax[tar])]
+        (Slengths, Ssteps) = summarise_runs(SS[tar])
+        SSav[tar] = Ssteps['mean'].tolist()
+        bands[tar] = [Ssteps['low'].tolist(), Ssteps['high'].tolist()]
         # open for 'w'riting
         f = open(OUTPUT_FILENAME_BY_TARGET[tar]+'_averages.txt', 'w')
         f.write("%s\n" % SSav[tar])
         f.close()
 
         # Frequencies
-        Sfreq[tar] = [0 for i in range(nmax[tar]+1)]
-        for i in range(nn):
-            Sfreq[tar][len(SS[tar][i])-padding] += 1
+        Sfreq[tar] = Slengths['frequencies']
 
         # CSG TO DO:  Change file name
         # open for 'w'riting
         f = open(OUTPUT_FILENAME_BY_TARGET[tar]+'_vertex_del_freq.txt', 'w')
         f.write("%s\n" % Sfreq[tar])
         f.close()
-        print("Frequencies")
-        fig, ax = plt.subplots()
-        IntervalStart = nmin[tar]
-        Xrange = [j for j in range(IntervalStart, nmax[tar]+1)]
-        XrangeWidth = max(Xrange) - min(Xrange) + 1
-        BarWidth = 0.05 * XrangeWidth
-        if tar == 4 or tar == 13:
-            BarWidth = BarWidth/10
-        #  MedianBar = [0 for j in Xrange]
-        JustUnderHalfWay = math.floor((nn+1)/2.0)
-        JustOverHalfWay = math.ceil((nn+1)/2.0)
-        FrequencySum = 0
-        PositiveXrange = [i for i in Xrange if Sfreq[tar][i] > 0]
-        j = -1
-        while FrequencySum < JustUnderHalfWay:
-            j += 1
-            tempBar = Sfreq[tar][j]
-            FrequencySum += tempBar
-        #  MedianBar[j-IntervalStart] = tempBar
-        MedianBar = j
-        if FrequencySum < JustOverHalfWay:
-            # print(JustUnderHalfWay, JustOverHalfWay, j, PositiveXrange)
-            jj = min([i for i in PositiveXrange if i > j])
-            # MedianBar[jj-IntervalStart] = Sfreq[tar][jj]
-            MedianBar = (j+jj)/2.0
-        ax.axis([nmin[tar]-1, nmax[tar]+1, 0, max(Sfreq[tar])+1])
-        ax.bar(Xrange, [Sfreq[tar][i] for i in Xrange], width=BarWidth, color='b', align='center')
-        # ax.bar(Xrange, MedianBar, width=BarWidth, color='r', align='center')
-        ax.axvline(MedianBar, color='r', linewidth=2)
-        # CSG attempts to add mean bar as well as Median, 11.11.2015
-        MeanBar = sum([len(SS[tar][i]) - padding for i in range(nn)]) / float(nn)
-        # print("mean", MeanBar)
-        plt.axvline(MeanBar, color='c', linestyle='dashed', linewidth=2)
-        ax.set_xlabel('Number of deletion steps until network disruption')
-        plt.savefig(OUTPUT_FILENAME_BY_TARGET[tar]+'_vertex_del_freq.png',
-                    dpi=300, facecolor='w', edgecolor='w',
-                    orientation='portrait', papertype=None, format='png',
-                    transparent=False, bbox_inches=None, pad_inches=0.1,
-                    frameon=None)
-        # plt.show()
-        plt.close(fig)
-        Sfreqset = [len(SS[tar][i])-padding for i in range(nn)]
-        # print(Sfreqset)
-        Sav = sum(Sfreqset)*1.000/nn
-        Ssd = (sum([((Sav-s) ** 2) for s in Sfreqset])*1.000/nn) ** (0.5)
-        # print(Sav,Ssd)
+        lengths[tar] = [len(RunValues) for RunValues in SS[tar]]
+        Sav = Slengths['mean']
+        Ssd = Slengths['sd']
         # CSG TO DO:  Change file name
         # open for 'w'riting
         f = open(OUTPUT_FILENAME_BY_TARGET[tar]+'_vertex_del_freq_Av_st.txt', 'w')
         f.write("%s\n" % [Sav, Ssd])
         f.close()
+        # 95% bootstrap intervals of the mean and median run lengths
+        f = open(OUTPUT_FILENAME_BY_TARGET[tar]+'_vertex_del_freq_ci.txt', 'w')
+        f.write("%s\n" % [Slengths['mean_ci'], Slengths['median'], Slengths['median_ci']])
+        f.close()
 
-    # with or without adaptation
-    nmaxglobal1 = max(nmax)
-
-    # only with adaptation
-    # nmaxglobal2 = max([nmax[tar] for tar in [0,1,2,3,4,5,7,8]])
-
-    # no random, only with adaptation
-    nmaxglobal2 = max([nmax[tar] for tar in [0, 1, 2, 3, 5, 7, 8]])
-    #nmaxglobal2 = max([nmax[tar] for tar in [0,1,2,3,5]])
-
-    #nmaxglobal3 = max([nmax[tar] for tar in [0,1,2,7,8]])
-
-    #nmaxglobal = [nmaxglobal1,nmaxglobal2,nmaxglobal3]
-    nmaxglobal = [nmaxglobal1, nmaxglobal2]
-
-    tarfmt = [('black', 'solid'), ('gray', 'solid'), ('black', 'dotted'),
-              ('black', 'dashed'), ('black', 'solid'), ('gray', 'dashed'),
-              ('green', 'dashed'), ('black', 'dashed'), ('gray', 'dashed'),
-              ('red', 'dashed'), ('blue', 'dashed'), ('cyan', 'dashed'),
-              ('orange', 'dashed'), ('black', 'dashed')]
-
-    """New colour scheme in shades of gray.
-
-     (0) black        -- cutset targeting
-     (1) gray         -- degree targeting
-     (2) black dotted -- betweenness targeting
-     (3) black dashed -- money targeting
-     (4) N/A          -- random targeting (No longer plotted)
-     (5) grey  dashed -- precursor targeting
-     (6) N/A          -- degree targeting without adaptation  (No longer plotted)
-     (7) black dashed -- cutset targeting until fewer than 50% of vertices remaining; then max degree targeting
-     (8) grey  dashed -- cutset targeting until fewer than 50% of vertices remaining; then max betweenness targeting
-     (9) N/A          -- betweenness targeting without adaptation  (No longer plotted)
-    (10) N/A          -- cutset targeting without adaptation    (No longer plotted)
-    (11) N/A          -- money targeting without adaptation     (No longer plotted)
-    (12) N/A          -- precursor targeting without adaptation (No longer plotted)
-    (13) N/A          -- random targeting without adaptation    (No longer plotted)
-
-    First  plot targets: [0,1,2,3,5]
-    Second plot targets: [0,1,2,7,8]
-    """
-
-    #xaxistype = [[-1, nmaxglobal[i]+1] for i in range(3)]
-    xaxistype = [[-1, nmaxglobal[i]+1] for i in range(2)]
-    yaxistype = [[0, max([max([s[outputtype] for s in SSav[tar]]) for tar in range(ntarget)])+0.05] for outputtype in range(4)]
-
-    # The tweak below is to accomodate for the [0,2,3] range of "outputtype" below
-    # (Yep, can be cleaned up a bit - but works ok ;) )
-    #xaxistype_tweak = [xaxistype[0],[],xaxistype[1],xaxistype[2]]
-    #
-    # A comparative plot of the degree centralities for each of the targeting methods
-    # outputtype assume the values
-    #   0  for degree centrality
-    #   1  for betweenness centrality  NO LONGER NEEDED!
-    #   2  for number of connected components
-    #   3  for maximal component size
-    for outputtype in [0, 2, 3]:
-    #  fig, ax1 = plt.subplots()
-    ###  for tar in range(ntarget):  ## This one (now commented out) does ALL the simulations at the same time
-    #  for tar in [0,1,2,3,4,5,6,9,10,11,12,13]:  ##  Try everything **except the hybrids***.  It might be too much.
-    #    ax1.plot([i for i in range(1,len(SSav[tar])+1)],[s[outputtype] for s in SSav[tar]], color=tarfmt[tar][0], linestyle=tarfmt[tar][1], alpha=0.8)
-    #  ax1.axis(xaxistype[0]+yaxistype[outputtype])
-    #  ax1.set_xlabel('Number of steps')
-    #  ax1.set_ylabel(Y_AXIS_LABEL[outputtype])
-    #  plt.savefig(OUTPUT_FILENAME_BY_MEASURE[outputtype]+'.png',dpi=300, facecolor='w', edgecolor='w',orientation='portrait',papertype=None, format='png', transparent=False, bbox_inches=None, pad_inches=0.1, frameon=None)
-    #  #plt.show()
-    #  plt.close(fig)
-
-    #   # Plot without random strategy, so we can actually see!!  All simulations EXCEPT the hybrids and random.
-    #   # So this demonstrates the effect of adaptation
-    #  fig, ax1 = plt.subplots()
-    #  for tar in [0,1,2,3,5,6,9,10,11,12]:
-    #    ax1.plot([i for i in range(1,len(SSav[tar])+1)],[s[outputtype] for s in SSav[tar]], color=tarfmt[tar][0], linestyle=tarfmt[tar][1], alpha=0.8)
-    #  ax1.axis(xaxistype[1]+yaxistype[outputtype])
-    #  ax1.set_xlabel('Number of steps')
-    #  ax1.set_ylabel(Y_AXIS_LABEL[outputtype])
-    #  plt.savefig(OUTPUT_FILENAME_BY_MEASURE[outputtype]+'_no_hybrid_no-random.png',dpi=300, facecolor='w', edgecolor='w',orientation='portrait',papertype=None, format='png', transparent=False, bbox_inches=None, pad_inches=0.1, frameon=None)
-    #  #plt.show()
-    #  plt.close(fig)
-
-        # As per Alison's request: our main 5 strategies (not random), all with adaptation.  POINT 2!
-        # But don't include the hybrids yet.
-        fig, ax1 = plt.subplots()
-        for tar in [0, 1, 2, 3, 5]:
-            # # For "Proportion of active runs" plots, we want percentages on the y-axis:
-            #
-            # With our cutset implementation fixed/improved, we now prefer actual averages again, not percentages.
-            # The following if/else chunk is therefore no longer relevant.
-            #
-            # if outputtype == 2:
-            #     ax1.plot([i for i in range(1, len(SSav[tar])+1)], [s[outputtype]*100.0 for s in SSav[tar]], color=tarfmt[tar][0], linestyle=tarfmt[tar][1], alpha=0.8)
-            #     ax1.axis(xaxistype[1]+[0, 105])
-            #     # ax1.axis(xaxistype_tweak[outputtype]+[0,105])
-            #     # Formatting to percentages, this code nicked from stackoverflow.com
-            #     fmt = '%.0f%%'
-            #     xticks = mtick.FormatStrFormatter(fmt)
-            #     ax1.yaxis.set_major_formatter(xticks)
-            # else:
-            #     ax1.plot([i for i in range(1, len(SSav[tar])+1)], [s[outputtype] for s in SSav[tar]], color=tarfmt[tar][0], linestyle=tarfmt[tar][1], alpha=0.8)
-            #     ax1.axis(xaxistype[1]+yaxistype[outputtype])
-            #     # ax1.axis(xaxistype_tweak[outputtype]+yaxistype[outputtype])
-            ax1.plot([i for i in range(1, len(SSav[tar])+1)], [s[outputtype] for s in SSav[tar]], color=tarfmt[tar][0], linestyle=tarfmt[tar][1], alpha=0.8)
-            ax1.axis(xaxistype[1]+yaxistype[outputtype])
-        ax1.set_xlabel('Number of steps')
-        ax1.set_ylabel(Y_AXIS_LABEL[outputtype])
-        plt.savefig(OUTPUT_FILENAME_BY_MEASURE[outputtype]+'_main_strategies_with_adapt.png',
-                    dpi=300, facecolor='w', edgecolor='w',
-                    orientation='portrait', papertype=None, format='png',
-                    transparent=False, bbox_inches=None, pad_inches=0.1,
-                    frameon=None)
-        # plt.show()
-        plt.close(fig)
-
-    #   # Plot main strategies + hybrids.  All with adaptation; no random.
-    #  fig, ax1 = plt.subplots()
-    #  for tar in [0,1,2,3,5,7,8]:
-    #    ax1.plot([i for i in range(1,len(SSav[tar])+1)],[s[outputtype] for s in SSav[tar]], color=tarfmt[tar][0], linestyle=tarfmt[tar][1], alpha=0.8)
-    #  ax1.axis(xaxistype[1]+yaxistype[outputtype])
-    #  ax1.set_xlabel('Number of steps')
-    #  ax1.set_ylabel(Y_AXIS_LABEL[outputtype])
-    #  plt.savefig(OUTPUT_FILENAME_BY_MEASURE[outputtype]+'_with-adapt_and_hybrids_only.png',dpi=300, facecolor='w', edgecolor='w',orientation='portrait',papertype=None, format='png', transparent=False, bbox_inches=None, pad_inches=0.1, frameon=None)
-    #  #plt.show()
-    #  plt.close(fig)
-
-       # Ignore the resource-based strategies: just cutset, degree, betweenness + hybrids.  All with adaptation; no random.  POINT 3!
-        fig, ax1 = plt.subplots()
-        for tar in [0, 1, 2, 7, 8]:
-####################
-##  Now we need to go back to "Number of active components", we don't need special
-##  treatment here...
-#####################
-            # For "Proportion of active runs" plots, we want percentages on the y-axis:
-            #if outputtype == 2:
-                #ax1.plot([i for i in range(1, len(SSav[tar])+1)], [s[outputtype]*100.0 for s in SSav[tar]], color=tarfmt[tar][0], linestyle=tarfmt[tar][1], alpha=0.8)
-                #ax1.axis(xaxistype[1]+[0, 105])
-                ## ax1.axis(xaxistype_tweak[outputtype]+[0,105])
-                ## Format you want the ticks, e.g. '40%'
-                #fmt = '%.0f%%'
-                #xticks = mtick.FormatStrFormatter(fmt)
-                #ax1.yaxis.set_major_formatter(xticks)
-            #else:
-#############
-##  End of old special treatment for the "Active runs" plot, which is now back to "Nr components"
-################
-            ax1.plot([i for i in range(1, len(SSav[tar])+1)], [s[outputtype] for s in SSav[tar]], color=tarfmt[tar][0], linestyle=tarfmt[tar][1], alpha=0.8)
-            ax1.axis(xaxistype[1]+yaxistype[outputtype])
-            # ax1.axis(xaxistype_tweak[outputtype]+yaxistype[outputtype])
-        ax1.set_xlabel('Number of steps')
-        ax1.set_ylabel(Y_AXIS_LABEL[outputtype])
-        plt.savefig(OUTPUT_FILENAME_BY_MEASURE[outputtype]+'_structural_and_hybrids_only.png',
-                    dpi=300, facecolor='w', edgecolor='w',
-                    orientation='portrait', papertype=None, format='png',
-                    transparent=False, bbox_inches=None, pad_inches=0.1,
-                    frameon=None)
-        # plt.show()
-        plt.close(fig)
+    # The histograms and comparison plots are drawn by render.py, from the
+    # aggregates saved here; it skips the figures whose data and style
+    # have not changed since it last drew them
+    save_aggregates('aggregates.json', OUTPUT_FILENAME_BY_TARGET, SSav, Sfreq, lengths,
+                    bands)
+    (drawn, skipped) = render_figures('aggregates.json')
+    print('%d figures drawn, %d unchanged' % (len(drawn), len(skipped)))
 
     print("All good!")
 
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Aggregate artifacts of simulation results, for the criminal_networks app.
+
+Results are published as small static JSON files the app fetches without
+a running backend: one file per cell (network, strategy, p,
+ignore_equipment), and an index of all cells.
+
+  index.json            {'measures': [..], 'cells': [{'file', 'network',
+                        'tar', 'strategy', 'p', 'ignore_equipment', 'runs',
+                        'mean_length'}, ..]}
+  NETWORK/STRATEGY-pP-ieI.json
+                        {'network', 'tar', 'strategy', 'p',
+                         'ignore_equipment', 'lengths': length summary
+                         (see runstats.length_stats(), with the
+                         frequencies as the histogram), 'curves': {measure:
+                         [level, ..]}}
+
+Each curve is the per-step mean of a measure over the runs with its
+bootstrap band, at several levels of detail: a level is {'stride': s,
+'mean': [..], 'low': [..], 'high': [..]}, each point the average of s
+consecutive steps.  Levels go from the coarsest, of at most BASE_POINTS
+points, to full resolution (capped at MAX_POINTS points), four times finer
+each; the app draws the finest level that fits its width.  Values are
+rounded to SIGNIFICANT digits.  A cell of the criminal network takes
+under 2 kB, and its index entry about 170 bytes.
+
+Publishing a cell replaces it in the index and leaves the other cells, so
+sweeps of different networks and parameters accumulate.
+
+Usage: python artifacts.py run NN [network_file ..] [--p P ..] [--ignore-equipment]
+                               [--out DIR] [--processes N]
+       python artifacts.py trace TRACE_FILE network_file [--out DIR]
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+
+from network import load_network
+from runstats import ragged_array, length_stats, step_stats
+from simple import NO_ADAPT_TARGETS, OUTPUT_FILENAME_BY_TARGET
+
+
+DEFAULT_OUT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'criminal_networks', 'static', 'results')
+
+MEASURES = ['betweenness_centralisation', 'degree_centralisation', 'nCC', 'Cmax']
+
+BASE_POINTS = 64
+MAX_POINTS = 4096
+SIGNIFICANT = 4
+
+
+def compact(x):
+    """
+    x rounded to SIGNIFICANT digits (None for nan), as a JSON number.
+    """
+
+    if x != x:
+        return None
+    if x == int(x) and abs(x) < 1e15:
+        return int(x)
+
+    return float('%.*g' % (SIGNIFICANT, x))
+
+
+def compact_list(values):
+    return [compact(x) for x in np.asarray(values, dtype=float).tolist()]
+
+
+def downsample(values, stride):
+    """
+    The averages of stride consecutive entries of values (the last block
+    may be shorter).
+    """
+
+    values = np.asarray(values, dtype=float)
+    if stride == 1:
+        return values
+    starts = np.arange(0, len(values), stride)
+    sums = np.add.reduceat(values, starts)
+
+    return sums / np.diff(np.append(starts, len(values)))
+
+
+def levels_of_detail(mean, low, high):
+    """
+    The levels of a curve (see above), coarsest first.
+    """
+
+    T = len(mean)
+    stride = 1
+    while T > stride*MAX_POINTS:
+        stride *= 4
+    levels = []
+    while True:
+        levels.append({'stride': stride,
+                       'mean': compact_list(downsample(mean, stride)),
+                       'low': compact_list(downsample(low, stride)),
+                       'high': compact_list(downsample(high, stride))})
+        if -(-T // stride) <= BASE_POINTS:
+            break
+        stride *= 4
+    levels.reverse()
+
+    return levels
+
+
+def cell_artifact(network, tar, p, ignore_equipment, runs, rng=None):
+    """
+    The artifact of the runs (lists of step records) of one cell.
+    """
+
+    (lengths, values) = ragged_array(runs)
+    summary = length_stats(lengths, rng=rng)
+    steps = step_stats(values, rng=rng)
+    curves = {}
+    for (k, measure) in enumerate(MEASURES):
+        curves[measure] = levels_of_detail(steps['mean'][:, k], steps['low'][:, k],
+                                           steps['high'][:, k])
+    for key in ('mean', 'sd', 'median'):
+        summary[key] = compact(summary[key])
+    for key in ('quantiles', 'mean_ci', 'median_ci'):
+        summary[key] = compact_list(summary[key])
+
+    return {'network': network, 'tar': tar, 'strategy': OUTPUT_FILENAME_BY_TARGET[tar],
+            'p': p, 'ignore_equipment': ignore_equipment, 'lengths': summary,
+            'curves': curves}
+
+
+def cell_filename(network, tar, p, ignore_equipment):
+    stem = os.path.splitext(os.path.basename(network))[0]
+
+    return '%s/%s-p%.2f-ie%d.json' % (stem, OUTPUT_FILENAME_BY_TARGET[tar], p, ignore_equipment)
+
+
+def publish(artifacts, out=DEFAULT_OUT):
+    """
+    Write the artifacts into out and merge them into its index.json.
+    """
+
+    path = os.path.join(out, 'index.json')
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        index = {'measures': MEASURES, 'cells': []}
+    cells = dict([(cell['file'], cell) for cell in index['cells']])
+    for artifact in artifacts:
+        name = cell_filename(artifact['network'], artifact['tar'], artifact['p'],
+                             artifact['ignore_equipment'])
+        filename = os.path.join(out, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            json.dump(artifact, f, separators=(',', ':'))
+        cells[name] = {'file': name, 'network': artifact['network'], 'tar': artifact['tar'],
+                       'strategy': artifact['strategy'], 'p': artifact['p'],
+                       'ignore_equipment': artifact['ignore_equipment'],
+                       'runs': artifact['lengths']['runs'],
+                       'mean_length': artifact['lengths']['mean']}
+    index['cells'] = [cells[name] for name in sorted(cells)]
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Publish aggregate artifacts for the app')
+    parser.add_argument('command', choices=['run', 'trace'])
+    parser.add_argument('source', help='number of runs per cell (run) or trace file (trace)')
+    parser.add_argument('networks', nargs='*', default=['criminal.txt'])
+    parser.add_argument('--p', type=float, nargs='+', default=[0.5])
+    parser.add_argument('--ignore-equipment', action='store_true')
+    parser.add_argument('--out', default=DEFAULT_OUT)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv[1:])
+    ie = 1 if args.ignore_equipment else 0
+
+    artifacts = []
+    if args.command == 'run':
+        import random
+        from shared import run_parallel
+        nn = int(args.source)
+        random.seed()
+        for filename in args.networks:
+            network = load_network(filename)
+            cells = [(tar, p) for p in args.p for tar in range(len(OUTPUT_FILENAME_BY_TARGET))]
+            tasks = [(tar, tar not in NO_ADAPT_TARGETS, p, ie, random.getrandbits(64))
+                     for (tar, p) in cells for i in range(nn)]
+            results = run_parallel(network, tasks, args.processes)
+            for (k, (tar, p)) in enumerate(cells):
+                artifacts.append(cell_artifact(os.path.basename(filename), tar, p, ie,
+                                               results[k*nn:(k+1)*nn]))
+                print('%s %s p=%.2f: mean length %.2f'
+                      % (filename, OUTPUT_FILENAME_BY_TARGET[tar], p, artifacts[-1]['lengths']['mean']))
+    else:
+        from traces import read_traces, replay_parallel
+        filename = args.networks[0]
+        network = load_network(filename)
+        keys = [(trace.tar, trace.p, trace.ignore_equipment)
+                for trace in read_traces(args.source, network)]
+        runs = replay_parallel(network, args.source, MEASURES, args.processes)
+        cells = {}
+        for (key, run) in zip(keys, runs):
+            # Replayed rows are [v, measures..], as step records are
+            cells.setdefault(key, []).append(run)
+        for key in sorted(cells):
+            (tar, p, ignore_equipment) = key
+            artifacts.append(cell_artifact(os.path.basename(filename), tar, p,
+                                           ignore_equipment, cells[key]))
+    publish(artifacts, args.out)
+    print('%d cells published to %s' % (len(artifacts), os.path.normpath(args.out)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Many replicates of one cheap strategy, advanced in lockstep on NumPy arrays.
+
+For random targeting, the degree-based strategies (max degree, money,
+precursor) and their no-adapt variants, a step of
+intervention_adaptation_simulation() does very little work, and running
+replicates one after another is dominated by per-call overhead.
+batched_simulation() runs R replicates together instead.  The state of
+the batch is
+
+  alive     R x n boolean matrix: the nodes left in each replicate
+  extra     edges added by adaptation, as rows (replicate, u, v)
+
+over the shared edge array of a network.Network; degrees, component
+labels (by array union-find over the live edges of all replicates at
+once) and the attribute coverage of each component are recomputed from
+these each step.  Selection, pruning and the step measures are vectorised
+across the batch.  Adaptation, which only happens when a deletion splits a
+component, is done replicate by replicate with a multi-source BFS.
+
+The replicates follow the same rules as the simulation in simple.py but
+draw their random numbers from a NumPy Generator, so they agree with it in
+distribution rather than run for run.  Betweenness centralisation is only
+computed (with networkx, replicate by replicate) if asked for; otherwise
+it is recorded as nan.
+
+Each replicate is returned as the list of step records [v,
+betweenness centralisation, degree centralisation, nCC, Cmax] that
+intervention_adaptation_simulation() returns, v labelled 1..n.
+
+Usage: python batched.py [R] [network_file]
+"""
+
+import sys
+import time
+
+import numpy as np
+import networkx as nx
+
+from network import load_network, component_labels, ALL_ATTRIBUTES, EQUIPMENT
+from simple import (STRATEGIES, MaxDegree, Money, Random,
+                    betweenness_centralisation, OUTPUT_FILENAME_BY_TARGET)
+
+
+# Number of attributes in each bitmask
+POPCOUNT = np.array([bin(k).count('1') for k in range(256)], dtype=np.int64)
+
+
+def _max_degree_scores(batch, attribute):
+    return np.where(batch.alive, batch.degrees + 0.5*batch.rng.random(batch.alive.shape), -1.0)
+
+
+def _attribute_scores(batch, attribute):
+    # Nodes with the attribute by highest degree; once none is left in a
+    # replicate, any node uniformly
+    has = (batch.network.masks & (1 << (attribute - 1))) != 0
+    noise = batch.rng.random(batch.alive.shape)
+    holders = batch.alive & has
+    scores = np.where(holders, batch.degrees + 0.5*noise, -1.0)
+    none_left = ~holders.any(axis=1)
+    scores[none_left] = np.where(batch.alive[none_left], noise[none_left], -1.0)
+
+    return scores
+
+
+def _random_scores(batch, attribute):
+    return np.where(batch.alive, batch.rng.random(batch.alive.shape), -1.0)
+
+
+# Vectorised selection for each strategy class that has one, with the
+# attribute it targets; subclasses (the no-adapt variants) inherit theirs
+BATCH_SELECTORS = {MaxDegree: [_max_degree_scores, None],
+                   Money: [_attribute_scores, 1],
+                   Random: [_random_scores, None]}
+
+
+def batch_selector(tar):
+    """
+    [scores, attribute] for the strategy tar: scores(batch, attribute) is
+    an R x n array whose row maxima are the nodes to delete.  Raises
+    ValueError for the strategies that cannot be batched.
+    """
+
+    cls = STRATEGIES[tar]
+    for klass in cls.__mro__:
+        if klass in BATCH_SELECTORS:
+            (scores, attribute) = BATCH_SELECTORS[klass]
+            if klass is Money:
+                attribute = cls.attribute
+            return [scores, attribute]
+
+    raise ValueError("Strategy %d (%s) cannot be batched" % (tar, cls.name))
+
+
+def batched_targets():
+    """
+    The strategies batched_simulation() can run.
+    """
+
+    result = []
+    for tar in sorted(STRATEGIES):
+        try:
+            batch_selector(tar)
+        except ValueError:
+            continue
+        result.append(tar)
+
+    return result
+
+
+class Batch(object):
+    """
+    The state of R replicates on one network, adapting with probability
+    scale p.
+    """
+
+    def __init__(self, network, R, p, ignore_equipment, rng):
+        self.network = network
+        self.R = R
+        self.n = network.n
+        self.p = p
+        self.ignore_equipment = ignore_equipment
+        self.rng = rng
+        self.alive = np.ones((R, network.n), dtype=bool)
+        self.extra = np.zeros((0, 3), dtype=np.int64)
+        self.u = network.edges[:, 0].astype(np.int64)
+        self.v = network.edges[:, 1].astype(np.int64)
+        self.full = ALL_ATTRIBUTES & ~(EQUIPMENT if ignore_equipment else 0)
+
+    def live_edges(self, alive=None, replicate=None):
+        """
+        The flat endpoints [a, b] (r*n + u) of the edges whose ends are both
+        alive (in alive, the current state by default).  If replicate is
+        given, alive is the single row of that replicate, and a and b are
+        plain node indices.
+        """
+
+        if alive is None:
+            alive = self.alive
+        (r, e) = np.nonzero(alive[:, self.u] & alive[:, self.v])
+        a = r*self.n + self.u[e]
+        b = r*self.n + self.v[e]
+        extra = self.extra
+        if replicate is not None:
+            extra = extra[extra[:, 0] == replicate]
+            extra = np.column_stack((np.zeros(len(extra), dtype=np.int64), extra[:, 1:]))
+        if len(extra) > 0:
+            flat = alive.ravel()
+            ea = extra[:, 0]*self.n + extra[:, 1]
+            eb = extra[:, 0]*self.n + extra[:, 2]
+            keep = flat[ea] & flat[eb]
+            a = np.concatenate((a, ea[keep]))
+            b = np.concatenate((b, eb[keep]))
+
+        return [a, b]
+
+    def refresh(self):
+        """
+        Recompute degrees and component labels from alive and extra.
+        """
+
+        (a, b) = self.live_edges()
+        self.degrees = np.bincount(np.concatenate((a, b)),
+                                   minlength=self.alive.size).reshape(self.alive.shape)
+        self.labels = component_labels(self.alive.size, a, b)
+
+    def coverage(self):
+        """
+        The attribute bitmask covered by each component, indexed by label.
+        """
+
+        cover = np.zeros(self.alive.size, dtype=np.uint8)
+        live = np.flatnonzero(self.alive.ravel())
+        np.bitwise_or.at(cover, self.labels[live], self.network.masks[live % self.n])
+
+        return cover
+
+    def prune(self):
+        """
+        Kill every component lacking attributes; returns the number of
+        nodes removed.
+        """
+
+        cover = self.coverage()
+        flat = self.alive.ravel()
+        bad = flat & ((cover[self.labels] & self.full) != self.full)
+        self.alive = (flat & ~bad).reshape(self.alive.shape)
+
+        return int(bad.sum())
+
+
+def adapt_replicate(batch, r, v, before):
+    """
+    Adaptation of replicate r after deleting v, as in adapt_components():
+    every component lacking attributes picks, among the nodes outside it
+    that were in v's old component and make up its missing attributes, one
+    with probability proportional to the inverse of its distance to the
+    component (in the graph before the deletion), and each former
+    neighbour of v in the component links to it with probability p.
+    before is the alive row of r before the deletion.  Returns the list of
+    edges added.
+    """
+
+    n = batch.n
+    masks = batch.network.masks
+    # Adjacency of replicate r before the deletion
+    (a, b) = batch.live_edges(before[None, :], r)
+    src = np.concatenate((a, b))
+    dst = np.concatenate((b, a))
+    order = np.argsort(src, kind='stable')
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=offsets[1:])
+    dst = dst[order]
+    neighbours_of_v = dst[offsets[v]:offsets[v+1]]
+
+    def bfs(sources):
+        dist = np.full(n, -1, dtype=np.int64)
+        dist[sources] = 0
+        frontier = sources
+        d = 0
+        while len(frontier) > 0:
+            d += 1
+            starts = offsets[frontier]
+            counts = offsets[frontier + 1] - starts
+            reach = dst[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+            reach = np.unique(reach[dist[reach] < 0])
+            dist[reach] = d
+            frontier = reach
+        return dist
+
+    row = batch.labels[r*n:(r+1)*n] - r*n
+    alive = batch.alive[r]
+    added = []
+    ie = batch.ignore_equipment
+    for label in np.unique(row[alive]):
+        members = np.flatnonzero(alive & (row == label))
+        cover = np.bitwise_or.reduce(masks[members]) & batch.full
+        if POPCOUNT[cover] + ie == 8:
+            continue
+        dist = bfs(members)
+        # (As in adapt_components, the candidate's own attributes are
+        # counted in full, equipment included)
+        candidates = np.flatnonzero(alive & (row != label) & (dist > 0)
+                                    & (POPCOUNT[masks | cover] + ie == 8))
+        if len(candidates) == 0:
+            continue
+        weights = 1.0/dist[candidates]
+        vadd = candidates[batch.rng.choice(len(candidates), p=weights/weights.sum())]
+        linked = np.intersect1d(members, neighbours_of_v)
+        for cv in linked[batch.rng.random(len(linked)) < batch.p]:
+            added.append((r, vadd, cv))
+
+    return added
+
+
+def step_record(batch, r, v, betweenness):
+    alive = batch.alive[r]
+    nn = int(alive.sum())
+    if nn == 0:
+        return [int(v) + 1, 0, 0, 0, 0]
+    row = batch.labels[r*batch.n:(r+1)*batch.n][alive]
+    sizes = np.unique(row, return_counts=True)[1]
+    if nn <= 2:
+        dc = 0
+    else:
+        degree = batch.degrees[r][alive]/float(nn - 1)
+        dc = float((nn*degree.max() - degree.sum())/(nn - 2))
+    bc = float('nan')
+    if betweenness:
+        H = nx.Graph()
+        H.add_nodes_from((np.flatnonzero(alive) + 1).tolist())
+        (a, b) = batch.live_edges(alive[None, :], r)
+        H.add_edges_from(np.column_stack((a + 1, b + 1)).tolist())
+        bc = betweenness_centralisation(H)
+
+    return [int(v) + 1, bc, dc, len(sizes), int(sizes.max())]
+
+
+def batched_simulation(network, tar, R, p=0.5, ignore_equipment=0,
+                       badapt=None, seed=None, betweenness=False):
+    """
+    R replicates of the strategy tar on the Network network, advanced in
+    lockstep.  badapt None follows the strategy (STRATEGIES[tar].adapt).
+    Returns the list of the R runs, each a list of step records as
+    intervention_adaptation_simulation() returns them (with nan for the
+    betweenness centralisation unless betweenness is True).
+    """
+
+    (scores, attribute) = batch_selector(tar)
+    if badapt is None:
+        badapt = STRATEGIES[tar].adapt
+    batch = Batch(network, R, p, ignore_equipment, np.random.default_rng(seed))
+    runs = [[] for r in range(R)]
+    batch.refresh()
+    while True:
+        active = np.flatnonzero(batch.alive.any(axis=1))
+        if len(active) == 0:
+            break
+        chosen = np.argmax(scores(batch, attribute), axis=1)
+        before = batch.alive.copy()
+        batch.alive[active, chosen[active]] = False
+        batch.refresh()
+
+        if badapt:
+            # Replicates whose deletion left more than one component
+            counts = np.zeros(R, dtype=np.int64)
+            live = np.flatnonzero(batch.alive.ravel())
+            roots = np.unique(batch.labels[live])
+            np.add.at(counts, roots // batch.n, 1)
+            added = []
+            for r in active[counts[active] > 1]:
+                added.extend(adapt_replicate(batch, r, chosen[r], before[r]))
+            if added != []:
+                # Two deficient components may propose the same edge, each
+                # from its own side; add_edge() adds it once, so must we
+                added = np.array(added, dtype=np.int64)
+                added = np.unique(np.column_stack((added[:, 0],
+                                                   added[:, 1:].min(axis=1),
+                                                   added[:, 1:].max(axis=1))), axis=0)
+                batch.extra = np.concatenate((batch.extra, added))
+                batch.refresh()
+
+        # Pruning takes whole components, so the degrees and labels of the
+        # nodes left stand
+        batch.prune()
+        for r in active:
+            runs[r].append(step_record(batch, r, chosen[r], betweenness))
+
+    return runs
+
+
+def main(argv):
+    R = int(argv[1]) if len(argv) > 1 else 1000
+    filename = argv[2] if len(argv) > 2 else 'criminal.txt'
+
+    network = load_network(filename)
+    for tar in batched_targets():
+        start = time.perf_counter()
+        runs = batched_simulation(network, tar, R)
+        elapsed = time.perf_counter() - start
+        lengths = [len(run) for run in runs]
+        print('%-20s %d runs in %7.2f s, mean length %6.2f'
+              % (OUTPUT_FILENAME_BY_TARGET[tar], R, elapsed,
+                 float(sum(lengths))/R))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the simulation code.
+
+Microbenchmarks time each targeting function, calc_attributes, the two
+centralisation functions, the adaptation block and pruning on a fixed
+graph; the end-to-end benchmarks time whole runs of
+intervention_adaptation_simulation() for each strategy.  Everything runs
+on criminal.txt and on synthetic networks of growing size.
+
+Results are appended as JSON lines to a results file, one record per
+(commit, network, benchmark), so that timings can be compared between
+commits and plotted against network size:
+
+    python benchmarks.py run [--sizes 128 256 512] [--repeat 5] [--runs 3]
+    python benchmarks.py compare OLD_COMMIT NEW_COMMIT [--threshold 0.1]
+    python benchmarks.py scaling [--commit COMMIT]
+
+compare exits with status 1 if any benchmark got slower by more than the
+threshold, so it can gate a change.  scaling prints a CSV table of
+seconds by benchmark and network size.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+
+import networkx as nx
+
+from simple import (initialise_network, intervention_adaptation_simulation,
+                    cut_set_targeting, max_degree_targeting,
+                    max_betweenness_targeting, money_targeting,
+                    precursor_targeting, attribute_targeting,
+                    random_targeting, calc_attributes, degree_centralisation,
+                    betweenness_centralisation, adapt_components,
+                    prune_inactive_components, attribute_masks, OUTPUT_FILENAME_BY_TARGET,
+                    NO_ADAPT_TARGETS)
+from synthetic import network_profile, generate, to_graph
+
+
+RESULTS_FILENAME = 'benchmarks.jsonl'
+
+
+def synthetic_network(n, profile, seed):
+    """
+    A synthetic network on nodes 1..n resembling the profiled network, for
+    scaling runs (see synthetic.py).
+    """
+
+    (edges, bits) = generate(n, profile, seed)
+
+    return to_graph(edges, bits)
+
+
+def current_commit():
+    """
+    The short hash of HEAD, with '+' appended if the tree has changes.
+    """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=here, universal_newlines=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--', '.'], cwd=here)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return commit + ('+' if dirty else '')
+
+
+def time_call(fn, repeat, setup=None):
+    """
+    Call fn() repeat times (after setup(), if given, whose result is passed
+    to fn) and return the list of wall times in seconds.
+    """
+
+    times = []
+    for r in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        if setup is not None:
+            fn(arg)
+        else:
+            fn()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def micro_benchmarks(G, node_attributes):
+    """
+    The microbenchmarks for the graph G, as a list of [name, fn, setup].
+    """
+
+    ignoreEquip = 0
+    top = max(G.degree_iter(), key=lambda nd: nd[1])[0]
+    # (Worked out once, as a run does)
+    masks = attribute_masks(node_attributes)
+
+    def adaptation_setup():
+        GG = G.copy()
+        GG.remove_node(top)
+        return [GG, list(nx.connected_component_subgraphs(GG))]
+
+    def pruning_setup():
+        GG = G.copy()
+        GG.remove_node(top)
+        return GG
+
+    return [
+        ['cut_set_targeting', lambda: cut_set_targeting(G, set()), None],
+        ['max_degree_targeting', lambda: max_degree_targeting(G), None],
+        ['max_betweenness_targeting', lambda: max_betweenness_targeting(G), None],
+        ['money_targeting', lambda: money_targeting(G, node_attributes, ignoreEquip), None],
+        ['precursor_targeting', lambda: precursor_targeting(G, node_attributes, ignoreEquip), None],
+        ['attribute_targeting', lambda: attribute_targeting(G, 3, node_attributes, ignoreEquip), None],
+        ['random_targeting', lambda: random_targeting(G), None],
+        ['calc_attributes', lambda: calc_attributes(G.nodes(), node_attributes, ignoreEquip), None],
+        ['degree_centralisation', lambda: degree_centralisation(G), None],
+        ['betweenness_centralisation', lambda: betweenness_centralisation(G), None],
+        ['adapt_components',
+         lambda GL: adapt_components(GL[0], G, top, GL[1], node_attributes, 0.5, ignoreEquip),
+         adaptation_setup],
+        ['prune_inactive_components',
+         lambda GG: prune_inactive_components(GG, node_attributes, ignoreEquip, masks),
+         pruning_setup],
+    ]
+
+
+def run_benchmarks(networks, repeat, runs, only, max_seconds, output):
+    """
+    Run every benchmark whose name contains only (all if only is None) on
+    every network in networks, a list of [name, G, node_attributes] in
+    increasing order of size, appending the results to output.
+
+    A benchmark is not run on the larger networks once a single call has
+    taken more than max_seconds.
+    """
+
+    commit = current_commit()
+    skipped = set()
+    f = open(output, 'a')
+    for (network, G, node_attributes) in networks:
+        benchmarks = micro_benchmarks(G, node_attributes)
+        for tar in range(len(OUTPUT_FILENAME_BY_TARGET)):
+            benchmarks.append(['run_' + OUTPUT_FILENAME_BY_TARGET[tar],
+                               (lambda tar: lambda: intervention_adaptation_simulation(
+                                   G, node_attributes, tar, tar not in NO_ADAPT_TARGETS,
+                                   0.5, 0))(tar),
+                               None])
+        for (name, fn, setup) in benchmarks:
+            if (only is not None and only not in name) or name in skipped:
+                continue
+            random.seed(1)
+            nrepeat = runs if name.startswith('run_') else repeat
+            times = time_call(fn, nrepeat, setup)
+            times.sort()
+            record = {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                      'network': network, 'n': G.number_of_nodes(),
+                      'm': G.number_of_edges(), 'benchmark': name,
+                      'seconds': times[len(times)//2], 'min': times[0],
+                      'repeat': nrepeat}
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            print('%-12s %-36s %12.6f s' % (network, name, record['seconds']))
+            if times[0] > max_seconds:
+                skipped.add(name)
+    f.close()
+
+
+def load_results(filename):
+    f = open(filename, 'r')
+    records = [json.loads(line) for line in f if line.strip() != '']
+    f.close()
+
+    return records
+
+
+def latest_by_key(records, commit):
+    """
+    {(network, benchmark): record} for the last records of the given commit.
+    """
+
+    result = {}
+    for record in records:
+        if record['commit'] == commit:
+            result[(record['network'], record['benchmark'])] = record
+
+    return result
+
+
+def compare(records, old, new, threshold):
+    """
+    Compare the timings of two commits.  Returns [lines of text, number of
+    regressions], a regression being a benchmark more than threshold
+    (a fraction) slower in new than in old.
+    """
+
+    before = latest_by_key(records, old)
+    after = latest_by_key(records, new)
+    lines = ['%-12s %-36s %12s %12s %8s' % ('network', 'benchmark', old, new, 'change')]
+    regressions = 0
+    for key in sorted(set(before.keys()) & set(after.keys())):
+        s0 = before[key]['seconds']
+        s1 = after[key]['seconds']
+        change = (s1 - s0)/s0 if s0 > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        lines.append('%-12s %-36s %12.6f %12.6f %+7.1f%%%s' % (
+            key[0], key[1], s0, s1, 100*change, flag))
+
+    return [lines, regressions]
+
+
+def scaling_table(records, commit):
+    """
+    CSV lines: one row per benchmark, one column per synthetic network size,
+    seconds in each cell.
+    """
+
+    latest = latest_by_key(records, commit)
+    sizes = sorted(set([r['n'] for (key, r) in latest.items() if key[0].startswith('synthetic')]))
+    names = sorted(set([key[1] for key in latest.keys()]))
+    lines = [','.join(['benchmark'] + [str(n) for n in sizes])]
+    for name in names:
+        row = [name]
+        for n in sizes:
+            matches = [r['seconds'] for (key, r) in latest.items()
+                       if key[1] == name and key[0].startswith('synthetic') and r['n'] == n]
+            row.append('%.6g' % matches[0] if matches != [] else '')
+        lines.append(','.join(row))
+
+    return lines
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks for the simulation code')
+    parser.add_argument('--results', default=RESULTS_FILENAME)
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run')
+    run.add_argument('--sizes', type=int, nargs='*', default=[128, 256, 512, 1024])
+    run.add_argument('--repeat', type=int, default=5)
+    run.add_argument('--runs', type=int, default=3)
+    run.add_argument('--only', default=None)
+    run.add_argument('--max-seconds', type=float, default=30.0)
+    run.add_argument('--network', default='criminal.txt')
+    cmp = commands.add_parser('compare')
+    cmp.add_argument('old')
+    cmp.add_argument('new')
+    cmp.add_argument('--threshold', type=float, default=0.1)
+    scaling = commands.add_parser('scaling')
+    scaling.add_argument('--commit', default=None)
+    args = parser.parse_args(argv[1:])
+
+    if args.command == 'compare':
+        (lines, regressions) = compare(load_results(args.results), args.old,
+                                       args.new, args.threshold)
+        print('\n'.join(lines))
+        return 1 if regressions > 0 else 0
+
+    if args.command == 'scaling':
+        commit = args.commit if args.commit is not None else current_commit()
+        print('\n'.join(scaling_table(load_results(args.results), commit)))
+        return 0
+
+    if args.command != 'run':
+        parser.print_help()
+        return 2
+
+    (G, node_attributes) = initialise_network(args.network)
+    networks = [['criminal', G, node_attributes]]
+    profile = network_profile(G, node_attributes)
+    for n in args.sizes:
+        (H, attributes) = synthetic_network(n, profile, n)
+        networks.append(['synthetic-%d' % n, H, attributes])
+    run_benchmarks(networks, args.repeat, args.runs, args.only,
+                   args.max_seconds, args.results)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
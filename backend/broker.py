@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Sweeps over several machines, through a job table in an SQLite file.
+
+There is no queue service on the cluster, but there is a shared file
+system, so the sweep lives in one SQLite database there:
+
+  networks  the networks of the sweep, as snapshots (see snapshot.py),
+            keyed by their content hash, so workers need nothing but the
+            database
+  units     the work units: (network, tar, adaptation, p,
+            ignore_equipment) and a range of seeds, seed .. seed+runs-1
+            (run k is seeded with seed+k, as run_task() seeds a run), with
+            their state: pending, leased (to a worker, until a time),
+            done or failed
+  results   the runs of each unit done, zlib-compressed JSON {'runs':
+            [step records of each run], 'seconds': [time of each run]}
+
+A worker claims the first pending unit in a transaction, taking a lease
+on it for LEASE seconds, and a heartbeat thread renews the lease every
+LEASE/3 seconds while the unit runs.  A worker that dies stops renewing,
+and once its lease has expired another worker claims the unit again.  A
+unit whose run raises goes back to pending with the error recorded.
+Either way a unit is tried at most MAX_ATTEMPTS times before it is
+marked failed.  If a lease expires under a worker that is merely slow,
+two workers may finish the same unit: the runs are seeded, so they are
+the same, and the first result stands.  Workers leave once no unit is
+pending or leased.
+
+The coordinator submits the units, optionally starts workers on the
+local host (several worker processes stand in for the nodes of the
+cluster), follows the sweep with telemetry (see telemetry.py), and
+finally merges the results of each cell (network, strategy, p,
+ignore_equipment) into its aggregates (see artifacts.py).
+
+The database uses SQLite's default rollback journal rather than WAL,
+which needs shared memory and does not work over network file systems.
+
+Usage: python broker.py submit DB NN [network_file ..] [--p P ..]
+                            [--ignore-equipment] [--unit-runs K] [--seed S]
+       python broker.py work DB [--lease SECONDS]
+       python broker.py coordinate DB [NN [network_file ..]] [--local-workers N]
+                            [--out DIR] (and the options of submit)
+       python broker.py status DB
+       python broker.py merge DB [--out DIR]
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+import contextlib
+import subprocess
+
+import numpy as np
+
+from network import load_network
+from snapshot import snapshot_layout, network_from_buffer
+from simple import (intervention_adaptation_simulation, NO_ADAPT_TARGETS,
+                    OUTPUT_FILENAME_BY_TARGET)
+
+
+LEASE = 60.0
+MAX_ATTEMPTS = 3
+UNIT_RUNS = 10
+# Seconds between polls of an idle worker and of the coordinator
+POLL = 2.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS networks (
+    hash TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    snapshot BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    network TEXT NOT NULL REFERENCES networks(hash),
+    tar INTEGER NOT NULL,
+    adaptation INTEGER NOT NULL,
+    p REAL NOT NULL,
+    ignore_equipment INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    runs INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS units_state ON units (state, id);
+CREATE TABLE IF NOT EXISTS results (
+    unit INTEGER PRIMARY KEY REFERENCES units(id),
+    payload BLOB NOT NULL
+);
+"""
+
+
+def connect(filename):
+    """
+    A connection to the sweep database filename, created if need be.
+    Transactions are explicit (see transaction()).
+    """
+
+    db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+    db.executescript(SCHEMA)
+
+    return db
+
+
+@contextlib.contextmanager
+def transaction(db):
+    """
+    A write transaction, taking the database's write lock at the start so
+    that two workers cannot claim the same unit.
+    """
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    db.execute('COMMIT')
+
+
+def snapshot_bytes(network):
+    """
+    [content hash, bytes] of a snapshot of the Network network.
+    """
+
+    (header, blobs, size) = snapshot_layout(network)
+    data = bytearray(size)
+    data[:len(header)] = header
+    for (start, blob) in blobs:
+        data[start:start+len(blob)] = blob
+
+    return [header[-32:].hex(), bytes(data)]
+
+
+def encode_result(runs, seconds):
+    return zlib.compress(json.dumps({'runs': runs, 'seconds': seconds},
+                                    separators=(',', ':')).encode('ascii'))
+
+
+def decode_result(payload):
+    return json.loads(zlib.decompress(payload).decode('ascii'))
+
+
+# Submitting
+
+def submit(db, filenames, nn, ps=(0.5,), ignore_equipment=0, unit_runs=UNIT_RUNS, seed=None):
+    """
+    Add the units of nn runs of every strategy, for each network file and
+    each p, and return the number of units added.  Runs are seeded with
+    consecutive seeds from seed (by default a random one).
+    """
+
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(32)
+    units = []
+    with transaction(db):
+        for filename in filenames:
+            (digest, data) = snapshot_bytes(load_network(filename))
+            db.execute('INSERT OR IGNORE INTO networks (hash, name, snapshot) VALUES (?, ?, ?)',
+                       (digest, os.path.basename(filename), data))
+            for p in ps:
+                for tar in range(len(OUTPUT_FILENAME_BY_TARGET)):
+                    for start in range(0, nn, unit_runs):
+                        runs = min(unit_runs, nn - start)
+                        units.append((digest, tar, int(tar not in NO_ADAPT_TARGETS), p,
+                                      ignore_equipment, seed, runs))
+                        seed += runs
+        db.executemany('INSERT INTO units (network, tar, adaptation, p, ignore_equipment, '
+                       'seed, runs) VALUES (?, ?, ?, ?, ?, ?, ?)', units)
+
+    return len(units)
+
+
+# Working
+
+def claim(db, worker, lease=LEASE):
+    """
+    Lease the first unit that is pending, or whose lease has expired, to
+    worker; returns the unit as a dict, or None if there is none.
+    """
+
+    now = time.time()
+    with transaction(db):
+        db.execute("UPDATE units SET state = 'failed', worker = NULL, "
+                   "error = COALESCE(error, 'lease expired') "
+                   "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                   (now, MAX_ATTEMPTS))
+        row = db.execute("SELECT id, network, tar, adaptation, p, ignore_equipment, seed, runs "
+                         "FROM units WHERE state = 'pending' "
+                         "OR (state = 'leased' AND lease_until < ?) ORDER BY id LIMIT 1",
+                         (now,)).fetchone()
+        if row is None:
+            return None
+        db.execute("UPDATE units SET state = 'leased', worker = ?, lease_until = ?, "
+                   "attempts = attempts + 1 WHERE id = ?", (worker, now + lease, row[0]))
+
+    return dict(zip(['id', 'network', 'tar', 'adaptation', 'p', 'ignore_equipment',
+                     'seed', 'runs'], row))
+
+
+def complete(db, unit, payload):
+    """
+    Store the result of unit; the first result stored stands.
+    """
+
+    with transaction(db):
+        db.execute('INSERT OR IGNORE INTO results (unit, payload) VALUES (?, ?)',
+                   (unit['id'], payload))
+        db.execute("UPDATE units SET state = 'done', worker = NULL, lease_until = NULL, "
+                   "finished = ? WHERE id = ?", (time.time(), unit['id']))
+
+
+def fail(db, unit, worker, error):
+    """
+    Give back a unit whose run raised error: pending again, or failed once
+    it has had MAX_ATTEMPTS.
+    """
+
+    with transaction(db):
+        db.execute("UPDATE units SET state = CASE WHEN attempts >= ? THEN 'failed' "
+                   "ELSE 'pending' END, worker = NULL, lease_until = NULL, error = ? "
+                   "WHERE id = ? AND worker = ? AND state = 'leased'",
+                   (MAX_ATTEMPTS, error, unit['id'], worker))
+
+
+def unfinished(db):
+    return db.execute("SELECT COUNT(*) FROM units WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+
+class Heartbeat(threading.Thread):
+    """
+    Renews worker's lease on a unit every lease/3 seconds until stop().
+    lost is set if the lease was taken over meanwhile.  (A thread of its
+    own, with a connection of its own, as sqlite3 connections are not
+    shared between threads.)
+    """
+
+    def __init__(self, filename, unit, worker, lease=LEASE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.unit = unit
+        self.worker = worker
+        self.lease = lease
+        self.lost = False
+        self.stopped = threading.Event()
+
+    def run(self):
+        db = connect(self.filename)
+        while not self.stopped.wait(self.lease/3):
+            with transaction(db):
+                renewed = db.execute("UPDATE units SET lease_until = ? WHERE id = ? AND worker = ? "
+                                     "AND state = 'leased'",
+                                     (time.time() + self.lease, self.unit['id'], self.worker))
+            if renewed.rowcount == 0:
+                self.lost = True
+                break
+        db.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Worker(object):
+    """
+    Claims and runs units of the sweep in filename until none is left.
+    The graphs of the networks are built once per worker.
+    """
+
+    def __init__(self, filename, lease=LEASE, name=None):
+        self.filename = filename
+        self.lease = lease
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.db = connect(filename)
+        self.graphs = {}
+
+    def graph(self, digest):
+        if digest not in self.graphs:
+            (data,) = self.db.execute('SELECT snapshot FROM networks WHERE hash = ?',
+                                      (digest,)).fetchone()
+            network = network_from_buffer(np.frombuffer(data, dtype=np.uint8),
+                                          'network %s' % digest, verify=True)
+            self.graphs[digest] = [network.to_graph(), network.node_attributes()]
+        return self.graphs[digest]
+
+    def run_unit(self, unit):
+        (G, node_attributes) = self.graph(unit['network'])
+        runs = []
+        seconds = []
+        for k in range(unit['runs']):
+            start = time.perf_counter()
+            random.seed(unit['seed'] + k)
+            runs.append(intervention_adaptation_simulation(
+                G, node_attributes, unit['tar'], bool(unit['adaptation']), unit['p'],
+                unit['ignore_equipment']))
+            seconds.append(time.perf_counter() - start)
+
+        return encode_result(runs, seconds)
+
+    def work(self):
+        """
+        Run units until the sweep has none pending or leased; returns the
+        number of units this worker completed.
+        """
+
+        done = 0
+        while True:
+            unit = claim(self.db, self.name, self.lease)
+            if unit is None:
+                if unfinished(self.db) == 0:
+                    return done
+                # Others hold leases, which may yet expire
+                time.sleep(POLL)
+                continue
+            heartbeat = Heartbeat(self.filename, unit, self.name, self.lease)
+            heartbeat.start()
+            try:
+                payload = self.run_unit(unit)
+            except Exception:
+                heartbeat.stop()
+                fail(self.db, unit, self.name, traceback.format_exc(limit=5))
+                continue
+            heartbeat.stop()
+            complete(self.db, unit, payload)
+            done += 1
+
+
+# Following and merging
+
+def status(db):
+    """
+    A dict with the number of units and of runs in each state, the failed
+    units (id, attempts, error) and the leases held (id, worker, seconds
+    left).
+    """
+
+    units = dict((state, [0, 0]) for state in ('pending', 'leased', 'done', 'failed'))
+    for (state, count, runs) in db.execute('SELECT state, COUNT(*), SUM(runs) FROM units '
+                                           'GROUP BY state'):
+        units[state] = [count, runs]
+    failed = db.execute("SELECT id, attempts, error FROM units WHERE state = 'failed' "
+                        "ORDER BY id").fetchall()
+    now = time.time()
+    leases = [(unit, worker, until - now) for (unit, worker, until) in
+              db.execute("SELECT id, worker, lease_until FROM units WHERE state = 'leased' "
+                         "ORDER BY id")]
+
+    return {'units': units, 'failed': failed, 'leases': leases}
+
+
+def cells(db):
+    """
+    {(network name, tar, p, ignore_equipment): [runs, ..]}: the runs of
+    the units done, merged by cell in the order of their seeds.
+    """
+
+    merged = {}
+    rows = db.execute('SELECT networks.name, tar, p, ignore_equipment, payload FROM units '
+                      'JOIN networks ON networks.hash = units.network '
+                      'JOIN results ON results.unit = units.id ORDER BY units.seed')
+    for (name, tar, p, ignore_equipment, payload) in rows:
+        merged.setdefault((name, tar, p, ignore_equipment), []).extend(decode_result(payload)['runs'])
+
+    return merged
+
+
+def merge(db, out=None):
+    """
+    Merge the results into one artifact per cell (see artifacts.py),
+    published into out if given; returns the artifacts.
+    """
+
+    from artifacts import cell_artifact, publish
+    merged = cells(db)
+    artifacts = [cell_artifact(name, tar, p, ignore_equipment, merged[(name, tar, p, ignore_equipment)])
+                 for (name, tar, p, ignore_equipment) in sorted(merged)]
+    if out is not None:
+        publish(artifacts, out)
+
+    return artifacts
+
+
+def follow(db, telemetry, workers):
+    """
+    Report the runs of units as they are done to telemetry, until the
+    sweep has no unit pending or leased, or all the local workers (a list
+    of Popen) have exited.
+    """
+
+    seen = set()
+    while True:
+        new = [unit for (unit,) in db.execute("SELECT id FROM units WHERE state = 'done'")
+               if unit not in seen]
+        for unit in new:
+            (tar, payload) = db.execute('SELECT tar, payload FROM units JOIN results '
+                                        'ON results.unit = units.id WHERE units.id = ?',
+                                        (unit,)).fetchone()
+            result = decode_result(payload)
+            for (run, seconds) in zip(result['runs'], result['seconds']):
+                telemetry.observe_run(tar, seconds, steps=len(run))
+            seen.add(unit)
+        if unfinished(db) == 0:
+            return
+        if workers and all(worker.poll() is not None for worker in workers):
+            return
+        time.sleep(POLL)
+
+
+def print_status(db):
+    state = status(db)
+    for (name, (count, runs)) in sorted(state['units'].items()):
+        print('%-8s %6d units %8d runs' % (name, count, runs or 0))
+    for (unit, worker, left) in state['leases']:
+        print('unit %d leased to %s, %.0f s left' % (unit, worker, left))
+    for (unit, attempts, error) in state['failed']:
+        print('unit %d failed after %d attempts: %s'
+              % (unit, attempts, (error or '').strip().splitlines()[-1:]))
+
+    return state
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Sweeps through a shared job table')
+    parser.add_argument('command', choices=['submit', 'work', 'coordinate', 'status', 'merge'])
+    parser.add_argument('database')
+    parser.add_argument('nn', nargs='?', type=int, default=None, help='runs per strategy')
+    parser.add_argument('networks', nargs='*', default=['criminal.txt'])
+    parser.add_argument('--p', type=float, nargs='+', default=[0.5])
+    parser.add_argument('--ignore-equipment', action='store_true')
+    parser.add_argument('--unit-runs', type=int, default=UNIT_RUNS)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--lease', type=float, default=LEASE)
+    parser.add_argument('--local-workers', type=int, default=0)
+    parser.add_argument('--out', default=None, help='publish the merged artifacts here')
+    args = parser.parse_args(argv[1:])
+    db = connect(args.database)
+
+    if args.command in ('submit', 'coordinate') and args.nn is not None:
+        added = submit(db, args.networks, args.nn, args.p, 1 if args.ignore_equipment else 0,
+                       args.unit_runs, args.seed)
+        print('%d units submitted to %s' % (added, args.database))
+    elif args.command == 'submit':
+        parser.error('submit needs the number of runs per strategy')
+
+    if args.command == 'work':
+        worker = Worker(args.database, args.lease)
+        start = time.perf_counter()
+        done = worker.work()
+        print('%s: %d units in %.1f s' % (worker.name, done, time.perf_counter() - start))
+
+    elif args.command == 'coordinate':
+        from telemetry import Telemetry
+        state = status(db)
+        total = sum(runs or 0 for (count, runs) in state['units'].values())
+        workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'work',
+                                     args.database, '--lease', str(args.lease)])
+                   for i in range(args.local_workers)]
+        telemetry = Telemetry('sweep.prom', total=total, workers=max(1, args.local_workers))
+        try:
+            follow(db, telemetry, workers)
+        finally:
+            telemetry.close()
+            for worker in workers:
+                worker.wait()
+        state = print_status(db)
+        artifacts = merge(db, args.out)
+        for artifact in artifacts:
+            print('%s %-26s p=%.2f ie=%d: %d runs, mean length %.2f'
+                  % (artifact['network'], artifact['strategy'], artifact['p'],
+                     artifact['ignore_equipment'], artifact['lengths']['runs'],
+                     artifact['lengths']['mean']))
+        if state['units']['pending'][0] or state['units']['leased'][0] or state['failed']:
+            return 1
+
+    elif args.command == 'status':
+        print_status(db)
+
+    elif args.command == 'merge':
+        artifacts = merge(db, args.out)
+        print('%d cells merged' % len(artifacts))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
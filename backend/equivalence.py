@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Statistical equivalence of simulation engines with the reference.
+
+The reference is intervention_adaptation_simulation() as it stood in
+all_simulations-20160711.py.  A faster engine that draws its random
+numbers in a different order cannot reproduce its runs, only their
+distribution, so for each strategy check() runs both engines over the
+same seeds and compares:
+
+  exact       where both engines draw from the random module the way the
+              reference does (Engine.exact), every run must be equal,
+              step record for step record
+  lengths     the numbers of deletions: two-sample Kolmogorov-Smirnov
+              test, and the difference of the means within a tolerance
+              band of BAND_Z standard errors
+  steps       every measure at every step (runs that have ended count as
+              0, as in SSav): two-sample KS tests, and the differences of
+              the means within tolerance bands, Bonferroni-corrected for
+              the number of comparisons
+
+A strategy passes if no run differs (when exact) and no test rejects at
+level alpha.  The engines:
+
+  reference   the 2016 code (all_simulations-20160711.py)
+  simple      simple.py (exact)
+  session     session.Session, stepping a strategy to the end
+  batched     batched.py, for the strategies it can batch (NumPy RNG)
+
+Runs are spread over a pool of processes sharing the network (see
+shared.py).
+
+Usage: python equivalence.py [candidate] [--reference ENGINE] [--runs N]
+           [--strategies T ..] [--alpha A] [--processes N] [--network FILE]
+The exit status is 1 if any strategy fails, so it can gate a change.
+"""
+
+import os
+import io
+import sys
+import math
+import time
+import random
+import argparse
+import contextlib
+import importlib.util
+from statistics import NormalDist
+from multiprocessing import Pool
+
+import numpy as np
+
+import shared
+from network import load_network
+from runstats import ragged_array
+from simple import (STRATEGIES, OUTPUT_FILENAME_BY_TARGET,
+                    intervention_adaptation_simulation)
+
+
+ALPHA = 0.001
+RUNS = 40
+BAND_Z = 4.0
+
+# Measures are compared rounded to DECIMALS places: engines that sum in a
+# different order differ in the last bits
+DECIMALS = 9
+
+LEGACY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'all_simulations-20160711.py')
+
+MEASURE_NAMES = ['betweenness', 'degree', 'nCC', 'Cmax']
+
+
+# Two-sample tests
+
+def ks_2samp(a, b):
+    """
+    [D, p]: the two-sample Kolmogorov-Smirnov statistic of the samples a
+    and b, and its asymptotic p-value.
+    """
+
+    a = np.sort(np.asarray(a, dtype=float))
+    b = np.sort(np.asarray(b, dtype=float))
+    (n, m) = (len(a), len(b))
+    points = np.concatenate((a, b))
+    D = float(np.max(np.abs(np.searchsorted(a, points, side='right')/float(n)
+                            - np.searchsorted(b, points, side='right')/float(m))))
+    en = math.sqrt(n*m/float(n + m))
+    lam = (en + 0.12 + 0.11/en) * D
+    if lam < 1e-3:
+        return [D, 1.0]
+    p = 2*sum([(-1)**(j - 1) * math.exp(-2*j*j*lam*lam) for j in range(1, 101)])
+
+    return [D, min(max(p, 0.0), 1.0)]
+
+
+def mean_band(a, b, z):
+    """
+    [difference of the means of a and b (along the first axis), its
+    tolerance: z standard errors of the difference].  Identical constant
+    samples have tolerance 0 and difference 0.
+    """
+
+    (n, m) = (a.shape[0], b.shape[0])
+    se = np.sqrt(a.var(axis=0, ddof=1)/n + b.var(axis=0, ddof=1)/m)
+
+    return [a.mean(axis=0) - b.mean(axis=0), z*se + 1e-9]
+
+
+# Engines
+
+class Engine(object):
+    """
+    A simulation engine.  run_one(G, node_attributes, network, tar, seed)
+    runs in a worker of the pool and returns a run as a list of step
+    records.
+    """
+
+    name = None
+    # Draws from the random module exactly as the reference does, so that
+    # runs with the same seed are equal
+    exact = False
+
+    def targets(self):
+        return sorted(STRATEGIES)
+
+    def runs(self, network, tar, seeds, pool):
+        tasks = [(self.name, tar, seed) for seed in seeds]
+        return pool.map(_engine_task, tasks)
+
+
+class Reference(Engine):
+    name = 'reference'
+    exact = True
+    module = None
+
+    def run_one(self, G, node_attributes, network, tar, seed):
+        if Reference.module is None:
+            spec = importlib.util.spec_from_file_location('all_simulations', LEGACY_FILE)
+            Reference.module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(Reference.module)
+        random.seed(seed)
+        # (It prints the number of components whenever there are several)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return Reference.module.intervention_adaptation_simulation(
+                G, node_attributes, tar, STRATEGIES[tar].adapt, 0.5, 0)
+
+
+class Simple(Engine):
+    name = 'simple'
+    exact = True
+
+    def run_one(self, G, node_attributes, network, tar, seed):
+        random.seed(seed)
+        return intervention_adaptation_simulation(G, node_attributes, tar, None, 0.5, 0)
+
+
+class SessionEngine(Engine):
+    name = 'session'
+
+    def run_one(self, G, node_attributes, network, tar, seed):
+        from session import Session
+        session = Session(network, 0.5, 0, seed)
+        run = []
+        while session.GG.number_of_nodes() > 0:
+            delta = session.step(tar)
+            metrics = delta['metrics']
+            run.append([session.label(delta['removed']), metrics['betweenness_centralisation'],
+                        metrics['degree_centralisation'], metrics['nCC'], metrics['Cmax']])
+        return run
+
+
+class Batched(Engine):
+    name = 'batched'
+
+    def targets(self):
+        from batched import batched_targets
+        return batched_targets()
+
+    def runs(self, network, tar, seeds, pool):
+        from batched import batched_simulation
+        # One batch for all the seeds, seeded by the first; betweenness is
+        # nan, and left out of the comparison
+        return batched_simulation(network, tar, len(seeds), seed=seeds[0])
+
+
+ENGINES = dict([(engine.name, engine) for engine in
+                [Reference(), Simple(), SessionEngine(), Batched()]])
+
+
+def _engine_task(task):
+    (name, tar, seed) = task
+    worker = shared._worker
+
+    return ENGINES[name].run_one(shared.worker_graph(), worker['node_attributes'],
+                                 worker['network'], tar, seed)
+
+
+# The comparison
+
+def compare(reference, candidate, exact, alpha=ALPHA):
+    """
+    Compare two lists of runs of one strategy (see above); returns a dict
+    of the results, with 'passed'.
+    """
+
+    result = {'runs': len(reference)}
+    failures = []
+    if exact:
+        differ = [k for k in range(len(reference)) if reference[k] != candidate[k]]
+        result['exact_mismatches'] = len(differ)
+        if differ:
+            failures.append('%d of %d runs differ' % (len(differ), len(reference)))
+
+    (la, va) = ragged_array(reference)
+    (lb, vb) = ragged_array(candidate)
+    (va, vb) = (np.round(va, DECIMALS), np.round(vb, DECIMALS))
+    (D, p) = ks_2samp(la, lb)
+    (difference, tolerance) = mean_band(la.astype(float), lb.astype(float), BAND_Z)
+    result['lengths'] = {'reference_mean': float(la.mean()), 'candidate_mean': float(lb.mean()),
+                         'ks_D': D, 'ks_p': p}
+    if p < alpha:
+        failures.append('deletion counts: KS p = %.2g' % p)
+    if abs(difference) > tolerance:
+        failures.append('mean deletions differ by %.3g (tolerance %.3g)' % (difference, tolerance))
+
+    # Per-step measures, padded to the same length; measures with nan
+    # (betweenness, from engines that skip it) are left out
+    T = max(va.shape[1], vb.shape[1])
+    va = np.pad(va, ((0, 0), (0, T - va.shape[1]), (0, 0)))
+    vb = np.pad(vb, ((0, 0), (0, T - vb.shape[1]), (0, 0)))
+    measures = [k for k in range(va.shape[2])
+                if not np.isnan(va[:, :, k]).any() and not np.isnan(vb[:, :, k]).any()]
+    comparisons = max(1, T*len(measures))
+    z = max(BAND_Z, NormalDist().inv_cdf(1 - alpha/(2*comparisons)))
+    worst_p = 1.0
+    worst = None
+    outside = 0
+    for k in measures:
+        (difference, tolerance) = mean_band(va[:, :, k], vb[:, :, k], z)
+        outside += int((np.abs(difference) > tolerance).sum())
+        for t in range(T):
+            p = ks_2samp(va[:, t, k], vb[:, t, k])[1]
+            if p < worst_p:
+                (worst_p, worst) = (p, (MEASURE_NAMES[k], t + 1))
+    result['steps'] = {'measures': [MEASURE_NAMES[k] for k in measures], 'comparisons': comparisons,
+                       'worst_ks_p': worst_p, 'worst': worst, 'outside_band': outside}
+    if worst_p < alpha/comparisons:
+        failures.append('%s at step %d: KS p = %.2g' % (worst + (worst_p,)))
+    if outside > 0:
+        failures.append('%d step means outside their bands' % outside)
+
+    result['failures'] = failures
+    result['passed'] = failures == []
+
+    return result
+
+
+def check(network, candidate, reference='reference', targets=None, runs=RUNS,
+          alpha=ALPHA, processes=None, seed=None):
+    """
+    Compare the engine candidate with reference (names of ENGINES) for each
+    strategy in targets (by default all those both can run), over runs
+    seeds each.  Returns {tar: compare() result}.
+    """
+
+    candidate = ENGINES[candidate]
+    reference = ENGINES[reference]
+    if targets is None:
+        targets = [tar for tar in reference.targets() if tar in candidate.targets()]
+    rng = random.Random(seed)
+    seeds = dict([(tar, [rng.getrandbits(32) for i in range(runs)]) for tar in targets])
+    exact = candidate.exact and reference.exact
+
+    block = shared.publish_network(network)
+    try:
+        pool = Pool(processes, initializer=shared.init_worker, initargs=(block.name,))
+        try:
+            results = {}
+            for tar in targets:
+                a = reference.runs(network, tar, seeds[tar], pool)
+                b = candidate.runs(network, tar, seeds[tar], pool)
+                results[tar] = compare(a, b, exact, alpha)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        block.close()
+        block.unlink()
+
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Compare an engine with the reference simulation')
+    parser.add_argument('candidate', nargs='?', default='simple', choices=sorted(ENGINES))
+    parser.add_argument('--reference', default='reference', choices=sorted(ENGINES))
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--strategies', type=int, nargs='+', default=None)
+    parser.add_argument('--alpha', type=float, default=ALPHA)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--network', default='criminal.txt')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv[1:])
+
+    start = time.perf_counter()
+    results = check(load_network(args.network), args.candidate, args.reference,
+                    args.strategies, args.runs, args.alpha, args.processes, args.seed)
+    failed = 0
+    for tar in sorted(results):
+        result = results[tar]
+        lengths = result['lengths']
+        line = '%-26s %s  deletions %6.2f vs %6.2f (KS p %.3f), worst step KS p %.2g' % (
+            OUTPUT_FILENAME_BY_TARGET[tar], 'pass' if result['passed'] else 'FAIL',
+            lengths['reference_mean'], lengths['candidate_mean'], lengths['ks_p'],
+            result['steps']['worst_ks_p'])
+        if 'exact_mismatches' in result:
+            line += ', %d/%d runs equal' % (result['runs'] - result['exact_mismatches'], result['runs'])
+        print(line)
+        for failure in result['failures']:
+            print('    %s' % failure)
+        failed += not result['passed']
+    print('%s vs %s: %d of %d strategies pass, in %.1f s'
+          % (args.candidate, args.reference, len(results) - failed, len(results),
+             time.perf_counter() - start))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
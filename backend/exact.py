@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Exact distributions for the no-adapt strategies whose only randomness is
+tie-breaking.
+
+For MaxDegree_No_adapt (6) and MaxBetweenness_No_adapt (9), and likewise
+for Money_No_adapt (11) and Precursors_No_adapt (12), the network never
+adapts, so the graph after every step is the subgraph of G induced by the
+surviving nodes, and the only random choice is which of the tied
+candidates is deleted.  Rather than estimating the outcome from 100 Monte
+Carlo runs, we explore the tree of tie branches: each graph state (a set
+of surviving nodes) is expanded once, identical states reached along
+different branches are merged, and each branch is weighted by the
+probability 1/|ties| of choosing it.
+
+The result is the exact distribution of the number of deletion steps and
+the exact expected value of every recorded measure at every step, padded
+with zeros after the end of a run as main() in
+all_simulations-20160711.py does before averaging.
+
+Random_No_Adapt (13) is accepted too, but there every node is a candidate
+at every step, so the number of states explodes for all but tiny graphs;
+use max_states to bail out.  CutSet_No_adapt (10) is not handled: the
+cutset carried between steps is part of its state.
+"""
+
+import sys
+from fractions import Fraction
+
+from simple import (initialise_network, max_degree_candidates,
+                    max_betweenness_candidates, attribute_candidates,
+                    prune_inactive_components, step_measures, attribute_masks,
+                    OUTPUT_FILENAME_BY_TARGET)
+
+
+# For each supported target, a function (H, node_attributes,
+# ignore_equipment) returning the nodes the strategy chooses uniformly from
+CANDIDATES_BY_TARGET = {
+    6: lambda H, na, ie: max_degree_candidates(H),
+    9: lambda H, na, ie: max_betweenness_candidates(H),
+    11: lambda H, na, ie: attribute_candidates(H, 1, na, ie),
+    12: lambda H, na, ie: attribute_candidates(H, 5, na, ie),
+    13: lambda H, na, ie: H.nodes(),
+}
+
+
+class StateLimitExceeded(Exception):
+    pass
+
+
+def exact_distribution(G, node_attributes, tar, ignore_equipment,
+                       max_states=None):
+    """
+    Exact outcome of the no-adapt targeting strategy tar on the graph G.
+
+    Returns a dict with
+      'lengths'      {number of deletion steps: probability (a Fraction)}
+      'averages'     [[bc, dc, nCC, Cmax] for each step], the expected
+                     measures at each step, zero once a run has ended
+      'states'       the number of distinct graph states expanded
+      'evaluations'  the number of graph evaluations (candidate lists and
+                     step measures) that were needed
+
+    Raises StateLimitExceeded if more than max_states states are expanded.
+    """
+
+    if tar not in CANDIDATES_BY_TARGET:
+        raise ValueError("No exact engine for targeting method %d" % tar)
+    candidates = CANDIDATES_BY_TARGET[tar]
+
+    masks = attribute_masks(node_attributes)
+    start = frozenset(G.nodes())
+    # For every resolved state: [lengths, averages]
+    resolved = {frozenset(): [{0: Fraction(1)}, []]}
+    # For every expanded state: [[child, weight], ..]
+    children = {}
+    # The measures recorded once a step has led to the given state
+    measures = {}
+    expanded = 0
+    evaluations = 0
+
+    stack = [start]
+    while stack != []:
+        state = stack[-1]
+        if state in resolved:
+            stack.pop()
+            continue
+
+        if state not in children:
+            if max_states is not None and expanded >= max_states:
+                raise StateLimitExceeded("More than %d states" % max_states)
+            expanded += 1
+            H = G.subgraph(state)
+            C = candidates(H, node_attributes, ignore_equipment)
+            evaluations += 1
+            weights = {}
+            for v in C:
+                HH = H.copy()
+                HH.remove_node(v)
+                prune_inactive_components(HH, node_attributes, ignore_equipment, masks)
+                child = frozenset(HH.nodes())
+                if child not in measures:
+                    measures[child] = step_measures(HH)
+                    evaluations += 1
+                weights[child] = weights.get(child, 0) + Fraction(1, len(C))
+            children[state] = list(weights.items())
+            pending = [child for (child, w) in children[state] if child not in resolved]
+            if pending != []:
+                stack.extend(pending)
+                continue
+
+        # All children are resolved: combine them
+        lengths = {}
+        averages = []
+        for (child, w) in children[state]:
+            (child_lengths, child_averages) = resolved[child]
+            for (L, q) in child_lengths.items():
+                lengths[L+1] = lengths.get(L+1, 0) + w*q
+            rows = [measures[child]] + child_averages
+            while len(averages) < len(rows):
+                averages.append([0.0, 0.0, 0.0, 0.0])
+            for j in range(len(rows)):
+                for k in range(4):
+                    averages[j][k] += float(w)*rows[j][k]
+        resolved[state] = [lengths, averages]
+        del children[state]
+        stack.pop()
+
+    return {'lengths': resolved[start][0], 'averages': resolved[start][1],
+            'states': expanded, 'evaluations': evaluations}
+
+
+def length_moments(lengths):
+    """
+    [mean, standard deviation] of a distribution of deletion counts, using
+    the same (population) standard deviation as main().
+    """
+
+    mean = sum([L*q for (L, q) in lengths.items()])
+    var = sum([(L - mean)**2 * q for (L, q) in lengths.items()])
+
+    return [float(mean), float(var) ** 0.5]
+
+
+def main():
+    (G, node_attributes) = initialise_network('criminal.txt')
+    ignoreEquip = 0
+
+    for tar in [6, 9, 11, 12]:
+        result = exact_distribution(G, node_attributes, tar, ignoreEquip)
+        (Sav, Ssd) = length_moments(result['lengths'])
+        print(OUTPUT_FILENAME_BY_TARGET[tar])
+        print('  states %d, graph evaluations %d' % (result['states'], result['evaluations']))
+        print('  mean %.4f, sd %.4f' % (Sav, Ssd))
+        for L in sorted(result['lengths'].keys()):
+            print('  %3d steps with probability %s' % (L, result['lengths'][L]))
+
+        f = open(OUTPUT_FILENAME_BY_TARGET[tar]+'_exact_averages.txt', 'w')
+        f.write("%s\n" % result['averages'])
+        f.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
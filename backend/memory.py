@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in memory accounting for the simulation, with a per-worker budget.
+
+A MemoryProfiler is a profiling.Profiler (so it times the phases of a
+step as well) that also follows the memory the Python allocator hands
+out, with tracemalloc:
+
+  - for each run, the peak of traced memory, and for each phase of a
+    step the most it grew above its level at the start of the phase
+    (over all the steps of the run, and of all runs by strategy);
+  - the biggest allocation sites, by size of what they hold at the
+    high-water mark of the run: a snapshot is taken whenever the traced
+    memory at the end of a phase exceeds the last one's by a quarter.
+    (Memory allocated and freed within a phase shows in its peak, not in
+    the sites.)
+
+Given a budget in bytes, each phase's peak is checked against it as the
+phase ends.  Over budget, a run is either aborted, by raising
+MemoryBudgetExceeded (a MemoryError, with the phase and the sites), or
+degraded: it stops using the state cache and its step measures estimate
+betweenness from APPROXIMATE_SOURCES sources (see simple.py).  What the
+run holds already stays, so a degraded run is only aborted if it goes
+over HARD_LIMIT times the budget.  Degraded runs are marked as such in
+their records.
+
+Traced memory is what Python allocates after tracing starts (start() it
+before loading the network to count the network too), NumPy arrays
+included; it is somewhat below the resident size of the process.
+Tracing slows the simulation down several times, so it is for
+finding the budget of a network and for runs that must be kept inside
+one.
+
+    profiler = MemoryProfiler(budget=2 << 30, on_exceed='degrade')
+    intervention_adaptation_simulation(..., profiler=profiler)
+    record = profiler.end_run()
+    print(profiler.report())
+
+Usage: python memory.py [nn] [--budget MB] [--on-exceed abort|degrade]
+                        [--strategies T ..] [--processes N] [--network FILE]
+                        [--top N] [--frames N] [--json FILE]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+from multiprocessing import Pool, cpu_count
+
+import shared
+from network import load_network
+from profiling import Profiler, _Phase
+from simple import (intervention_adaptation_simulation, NO_ADAPT_TARGETS,
+                    OUTPUT_FILENAME_BY_TARGET)
+
+
+ON_EXCEED = ['abort', 'degrade']
+
+# Allocation sites kept per run, and frames of traceback per allocation.
+# One frame names the line that allocated, often in NetworkX or copy.py;
+# tracing 10-20 frames also names the line of simple.py that led there,
+# at several times the cost
+TOP = 10
+FRAMES = 1
+
+# Over the budget, a degraded run is aborted beyond this multiple of it
+HARD_LIMIT = 1.25
+
+# Growth of the traced memory that triggers a new high-water snapshot
+SNAPSHOT_GROWTH = 1.25
+
+MB = float(1 << 20)
+
+HERE = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+
+def start(frames=FRAMES):
+    """
+    Start tracing allocations, if nothing has yet.
+    """
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def _short(frame):
+    filename = frame.filename
+    if filename.startswith(HERE):
+        filename = os.path.relpath(filename, HERE)
+    elif 'site-packages' + os.sep in filename:
+        filename = filename.split('site-packages' + os.sep)[-1]
+    else:
+        filename = os.path.basename(filename)
+
+    return '%s:%d' % (filename, frame.lineno)
+
+
+def site_statistics(snapshot, top=TOP):
+    """
+    The top allocation sites of a snapshot, as [site, bytes, blocks].  A
+    site is the line that allocated, 'file:line', followed by ' < ' and the
+    innermost line of the simulation's own code that led to it, if that
+    is another one (tracemalloc's own allocations are left out).
+    """
+
+    sizes = {}
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    for trace in snapshot.traces:
+        # Frames come most recent first
+        frames = list(trace.traceback)
+        site = _short(frames[0])
+        for frame in frames:
+            if frame.filename.startswith(HERE):
+                if frame is not frames[0]:
+                    site += ' < ' + _short(frame)
+                break
+        entry = sizes.get(site)
+        if entry is None:
+            entry = sizes[site] = [0, 0]
+        entry[0] += trace.size
+        entry[1] += 1
+
+    return [[site, size, count] for (site, (size, count))
+            in sorted(sizes.items(), key=lambda item: -item[1][0])[:top]]
+
+
+class _MemoryPhase(_Phase):
+    """
+    Context manager timing one phase and following its memory.
+    """
+
+    def __enter__(self):
+        self.profiler.fold_peak()
+        tracemalloc.reset_peak()
+        self.level = tracemalloc.get_traced_memory()[0]
+        return _Phase.__enter__(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _Phase.__exit__(self, exc_type, exc_value, traceback)
+        # (No budget check while an exception is on its way out)
+        self.profiler.observe(self.name, self.level, exc_type is None)
+        return False
+
+
+class MemoryProfiler(Profiler):
+    """
+    Time and memory per (strategy, phase), memory per run and allocation
+    sites, within an optional budget in bytes (see above).  on_exceed is
+    one of ON_EXCEED.
+    """
+
+    def __init__(self, budget=None, on_exceed='abort', top=TOP, frames=FRAMES):
+        Profiler.__init__(self)
+        if on_exceed not in ON_EXCEED:
+            raise ValueError("on_exceed must be one of %s" % ', '.join(ON_EXCEED))
+        start(frames)
+        self.budget = budget
+        self.on_exceed = on_exceed
+        self.top = top
+        self.peaks = {}
+        self.runs = []
+        self.sites = {}
+        self.run = None
+        self.snapshot = None
+
+    def begin_run(self):
+        self.end_run()
+        tracemalloc.reset_peak()
+        level = tracemalloc.get_traced_memory()[0]
+        self.degraded = False
+        self.snapshot = None
+        self.snapshot_level = level
+        self.run = {'strategy': self.strategy, 'start': level, 'peak': level, 'phases': {},
+                    'degraded': None, 'aborted': None, 'sites': []}
+
+    def fold_peak(self):
+        """
+        Fold the peak since the last reset into the run's.
+        """
+
+        if self.run is not None:
+            self.run['peak'] = max(self.run['peak'], tracemalloc.get_traced_memory()[1])
+
+    def phase(self, name):
+        return _MemoryPhase(self, name)
+
+    def observe(self, name, level, check=True):
+        """
+        The phase name, which started with level bytes traced, has ended.
+        """
+
+        (current, peak) = tracemalloc.get_traced_memory()
+        growth = peak - level
+        key = (self.strategy, name)
+        self.peaks[key] = max(self.peaks.get(key, 0), growth)
+        if self.run is None:
+            return
+        phases = self.run['phases']
+        phases[name] = max(phases.get(name, 0), growth)
+        self.run['peak'] = max(self.run['peak'], peak)
+        if self.snapshot is None or current > self.snapshot_level * SNAPSHOT_GROWTH:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_level = current
+        if check and self.budget is not None:
+            if peak > self.budget * (HARD_LIMIT if self.degraded else 1):
+                self.exceeded(name, peak)
+
+    def exceeded(self, name, peak):
+        if self.on_exceed == 'degrade' and not self.degraded:
+            self.degraded = True
+            self.run['degraded'] = name
+            self.count('degraded_runs')
+            # Measure afresh from here
+            tracemalloc.reset_peak()
+            return
+        self.run['aborted'] = name
+        self.count('aborted_runs')
+        sites = site_statistics(self.snapshot, 3) if self.snapshot is not None else []
+        raise MemoryBudgetExceeded(
+            'strategy %s, %s phase: %.1f MB traced, over the budget of %.1f MB%s; biggest sites %s'
+            % (self.strategy, name, peak/MB, self.budget/MB,
+               ' and degraded' if self.degraded else '',
+               ', '.join(['%s (%.1f MB)' % (site, size/MB) for (site, size, count) in sites])))
+
+    def end_run(self):
+        """
+        Close the record of the current run, and return it (None if no run
+        is open): a dict with 'strategy', 'start' and 'peak' (bytes
+        traced), 'phases' ({phase: most growth in bytes}), 'degraded' and
+        'aborted' (the phase it happened in, or None) and 'sites' (see
+        site_statistics()).
+        """
+
+        run = self.run
+        if run is None:
+            return None
+        self.fold_peak()
+        if self.snapshot is not None:
+            run['sites'] = site_statistics(self.snapshot, self.top)
+            for (site, size, count) in run['sites']:
+                self.sites[site] = max(self.sites.get(site, 0), size)
+        self.runs.append(run)
+        (self.run, self.snapshot) = (None, None)
+
+        return run
+
+    def dump(self):
+        """
+        Profiler.dump(), with 'memory': {'peaks': {strategy: {phase:
+        bytes}}, 'runs': [run records], 'sites': {site: bytes}}.
+        """
+
+        self.end_run()
+        result = Profiler.dump(self)
+        peaks = {}
+        for ((tar, name), growth) in self.peaks.items():
+            peaks.setdefault(str(tar), {})[name] = growth
+        result['memory'] = {'peaks': peaks, 'runs': self.runs, 'sites': self.sites}
+
+        return result
+
+    def report(self):
+        self.end_run()
+        return format_records(self.runs, self.top)
+
+
+def format_records(runs, top=TOP):
+    """
+    A plain text table of run records: per strategy, the runs, their peaks
+    and the phases' most growth, then the biggest allocation sites.
+    """
+
+    lines = ['%-26s %5s %10s %10s %8s %8s   %s' % ('strategy', 'runs', 'mean MB', 'peak MB',
+                                                   'degraded', 'aborted', 'phase growth MB')]
+    strategies = sorted(set([run['strategy'] for run in runs]))
+    sites = {}
+    for tar in strategies:
+        mine = [run for run in runs if run['strategy'] == tar]
+        peaks = [run['peak'] for run in mine]
+        phases = {}
+        for run in mine:
+            for (name, growth) in run['phases'].items():
+                phases[name] = max(phases.get(name, 0), growth)
+            for (site, size, count) in run['sites']:
+                sites[site] = max(sites.get(site, 0), size)
+        lines.append('%-26s %5d %10.2f %10.2f %8d %8d   %s' % (
+            OUTPUT_FILENAME_BY_TARGET[tar] if tar is not None else '-', len(mine),
+            sum(peaks)/MB/len(mine), max(peaks)/MB,
+            len([run for run in mine if run['degraded']]),
+            len([run for run in mine if run['aborted']]),
+            ' '.join(['%s %.2f' % (name, phases[name]/MB)
+                      for name in sorted(phases, key=lambda name: -phases[name])])))
+    lines.append('Biggest allocation sites (at the high-water mark of a run):')
+    for site in sorted(sites, key=lambda site: -sites[site])[:top]:
+        lines.append('  %10.2f MB  %s' % (sites[site]/MB, site))
+
+    return '\n'.join(lines)
+
+
+# Budgeted sweeps
+
+def init_worker(name, budget, on_exceed, top, frames):
+    """
+    Pool initializer: start tracing, then attach to the network (see
+    shared.init_worker()), so that what the worker builds from it counts.
+    """
+
+    start(frames)
+    shared.init_worker(name)
+    shared._worker['profiler'] = MemoryProfiler(budget, on_exceed, top, frames)
+
+
+def run_task(task):
+    """
+    One run (task as for shared.run_task(), on a graph of its own) within
+    the worker's budget; returns [number of deletions, or None if aborted,
+    run record].
+    """
+
+    (tar, adaptation, p, ignore_equipment, seed) = task
+    worker = shared._worker
+    random.seed(seed)
+    try:
+        values = intervention_adaptation_simulation(
+            worker['network'].to_graph(), worker['node_attributes'], tar, adaptation, p,
+            ignore_equipment, profiler=worker['profiler'], copy=False)
+        length = len(values)
+    except MemoryBudgetExceeded:
+        length = None
+
+    return [length, worker['profiler'].end_run()]
+
+
+def run_budgeted(network, tasks, budget=None, on_exceed='abort', processes=None, top=TOP,
+                 frames=FRAMES):
+    """
+    Run the tasks on a pool of processes sharing the Network network, each
+    worker held to budget bytes; returns the results of run_task() in the
+    order of tasks.
+    """
+
+    block = shared.publish_network(network)
+    try:
+        pool = Pool(processes, initializer=init_worker,
+                    initargs=(block.name, budget, on_exceed, top, frames))
+        try:
+            results = pool.map(run_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        block.close()
+        block.unlink()
+
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Memory accounting of simulation runs')
+    parser.add_argument('nn', nargs='?', type=int, default=5, help='runs per strategy')
+    parser.add_argument('--budget', type=float, default=None, help='per worker, in MB')
+    parser.add_argument('--on-exceed', choices=ON_EXCEED, default='abort')
+    parser.add_argument('--strategies', type=int, nargs='+', default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--network', default='criminal.txt')
+    parser.add_argument('--top', type=int, default=TOP)
+    parser.add_argument('--frames', type=int, default=FRAMES)
+    parser.add_argument('--json', default=None, help='write the run records here')
+    args = parser.parse_args(argv[1:])
+
+    targets = args.strategies or range(len(OUTPUT_FILENAME_BY_TARGET))
+    random.seed()
+    tasks = [(tar, tar not in NO_ADAPT_TARGETS, 0.5, 0, random.getrandbits(64))
+             for tar in targets for i in range(args.nn)]
+    budget = None if args.budget is None else int(args.budget * MB)
+
+    start_time = time.perf_counter()
+    results = run_budgeted(load_network(args.network), tasks, budget, args.on_exceed,
+                           args.processes, args.top, args.frames)
+    records = [record for (length, record) in results]
+    print(format_records(records, args.top))
+    print('%d runs on %d processes in %.1f s' % (len(tasks), args.processes or cpu_count(),
+                                                 time.perf_counter() - start_time))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(records, f, indent=1)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
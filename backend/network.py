@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Loading networks of any size.
+
+A network file holds ID1 and ID2, the "from" and "to" nodes of each
+(directed) edge, and node_attributes, a list [[v, b1, .., b8], ..] giving
+the 8 attribute bits of every node v (see initialise_network() in
+simple.py).  Node IDs can be any integers, in any order and with gaps.
+
+load_network() relabels the nodes to dense indices 0..n-1, in increasing
+order of ID, and keeps the IDs as the reverse map.  Edges and attributes
+are built as arrays in bulk, so loading takes time linear in the size of
+the file, and everything downstream can be indexed by node.  The file is
+checked on the way: every attribute row must have 8 bits, no ID may have
+two attribute rows, and every edge must join two different nodes that
+have attribute rows.  Reciprocal or repeated edges are merged (criminal.txt
+lists most edges in both directions) and counted in duplicate_edges.
+
+The simulation code keeps its 1-based convention (node_attributes[v-1]):
+Network.to_graph() and Network.node_attributes() label node i as i+1, and
+network.ids[v-1] is the original ID of node v.
+
+load_network() also reads the binary snapshots written by snapshot.py.
+"""
+
+import json
+
+import numpy as np
+import networkx as nx
+
+
+# Attribute bitmasks: bit j-1 for attribute j
+ALL_ATTRIBUTES = 0xFF
+# Attribute 4 (equipment)
+EQUIPMENT = 1 << 3
+
+
+class NetworkError(ValueError):
+    pass
+
+
+class Network(object):
+    """
+    A network with nodes relabelled 0..n-1.
+
+    ids      (n,) original node IDs, increasing; ids[i] is the ID of node i
+    edges    (m, 2) undirected edges as pairs of node indices, i < j,
+             each edge once, sorted
+    masks    (n,) attribute bitmasks, bit j-1 set for attribute j
+    """
+
+    def __init__(self, ids, edges, masks, duplicate_edges=0):
+        self.ids = ids
+        self.edges = edges
+        self.masks = masks
+        self.duplicate_edges = duplicate_edges
+        self._csr = None
+
+    @property
+    def n(self):
+        return len(self.ids)
+
+    @property
+    def m(self):
+        return len(self.edges)
+
+    def index(self, node_ids):
+        """
+        The node indices of the given original IDs.
+        """
+
+        node_ids = np.asarray(node_ids)
+        if self.n == 0:
+            raise KeyError("Unknown node ID")
+        positions = np.minimum(np.searchsorted(self.ids, node_ids), self.n - 1)
+        if np.any(self.ids[positions] != node_ids):
+            raise KeyError("Unknown node ID")
+
+        return positions
+
+    def attribute_bits(self):
+        """
+        The (n, 8) array of attribute bits: column j-1 for attribute j.
+        """
+
+        return ((self.masks[:, None] >> np.arange(8, dtype=np.uint8)) & 1).astype(np.uint8)
+
+    def node_attributes(self):
+        """
+        The attributes as the list [[v, b1, .., b8], ..] used by the
+        simulation, with node i labelled v = i+1.
+        """
+
+        rows = np.column_stack((np.arange(1, self.n+1), self.attribute_bits()))
+
+        return rows.tolist()
+
+    def degrees(self):
+        return np.bincount(self.edges.ravel(), minlength=self.n)
+
+    def csr(self):
+        """
+        The adjacency in compressed sparse row form: the neighbours of node
+        i are indices[offsets[i]:offsets[i+1]], in increasing order.
+        """
+
+        if self._csr is None:
+            both = np.concatenate((self.edges, self.edges[:, ::-1]))
+            order = np.lexsort((both[:, 1], both[:, 0]))
+            offsets = np.zeros(self.n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(both[:, 0], minlength=self.n), out=offsets[1:])
+            self._csr = (offsets, both[order, 1].astype(np.int32))
+
+        return self._csr
+
+    def to_graph(self):
+        """
+        The network as a graph on the nodes 1..n.
+        """
+
+        G = nx.Graph()
+        G.add_nodes_from(range(1, self.n+1))
+        G.add_edges_from((self.edges + 1).tolist())
+
+        return G
+
+
+def component_labels(size, a, b):
+    """
+    Connected component labels of the graph on nodes 0..size-1 with the
+    edges (a[k], b[k]), by union-find on arrays: each round hooks every
+    edge's endpoints onto the smaller of their labels, then compresses the
+    label pointers fully, until every edge has equal labels at both ends.
+    Every node ends up labelled by the smallest node in its component.
+    """
+
+    labels = np.arange(size)
+    if len(a) == 0:
+        return labels
+    while True:
+        low = np.minimum(labels[a], labels[b])
+        np.minimum.at(labels, a, low)
+        np.minimum.at(labels, b, low)
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+        if np.array_equal(labels[a], labels[b]):
+            return labels
+
+
+def network_from_data(data):
+    """
+    A Network from a dict with ID1, ID2 and node_attributes, as stored in
+    criminal.txt.  Raises NetworkError if the data is inconsistent.
+    """
+
+    ID1 = np.asarray(data['ID1'], dtype=np.int64)
+    ID2 = np.asarray(data['ID2'], dtype=np.int64)
+    if ID1.shape != ID2.shape or ID1.ndim != 1:
+        raise NetworkError("ID1 and ID2 have different lengths")
+    try:
+        rows = np.asarray(data['node_attributes'], dtype=np.int64)
+    except ValueError:
+        raise NetworkError("node_attributes rows have different lengths")
+    if rows.ndim != 2 or rows.shape[1] != 9:
+        raise NetworkError("node_attributes rows must be [v, b1, .., b8]")
+    if np.any((rows[:, 1:] != 0) & (rows[:, 1:] != 1)):
+        raise NetworkError("Attribute values must be 0 or 1")
+
+    (ids, first, counts) = np.unique(rows[:, 0], return_index=True, return_counts=True)
+    if np.any(counts > 1):
+        raise NetworkError("Node %d has %d attribute rows"
+                           % (ids[counts > 1][0], counts[counts > 1][0]))
+    bits = rows[first, 1:].astype(np.uint8)
+    masks = (bits << np.arange(8, dtype=np.uint8)).sum(axis=1).astype(np.uint8)
+
+    # Relabel the edge endpoints, checking they all have attribute rows
+    n = len(ids)
+    ends = np.concatenate((ID1, ID2))
+    positions = ends
+    if len(ends) > 0:
+        if n == 0:
+            raise NetworkError("Edges given but no attribute rows")
+        positions = np.minimum(np.searchsorted(ids, ends), n - 1)
+        dangling = ends[ids[positions] != ends]
+        if len(dangling) > 0:
+            raise NetworkError("Edge endpoint %d has no attribute row (%d dangling IDs)"
+                               % (dangling[0], len(np.unique(dangling))))
+    u = positions[:len(ID1)]
+    v = positions[len(ID1):]
+    if np.any(u == v):
+        raise NetworkError("Self-loop at node %d" % ID1[u == v][0])
+
+    keys = np.minimum(u, v)*n + np.maximum(u, v)
+    unique_keys = np.unique(keys)
+    edges = np.column_stack((unique_keys // n, unique_keys % n)).astype(np.int32)
+
+    return Network(ids, edges, masks, len(keys) - len(unique_keys))
+
+
+def load_network(filename):
+    """
+    Load a network file (in the format of criminal.txt) as a Network.
+    Snapshots (see snapshot.py) are recognised and memory-mapped instead.
+    """
+
+    from snapshot import is_snapshot, load_snapshot
+    if is_snapshot(filename):
+        return load_snapshot(filename)
+
+    with open(filename, 'r') as f:
+        data = json.load(f)
+
+    return network_from_data(data)
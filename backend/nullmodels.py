@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Null-model ensembles of a network, for baselines of the strategies.
+
+Whether a strategy does well on criminal.txt because of the structure of
+the network, or would do as well on any network with its degrees and
+attributes, shows by running it on many randomised variants.  Variants
+are generated in bulk on arrays, R at a time:
+
+  rewire_edges()        degree-preserving randomisation by double edge
+                        swaps: edges (a, b) and (c, d) become (a, d) and
+                        (c, b).  Each round pairs up the edges of every
+                        replicate by a random matching and tries all m/2
+                        swaps at once, rejecting those that would make a
+                        self-loop, an edge already present, or an edge
+                        another swap of the round makes too.  2*swaps
+                        rounds make swaps proposals per edge.
+  permute_attributes()  attribute shuffles, in one of ATTRIBUTE_MODES:
+                          bits      each attribute permuted over the nodes
+                                    on its own, keeping only its frequency
+                          patterns  the 8 bits of a node moved together,
+                                    keeping which attributes occur together
+                          degree    as patterns, but only between nodes of
+                                    the same degree class (floor(log2(k+1))),
+                                    also keeping how attributes go with
+                                    degree
+
+An ensemble is one of KINDS: 'rewire' (edges rewired, attributes kept),
+'shuffle' (attributes shuffled, edges kept) or 'both'.  It is held as two
+arrays, edges (R+1, m, 2) and masks (R+1, n), whose variant 0 is the
+network itself; for the criminal network a thousand variants take about
+3 MB and about two seconds to generate.
+
+run_ensemble() runs every strategy nn times on every variant over a pool
+of processes: the arrays are published once in shared memory (as in
+shared.py), tasks carry only the variant and the run parameters, and a
+worker builds the graph of a variant when it first meets it (tasks are
+handed out a variant and strategy at a time, so it rarely builds one
+twice).  Only the number of deletions of each run comes back, and
+summarise_ensemble() aggregates them per strategy: the mean on the
+network itself, the distribution of the means over the variants, the
+z-score of the former in the latter, one-sided empirical p-values, and the
+length statistics of all the null runs pooled (see runstats.py).
+
+Usage: python nullmodels.py generate R OUT.npz [--kind K] [--attributes MODE]
+                              [--swaps S] [--seed S] [--network FILE]
+       python nullmodels.py run NN [--ensemble FILE.npz | --variants R --kind K ..]
+                              [--strategies T ..] [--processes N] [--out FILE.json]
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+from multiprocessing import Pool, cpu_count, shared_memory, util
+
+import numpy as np
+
+from network import Network, load_network
+from runstats import length_stats
+from simple import (intervention_adaptation_simulation, NO_ADAPT_TARGETS,
+                    OUTPUT_FILENAME_BY_TARGET)
+
+
+KINDS = ['rewire', 'shuffle', 'both']
+ATTRIBUTE_MODES = ['bits', 'patterns', 'degree']
+
+# Swaps proposed per edge
+SWAPS = 10
+
+
+# Rewiring
+
+def _member(keys, queries):
+    """
+    Whether each of queries is in the sorted array keys.
+    """
+
+    positions = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+
+    return keys[positions] == queries
+
+
+def rewire_edges(edges, n, R, swaps=SWAPS, rng=None):
+    """
+    [variants, acceptance]: the (R, m, 2) edges of R degree-preserving
+    randomisations of the (m, 2) edges (i < j) of a network on n nodes,
+    each edge i < j and sorted as in a Network, and the fraction of the
+    proposed swaps that were made.
+    """
+
+    if rng is None:
+        rng = np.random.default_rng()
+    m = len(edges)
+    E = np.tile(np.asarray(edges, dtype=np.int64), (R, 1, 1))
+    if m < 2 or R == 0:
+        return [E.astype(np.int32), 0.0]
+    half = m // 2
+    rows = np.arange(R)[:, None]
+    # Edges of different replicates have different keys
+    offset = (np.arange(R, dtype=np.int64) * n * n)[:, None]
+    made = 0
+    rounds = 2*swaps
+    for k in range(rounds):
+        keys = np.sort((offset + E[:, :, 0]*n + E[:, :, 1]).ravel())
+        order = rng.permuted(np.tile(np.arange(m), (R, 1)), axis=1)
+        (x, y) = (order[:, :half], order[:, half:2*half])
+        (a, b) = (E[rows, x, 0], E[rows, x, 1])
+        (c0, d0) = (E[rows, y, 0], E[rows, y, 1])
+        # Either way round: (a, d), (c, b) or (a, c), (d, b)
+        flip = rng.random((R, half)) < 0.5
+        (c, d) = (np.where(flip, d0, c0), np.where(flip, c0, d0))
+        (u1, v1) = (np.minimum(a, d), np.maximum(a, d))
+        (u2, v2) = (np.minimum(c, b), np.maximum(c, b))
+        k1 = offset + u1*n + v1
+        k2 = offset + u2*n + v2
+        ok = (u1 != v1) & (u2 != v2) & ~_member(keys, k1) & ~_member(keys, k2)
+        (unique, counts) = np.unique(np.concatenate((k1[ok], k2[ok])), return_counts=True)
+        twice = unique[counts > 1]
+        if len(twice) > 0:
+            ok &= ~np.isin(k1, twice) & ~np.isin(k2, twice)
+        E[rows, x, 0] = np.where(ok, u1, a)
+        E[rows, x, 1] = np.where(ok, v1, b)
+        E[rows, y, 0] = np.where(ok, u2, c0)
+        E[rows, y, 1] = np.where(ok, v2, d0)
+        made += int(ok.sum())
+
+    keys = np.sort(E[:, :, 0]*n + E[:, :, 1], axis=1)
+    variants = np.stack((keys // n, keys % n), axis=2).astype(np.int32)
+
+    return [variants, made / float(rounds*half*R)]
+
+
+# Attribute shuffles
+
+def permute_attributes(masks, R, mode='patterns', degrees=None, rng=None):
+    """
+    The (R, n) attribute masks of R shuffles of masks (see
+    ATTRIBUTE_MODES); mode 'degree' needs the degrees of the nodes.
+    """
+
+    if rng is None:
+        rng = np.random.default_rng()
+    masks = np.asarray(masks, dtype=np.uint8)
+    n = len(masks)
+    if mode == 'bits':
+        shuffled = np.zeros((R, n), dtype=np.uint8)
+        for j in range(8):
+            bit = (masks >> j) & 1
+            shuffled |= bit[rng.permuted(np.tile(np.arange(n), (R, 1)), axis=1)] << j
+        return shuffled
+    if mode == 'patterns':
+        classes = np.zeros(n)
+    elif mode == 'degree':
+        classes = np.floor(np.log2(np.asarray(degrees) + 1))
+    else:
+        raise ValueError("Unknown attribute mode %r" % (mode,))
+
+    # Sorting class + noise orders the nodes by class, at random within a
+    # class: the k-th node of each class takes the mask of the k-th one
+    nodes = np.argsort(classes, kind='stable')
+    order = np.argsort(classes[None, :] + rng.random((R, n)), axis=1)
+    shuffled = np.empty((R, n), dtype=np.uint8)
+    shuffled[:, nodes] = masks[order]
+
+    return shuffled
+
+
+def generate_ensemble(network, R, kind='rewire', attributes='patterns', swaps=SWAPS, seed=None):
+    """
+    The ensemble of R variants of the Network network, as a dict with
+    'kind', 'attributes', 'edges' (R+1, m, 2), 'masks' (R+1, n) (variant 0
+    the network itself) and 'acceptance' (of the swaps, if rewired).
+    """
+
+    if kind not in KINDS:
+        raise ValueError("Unknown ensemble kind %r" % (kind,))
+    rng = np.random.default_rng(seed)
+    acceptance = None
+    if kind in ('rewire', 'both'):
+        (edges, acceptance) = rewire_edges(network.edges, network.n, R, swaps, rng)
+    else:
+        edges = np.tile(network.edges, (R, 1, 1))
+    if kind in ('shuffle', 'both'):
+        masks = permute_attributes(network.masks, R, attributes, network.degrees(), rng)
+    else:
+        masks = np.tile(network.masks, (R, 1))
+
+    return {'kind': kind, 'attributes': attributes, 'acceptance': acceptance,
+            'edges': np.concatenate((network.edges[None].astype(np.int32), edges)),
+            'masks': np.concatenate((network.masks[None].astype(np.uint8), masks))}
+
+
+def save_ensemble(ensemble, filename):
+    np.savez_compressed(filename, edges=ensemble['edges'], masks=ensemble['masks'],
+                        kind=ensemble['kind'], attributes=ensemble['attributes'])
+
+
+def load_ensemble(filename):
+    data = np.load(filename)
+
+    return {'kind': str(data['kind']), 'attributes': str(data['attributes']),
+            'acceptance': None, 'edges': data['edges'], 'masks': data['masks']}
+
+
+def variant(ensemble, e):
+    """
+    Variant e of the ensemble as a Network, nodes labelled 1..n.
+    """
+
+    n = ensemble['masks'].shape[1]
+
+    return Network(np.arange(1, n+1), ensemble['edges'][e], ensemble['masks'][e])
+
+
+# Running
+
+def publish_ensemble(ensemble):
+    """
+    Copy the edges and masks of the ensemble into a new block of shared
+    memory; returns [block, shapes], what workers need to attach to it.
+    The caller must close() and unlink() the block.
+    """
+
+    (edges, masks) = (ensemble['edges'], ensemble['masks'])
+    block = shared_memory.SharedMemory(create=True, size=edges.nbytes + masks.nbytes)
+    np.ndarray(edges.shape, dtype=np.int32, buffer=block.buf)[:] = edges
+    np.ndarray(masks.shape, dtype=np.uint8, buffer=block.buf, offset=edges.nbytes)[:] = masks
+
+    return [block, (edges.shape, masks.shape)]
+
+
+# The state of a worker process, set up once by init_worker()
+_worker = {}
+
+
+def init_worker(name, shapes):
+    """
+    Pool initializer: attach to the published ensemble.
+    """
+
+    (edges_shape, masks_shape) = shapes
+    block = shared_memory.SharedMemory(name=name)
+    edges = np.ndarray(edges_shape, dtype=np.int32, buffer=block.buf)
+    _worker['block'] = block
+    _worker['ensemble'] = {
+        'edges': edges,
+        'masks': np.ndarray(masks_shape, dtype=np.uint8, buffer=block.buf, offset=edges.nbytes)}
+    _worker['variant'] = None
+    util.Finalize(None, release_worker, exitpriority=10)
+
+
+def release_worker():
+    block = _worker.pop('block', None)
+    _worker.clear()
+    if block is not None:
+        block.close()
+
+
+def run_task(task):
+    """
+    One run on a variant in a worker.  task is (variant, tar, adaptation,
+    p, ignore_equipment, seed); returns [number of deletions, seconds].
+    """
+
+    (e, tar, adaptation, p, ignore_equipment, seed) = task
+    start = time.perf_counter()
+    if _worker['variant'] != e:
+        network = variant(_worker['ensemble'], e)
+        _worker['graph'] = [network.to_graph(), network.node_attributes()]
+        _worker['variant'] = e
+    (G, node_attributes) = _worker['graph']
+    random.seed(seed)
+    values = intervention_adaptation_simulation(G, node_attributes, tar, adaptation, p,
+                                                ignore_equipment)
+
+    return [len(values), time.perf_counter() - start]
+
+
+def run_ensemble(ensemble, nn, targets=None, p=0.5, ignore_equipment=0, processes=None,
+                 telemetry=None, seed=None):
+    """
+    Run each strategy in targets (all by default) nn times on every variant
+    of the ensemble.  Returns {tar: (variants, nn) array of the numbers of
+    deletions}.
+    """
+
+    if targets is None:
+        targets = range(len(OUTPUT_FILENAME_BY_TARGET))
+    targets = list(targets)
+    V = ensemble['edges'].shape[0]
+    rng = random.Random(seed)
+    tasks = [(e, tar, tar not in NO_ADAPT_TARGETS, p, ignore_equipment, rng.getrandbits(64))
+             for e in range(V) for tar in targets for i in range(nn)]
+    lengths = np.zeros((len(targets), V, nn), dtype=np.int64)
+
+    (block, shapes) = publish_ensemble(ensemble)
+    try:
+        pool = Pool(processes, initializer=init_worker, initargs=(block.name, shapes))
+        try:
+            for (k, (length, seconds)) in enumerate(pool.imap(run_task, tasks, nn)):
+                (e, t, i) = (k // (len(targets)*nn), k // nn % len(targets), k % nn)
+                lengths[t, e, i] = length
+                if telemetry is not None:
+                    telemetry.observe_run(targets[t], seconds, steps=length)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        block.close()
+        block.unlink()
+
+    return dict([(tar, lengths[t]) for (t, tar) in enumerate(targets)])
+
+
+def summarise_ensemble(lengths, rng=None):
+    """
+    The per-strategy summary of run_ensemble()'s lengths (see above):
+    {tar: {'observed', 'null_mean', 'null_sd', 'z', 'p_fewer', 'p_more',
+    'null_lengths'}}.  p_fewer is the empirical p-value of the network
+    needing as few deletions as it does, p_more of it needing as many.
+    """
+
+    summary = {}
+    for tar in sorted(lengths):
+        observed = float(lengths[tar][0].mean())
+        means = lengths[tar][1:].mean(axis=1)
+        R = len(means)
+        sd = float(means.std(ddof=1)) if R > 1 else 0.0
+        summary[tar] = {
+            'observed': observed,
+            'null_mean': float(means.mean()) if R > 0 else None,
+            'null_sd': sd,
+            'z': (observed - float(means.mean()))/sd if sd > 0 else None,
+            'p_fewer': (1 + int((means <= observed).sum()))/float(R + 1),
+            'p_more': (1 + int((means >= observed).sum()))/float(R + 1),
+            'null_lengths': length_stats(lengths[tar][1:].ravel(), rng=rng) if R > 0 else None}
+
+    return summary
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Null-model ensembles of a network')
+    parser.add_argument('command', choices=['generate', 'run'])
+    parser.add_argument('count', type=int, help='variants (generate) or runs per strategy (run)')
+    parser.add_argument('output', nargs='?', default=None, help='ensemble file (generate)')
+    parser.add_argument('--network', default='criminal.txt')
+    parser.add_argument('--ensemble', default=None)
+    parser.add_argument('--variants', type=int, default=100)
+    parser.add_argument('--kind', choices=KINDS, default='rewire')
+    parser.add_argument('--attributes', choices=ATTRIBUTE_MODES, default='patterns')
+    parser.add_argument('--swaps', type=int, default=SWAPS)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--strategies', type=int, nargs='+', default=None)
+    parser.add_argument('--p', type=float, default=0.5)
+    parser.add_argument('--ignore-equipment', action='store_true')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--out', default=None, help='write the summary as JSON')
+    args = parser.parse_args(argv[1:])
+
+    if args.command == 'run' and args.ensemble is not None:
+        ensemble = load_ensemble(args.ensemble)
+    else:
+        R = args.count if args.command == 'generate' else args.variants
+        start = time.perf_counter()
+        ensemble = generate_ensemble(load_network(args.network), R, args.kind, args.attributes,
+                                     args.swaps, args.seed)
+        print('%d %s variants in %.2f s%s'
+              % (R, args.kind, time.perf_counter() - start,
+                 '' if ensemble['acceptance'] is None
+                 else ', %.0f%% of swaps made' % (100*ensemble['acceptance'])))
+    if args.command == 'generate':
+        if args.output is None:
+            parser.error('generate needs an output file')
+        save_ensemble(ensemble, args.output)
+        return 0
+
+    from telemetry import Telemetry
+    targets = args.strategies or range(len(OUTPUT_FILENAME_BY_TARGET))
+    V = ensemble['edges'].shape[0]
+    telemetry = Telemetry('sweep.prom', total=V*len(targets)*args.count,
+                          workers=args.processes or cpu_count())
+    lengths = run_ensemble(ensemble, args.count, targets, args.p,
+                           1 if args.ignore_equipment else 0, args.processes, telemetry,
+                           args.seed)
+    telemetry.close()
+    summary = summarise_ensemble(lengths)
+
+    print('%d variants (%s), %d runs each' % (V - 1, ensemble['kind'], args.count))
+    print('%-26s %8s %8s %7s %7s %8s %8s' % ('strategy', 'network', 'null', 'sd', 'z',
+                                             'p_fewer', 'p_more'))
+    for tar in sorted(summary):
+        s = summary[tar]
+        print('%-26s %8.2f %8.2f %7.2f %7s %8.3f %8.3f'
+              % (OUTPUT_FILENAME_BY_TARGET[tar], s['observed'], s['null_mean'], s['null_sd'],
+                 '-' if s['z'] is None else '%.2f' % s['z'], s['p_fewer'], s['p_more']))
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({'kind': ensemble['kind'], 'attributes': ensemble['attributes'],
+                       'variants': V - 1, 'runs': args.count,
+                       'strategies': dict([(OUTPUT_FILENAME_BY_TARGET[tar], summary[tar])
+                                           for tar in summary])}, f, indent=1)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in instrumentation for the simulation loop.
+
+A Profiler handed to intervention_adaptation_simulation() (or
+simulation_steps()) records the wall time and number of calls of each
+phase of a step, separately for each targeting strategy:
+
+  targeting    choosing the node to delete
+  copy         copying the graph into Gprev
+  components   finding the components after the deletion
+  adaptation   letting deficient components adapt
+  pruning      removing components that lack attributes
+  metrics      the centralisations, nCC and Cmax recorded for the step
+
+together with counters such as the number of components examined for
+adaptation, adaptation attempts, edges added and cutsets computed.
+
+Without a profiler the loop uses NULL_PROFILER, whose methods do nothing,
+so the instrumentation costs next to nothing when it is switched off.
+
+summary() gives a plain text table, dump()/save() a JSON-able record
+that diff_dumps() compares between two versions of the code.
+
+Usage: python profiling.py [nn] [output.json]
+       python profiling.py --diff old.json new.json
+"""
+
+import sys
+import json
+import time
+import random
+
+
+class _Phase(object):
+    """
+    Context manager timing one phase for a Profiler.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        key = (self.profiler.strategy, self.name)
+        entry = self.profiler.times.get(key)
+        if entry is None:
+            entry = self.profiler.times[key] = [0.0, 0]
+        entry[0] += time.perf_counter() - self.start
+        entry[1] += 1
+        return False
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Profiler(object):
+    """
+    Wall time and call counts per (strategy, phase), and counters per
+    (strategy, name).
+    """
+
+    enabled = True
+    # Set by a profiler enforcing a memory budget (see memory.py) to have
+    # the run switch to cheaper, approximate measures
+    degraded = False
+
+    def __init__(self):
+        self.strategy = None
+        self.times = {}
+        self.counters = {}
+
+    def set_strategy(self, tar):
+        """
+        Attribute what follows to the targeting strategy tar.
+        """
+
+        self.strategy = tar
+
+    def begin_run(self):
+        """
+        A new run starts (of the strategy last set).
+        """
+
+        pass
+
+    def phase(self, name):
+        """
+        A context manager timing the phase name:
+            with profiler.phase('targeting'):
+                ...
+        """
+
+        return _Phase(self, name)
+
+    def count(self, name, k=1):
+        key = (self.strategy, name)
+        self.counters[key] = self.counters.get(key, 0) + k
+
+    def dump(self):
+        """
+        The measurements as a JSON-able dict:
+        {'times': {strategy: {phase: [seconds, calls]}},
+         'counters': {strategy: {name: count}}}
+        Strategies are given as strings, since JSON keys must be.
+        """
+
+        result = {'times': {}, 'counters': {}}
+        for ((tar, name), entry) in self.times.items():
+            result['times'].setdefault(str(tar), {})[name] = list(entry)
+        for ((tar, name), count) in self.counters.items():
+            result['counters'].setdefault(str(tar), {})[name] = count
+
+        return result
+
+    def save(self, filename):
+        f = open(filename, 'w')
+        json.dump(self.dump(), f, indent=1, sort_keys=True)
+        f.close()
+
+    def summary(self):
+        return format_dump(self.dump())
+
+
+class NullProfiler(object):
+    """
+    A profiler that records nothing.
+    """
+
+    enabled = False
+    strategy = None
+    degraded = False
+
+    def set_strategy(self, tar):
+        pass
+
+    def begin_run(self):
+        pass
+
+    def phase(self, name):
+        return NULL_PHASE
+
+    def count(self, name, k=1):
+        pass
+
+
+NULL_PHASE = _NullPhase()
+NULL_PROFILER = NullProfiler()
+
+
+def _strategy_order(key):
+    # Numeric strategies first, in order
+    return (0, int(key), '') if key.lstrip('-').isdigit() else (1, 0, key)
+
+
+def format_dump(dump):
+    """
+    A plain text table of a dump: per strategy, each phase with its total
+    time, number of calls, time per call and share of the strategy's time,
+    followed by the counters.
+    """
+
+    lines = []
+    for tar in sorted(dump['times'].keys(), key=_strategy_order):
+        phases = dump['times'][tar]
+        total = sum([entry[0] for entry in phases.values()])
+        lines.append('Strategy %s: %.3f s' % (tar, total))
+        lines.append('  %-12s %10s %9s %12s %7s' % ('phase', 'seconds', 'calls',
+                                                    'ms/call', 'share'))
+        for name in sorted(phases.keys(), key=lambda name: -phases[name][0]):
+            (seconds, calls) = phases[name]
+            lines.append('  %-12s %10.3f %9d %12.4f %6.1f%%' % (
+                name, seconds, calls, 1000.0*seconds/max(calls, 1),
+                100.0*seconds/total if total > 0 else 0))
+        counters = dump['counters'].get(tar, {})
+        for name in sorted(counters.keys()):
+            lines.append('  %-24s %10d' % (name, counters[name]))
+
+    return '\n'.join(lines)
+
+
+def diff_dumps(old, new):
+    """
+    A plain text comparison of two dumps: seconds per call of each phase
+    before and after, and the relative change.
+    """
+
+    lines = ['%-8s %-12s %12s %12s %8s' % ('strategy', 'phase', 'old ms/call',
+                                          'new ms/call', 'change')]
+    strategies = set(old['times'].keys()) | set(new['times'].keys())
+    for tar in sorted(strategies, key=_strategy_order):
+        phases = set(old['times'].get(tar, {}).keys()) | set(new['times'].get(tar, {}).keys())
+        for name in sorted(phases):
+            per_call = []
+            for dump in [old, new]:
+                entry = dump['times'].get(tar, {}).get(name)
+                per_call.append(None if entry is None else 1000.0*entry[0]/max(entry[1], 1))
+            if None in per_call:
+                change = '-'
+            elif per_call[0] > 0:
+                change = '%+.1f%%' % (100.0*(per_call[1] - per_call[0])/per_call[0])
+            else:
+                change = '-'
+            lines.append('%-8s %-12s %12s %12s %8s' % (
+                tar, name,
+                '-' if per_call[0] is None else '%.4f' % per_call[0],
+                '-' if per_call[1] is None else '%.4f' % per_call[1],
+                change))
+
+    return '\n'.join(lines)
+
+
+def main(argv):
+    if len(argv) == 4 and argv[1] == '--diff':
+        dumps = []
+        for filename in argv[2:4]:
+            f = open(filename, 'r')
+            dumps.append(json.load(f))
+            f.close()
+        print(diff_dumps(dumps[0], dumps[1]))
+        return 0
+
+    from simple import (initialise_network, intervention_adaptation_simulation,
+                        NO_ADAPT_TARGETS, OUTPUT_FILENAME_BY_TARGET)
+
+    nn = int(argv[1]) if len(argv) > 1 else 5
+    output = argv[2] if len(argv) > 2 else 'profile.json'
+
+    (G, node_attributes) = initialise_network('criminal.txt')
+    random.seed(1)
+    profiler = Profiler()
+    for tar in range(len(OUTPUT_FILENAME_BY_TARGET)):
+        for i in range(nn):
+            intervention_adaptation_simulation(
+                G, node_attributes, tar, tar not in NO_ADAPT_TARGETS, 0.5, 0,
+                profiler=profiler)
+    print(profiler.summary())
+    profiler.save(output)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
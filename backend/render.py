@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The plotting stage of all_simulations-20160711.py, on its own.
+
+The simulation stage saves what the plots are made of (the average step
+measures, the frequencies of the run lengths and the run lengths of each
+strategy) with save_aggregates(); render_figures() then draws every
+figure from that file, on a pool of processes using matplotlib's headless
+Agg backend.  Only the render workers import matplotlib, so simulation
+processes never pay for it.
+
+Each figure is described by a spec (see figure_specs()): its kind, the
+data it plots and its styling.  The hash of the spec is recorded in a
+manifest next to the figures, and a figure whose spec has not changed
+since it was last drawn is skipped, so changing the style of one strategy
+in TARFMT redraws only the figures that strategy appears in.
+
+Usage: python render.py [aggregates.json] [output_dir] [processes] [--force]
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+from multiprocessing import Pool
+
+import numpy as np
+
+
+# Bump when the drawing code changes, so that every figure is redrawn
+RENDER_VERSION = 2
+
+DPI = 300
+
+MANIFEST = 'render_manifest.json'
+
+OUTPUT_FILENAME_BY_MEASURE = ['DegreeCentralities', 'BetweennessCentralities',
+                              'ConnectedComponents', 'MaximalComponentSize']
+
+Y_AXIS_LABEL = ['Degree centralization', 'Betweenness centralization',
+                'Number of components', 'Maximal component size']
+
+# (colour, line style) of each strategy in the comparison plots
+TARFMT = [('black', 'solid'), ('gray', 'solid'), ('black', 'dotted'),
+          ('black', 'dashed'), ('black', 'solid'), ('gray', 'dashed'),
+          ('green', 'dashed'), ('black', 'dashed'), ('gray', 'dashed'),
+          ('red', 'dashed'), ('blue', 'dashed'), ('cyan', 'dashed'),
+          ('orange', 'dashed'), ('black', 'dashed')]
+
+# New colour scheme in shades of gray.
+#
+#  (0) black        -- cutset targeting
+#  (1) gray         -- degree targeting
+#  (2) black dotted -- betweenness targeting
+#  (3) black dashed -- money targeting
+#  (4) N/A          -- random targeting (No longer plotted)
+#  (5) grey  dashed -- precursor targeting
+#  (6) N/A          -- degree targeting without adaptation  (No longer plotted)
+#  (7) black dashed -- cutset targeting until fewer than 50% of vertices remaining; then max degree targeting
+#  (8) grey  dashed -- cutset targeting until fewer than 50% of vertices remaining; then max betweenness targeting
+#  (9) N/A          -- betweenness targeting without adaptation  (No longer plotted)
+# (10) N/A          -- cutset targeting without adaptation    (No longer plotted)
+# (11) N/A          -- money targeting without adaptation     (No longer plotted)
+# (12) N/A          -- precursor targeting without adaptation (No longer plotted)
+# (13) N/A          -- random targeting without adaptation    (No longer plotted)
+#
+# First  plot targets: [0,1,2,3,5]
+# Second plot targets: [0,1,2,7,8]
+
+# The comparison plots: file name suffix and strategies
+COMPARISONS = [('_main_strategies_with_adapt', [0, 1, 2, 3, 5]),
+               ('_structural_and_hybrids_only', [0, 1, 2, 7, 8])]
+
+# The measures compared (indices into the average step measures)
+COMPARED_MEASURES = [0, 2, 3]
+
+# The strategies whose extent sets the x axis of the comparison plots (no
+# random, only with adaptation)
+X_AXIS_TARGETS = [0, 1, 2, 3, 5, 7, 8]
+
+
+def save_aggregates(filename, names, SSav, Sfreq, lengths, bands=None):
+    """
+    Save the aggregates of a sweep for render_figures(): for each strategy
+    tar, its name, SSav[tar] (the average measures at each step), Sfreq[tar]
+    (the number of runs of each length) and lengths[tar] (the length of each
+    run), and if given bands[tar], the [low, high] confidence band of
+    SSav[tar] (see runstats.step_stats()), shaded around the curves.
+    """
+
+    targets = []
+    for tar in range(len(names)):
+        target = {'tar': tar, 'name': names[tar], 'averages': SSav[tar],
+                  'frequencies': Sfreq[tar], 'lengths': lengths[tar]}
+        if bands is not None:
+            target['band'] = bands[tar]
+        targets.append(target)
+    with open(filename, 'w') as f:
+        json.dump({'targets': targets}, f)
+
+
+def load_aggregates(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)['targets']
+
+
+def measure_band(target, outputtype):
+    """
+    [low, high] of the confidence band of one measure of target, or None if
+    the aggregates have no band for it.
+    """
+
+    if 'band' not in target:
+        return None
+
+    return [[s[outputtype] for s in side] for side in target['band']]
+
+
+def figure_specs(targets):
+    """
+    The specs of all the figures drawn from the aggregates targets.
+    """
+
+    specs = []
+    for target in targets:
+        specs.append({'kind': 'histogram',
+                      'filename': target['name'] + '_vertex_del_freq.png',
+                      'frequencies': target['frequencies'],
+                      'nmin': min(target['lengths']),
+                      'median': float(np.median(target['lengths'])),
+                      'mean': float(np.mean(target['lengths'])),
+                      'narrow': target['tar'] in (4, 13)})
+
+    nmax = max([len(targets[tar]['averages']) for tar in X_AXIS_TARGETS if tar < len(targets)])
+    for outputtype in COMPARED_MEASURES:
+        top = max([max([s[outputtype] for s in target['averages']] + [0]) for target in targets]) + 0.05
+        for (suffix, tars) in COMPARISONS:
+            specs.append({'kind': 'comparison',
+                          'filename': OUTPUT_FILENAME_BY_MEASURE[outputtype] + suffix + '.png',
+                          'curves': [[[s[outputtype] for s in targets[tar]['averages']]]
+                                     + list(TARFMT[tar])
+                                     + [measure_band(targets[tar], outputtype)]
+                                     for tar in tars],
+                          'axis': [-1, nmax + 1, 0, top],
+                          'ylabel': Y_AXIS_LABEL[outputtype]})
+
+    return specs
+
+
+def spec_hash(spec):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([RENDER_VERSION, DPI, spec], sort_keys=True).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def _pyplot():
+    # Imported here, so that only the processes that draw load matplotlib
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def _save(plt, fig, filename):
+    plt.savefig(filename, dpi=DPI, facecolor='w', edgecolor='w',
+                orientation='portrait', format='png', transparent=False,
+                bbox_inches=None, pad_inches=0.1)
+    plt.close(fig)
+
+
+def draw_histogram(plt, spec, filename):
+    """
+    The frequencies of the run lengths of one strategy, with the median
+    (solid) and mean (dashed) lengths.
+    """
+
+    Sfreq = spec['frequencies']
+    nmin = spec['nmin']
+    nmax = len(Sfreq) - 1
+    fig, ax = plt.subplots()
+    Xrange = [j for j in range(nmin, nmax+1)]
+    XrangeWidth = max(Xrange) - min(Xrange) + 1
+    BarWidth = 0.05 * XrangeWidth
+    if spec['narrow']:
+        BarWidth = BarWidth/10
+    ax.axis([nmin-1, nmax+1, 0, max(Sfreq)+1])
+    ax.bar(Xrange, [Sfreq[i] for i in Xrange], width=BarWidth, color='b', align='center')
+    ax.axvline(spec['median'], color='r', linewidth=2)
+    ax.axvline(spec['mean'], color='c', linestyle='dashed', linewidth=2)
+    ax.set_xlabel('Number of deletion steps until network disruption')
+    _save(plt, fig, filename)
+
+
+def draw_comparison(plt, spec, filename):
+    """
+    The average of one measure at each step, for several strategies, with
+    its confidence band.
+    """
+
+    fig, ax1 = plt.subplots()
+    for (values, colour, linestyle, band) in spec['curves']:
+        ax1.plot([i for i in range(1, len(values)+1)], values, color=colour,
+                 linestyle=linestyle, alpha=0.8)
+        # The confidence band of the average, if the aggregates have it
+        if band is not None:
+            (low, high) = band
+            ax1.fill_between([i for i in range(1, len(low)+1)], low, high,
+                             color=colour, alpha=0.12, linewidth=0)
+    ax1.axis(spec['axis'])
+    ax1.set_xlabel('Number of steps')
+    ax1.set_ylabel(spec['ylabel'])
+    _save(plt, fig, filename)
+
+
+DRAW = {'histogram': draw_histogram, 'comparison': draw_comparison}
+
+
+def render_task(task):
+    (spec, directory) = task
+    filename = os.path.join(directory, spec['filename'])
+    DRAW[spec['kind']](_pyplot(), spec, filename)
+
+    return spec['filename']
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def render_figures(aggregates_file, directory='.', processes=None, force=False):
+    """
+    Draw the figures of the aggregates in aggregates_file into directory,
+    skipping those whose spec is unchanged since they were last drawn
+    (unless force).  Returns [drawn, skipped], lists of file names.
+    """
+
+    specs = figure_specs(load_aggregates(aggregates_file))
+    manifest = read_manifest(directory)
+    hashes = dict([(spec['filename'], spec_hash(spec)) for spec in specs])
+    todo = [spec for spec in specs
+            if force or manifest.get(spec['filename']) != hashes[spec['filename']]
+            or not os.path.exists(os.path.join(directory, spec['filename']))]
+    skipped = [spec['filename'] for spec in specs if spec not in todo]
+    drawn = []
+    if todo != []:
+        pool = Pool(min(processes or os.cpu_count(), len(todo)))
+        try:
+            for filename in pool.imap_unordered(render_task, [(spec, directory) for spec in todo]):
+                drawn.append(filename)
+                manifest[filename] = hashes[filename]
+                write_manifest(directory, manifest)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [drawn, skipped]
+
+
+def main(argv):
+    args = [a for a in argv[1:] if a != '--force']
+    aggregates_file = args[0] if len(args) > 0 else 'aggregates.json'
+    directory = args[1] if len(args) > 1 else '.'
+    processes = int(args[2]) if len(args) > 2 else None
+
+    start = time.perf_counter()
+    (drawn, skipped) = render_figures(aggregates_file, directory, processes,
+                                      '--force' in argv)
+    print('%d figures drawn, %d unchanged, in %.2f s'
+          % (len(drawn), len(skipped), time.perf_counter() - start))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Sequential stopping for the targeting simulations.
+
+main() in simple.py runs a fixed nn = 100 simulations for every targeting
+strategy.  The deterministic no-adapt strategies have settled after a
+handful of runs, while the random strategies (4 and 13) are still noisy
+after 100.  Here we keep scheduling runs for a strategy until the
+confidence interval for its mean number of deletion steps (and, if asked
+for, the per-step means of the recorded measures) is narrower than a
+target half-width, or until the overall run budget is spent.
+
+Each round, the strategy whose interval is furthest from its target gets
+the next batch of runs, so the compute goes where it is needed.  The
+report states the precision that was actually reached for every strategy.
+"""
+
+import sys
+import math
+import random
+from statistics import NormalDist
+
+from simple import (initialise_network, intervention_adaptation_simulation,
+                    OUTPUT_FILENAME_BY_TARGET, NO_ADAPT_TARGETS)
+
+
+# Number of measures recorded per step: betweenness centralisation,
+# degree centralisation, number of components, maximal component size
+NMEASURES = 4
+
+
+def t_quantile(q, df):
+    """
+    Approximate q-quantile of Student's t distribution with df degrees of
+    freedom, from the normal quantile by the Cornish-Fisher expansion
+    [Abramowitz & Stegun 26.7.5].  Good to a few parts in a thousand for
+    df >= 3, which is all we need for a stopping rule.
+    """
+
+    z = NormalDist().inv_cdf(q)
+    g1 = (z**3 + z)/4.0
+    g2 = (5*z**5 + 16*z**3 + 3*z)/96.0
+    g3 = (3*z**7 + 19*z**5 + 17*z**3 - 15*z)/384.0
+    g4 = (79*z**9 + 776*z**7 + 1482*z**5 - 1920*z**3 - 945*z)/92160.0
+
+    return z + g1/df + g2/df**2 + g3/df**3 + g4/df**4
+
+
+def mean_half_width(values, confidence):
+    """
+    Return [mean, half-width] of the two-sided confidence interval for the
+    mean of the list values.  With fewer than two values the half-width is
+    infinite.
+    """
+
+    nv = len(values)
+    mean = sum(values)*1.0/nv
+    if nv < 2:
+        return [mean, float('inf')]
+    var = sum([(x - mean)**2 for x in values])/(nv - 1.0)
+
+    return [mean, t_quantile(0.5 + confidence/2.0, nv - 1)*math.sqrt(var/nv)]
+
+
+def step_half_widths(runs, confidence):
+    """
+    Half-widths of the confidence intervals for the per-step means of each
+    measure, as [[hw_bc, hw_dc, hw_nCC, hw_Cmax] for each step].
+
+    Runs are padded with zeros up to the longest run, exactly as main()
+    in all_simulations-20160711.py does before averaging.
+    """
+
+    nmax = max([len(S) for S in runs])
+    widths = []
+    for j in range(nmax):
+        row = []
+        for k in range(1, NMEASURES+1):
+            column = [S[j][k] if j < len(S) else 0 for S in runs]
+            row.append(mean_half_width(column, confidence)[1])
+        widths.append(row)
+
+    return widths
+
+
+def precision(runs, confidence, step_width):
+    """
+    Summarise the precision reached by a list of runs of one strategy.
+
+    Returns a dict with the mean number of deletion steps, the half-width
+    of its confidence interval and, if step_width is not None, the largest
+    ratio of per-step half-width to step_width over all steps and measures.
+    """
+
+    (mean, hw) = mean_half_width([len(S) for S in runs], confidence)
+    result = {'runs': len(runs), 'mean': mean, 'half_width': hw,
+              'step_ratio': None}
+    if step_width is not None:
+        widths = step_half_widths(runs, confidence)
+        result['step_ratio'] = max([widths[j][k]/step_width[k]
+                                    for j in range(len(widths))
+                                    for k in range(NMEASURES)])
+
+    return result
+
+
+def sequential_sweep(G, node_attributes, targets, p=0.5, ignore_equipment=0,
+                     half_width=0.5, step_width=None, confidence=0.95,
+                     min_runs=10, max_runs=None, budget=1400, batch=5):
+    """
+    Run the targeting strategies in targets until each has reached the
+    requested precision, or until budget runs have been done altogether.
+
+    half_width is the target half-width (in deletion steps) of the
+    confidence interval for the mean number of deletion steps.
+    step_width, if given, is the target half-width for the per-step means:
+    either one number for all four measures or a list of four.
+    Every strategy gets min_runs runs first; after that the strategy
+    furthest from its target receives the next batch runs.  No strategy
+    receives more than max_runs runs.
+
+    Returns a dict mapping each target to a dict holding its list of runs
+    under 'data', the precision summary from precision(), and 'converged'.
+    """
+
+    if step_width is not None and not isinstance(step_width, (list, tuple)):
+        step_width = [step_width]*NMEASURES
+    if max_runs is None:
+        max_runs = budget
+
+    def shortfall(summary):
+        # How many times too wide is the widest interval for this strategy?
+        ratio = summary['half_width']/half_width if half_width > 0 else float('inf')
+        if summary['step_ratio'] is not None:
+            ratio = max(ratio, summary['step_ratio'])
+        return ratio
+
+    results = {}
+    used = 0
+    for tar in targets:
+        results[tar] = {'data': []}
+    for tar in targets:
+        nrun = min(min_runs, max_runs, budget - used)
+        for i in range(nrun):
+            results[tar]['data'].append(intervention_adaptation_simulation(
+                G, node_attributes, tar, tar not in NO_ADAPT_TARGETS, p,
+                ignore_equipment))
+        used += nrun
+
+    while True:
+        worst = None
+        for tar in targets:
+            if results[tar]['data'] == []:
+                continue
+            summary = precision(results[tar]['data'], confidence, step_width)
+            results[tar].update(summary)
+            results[tar]['converged'] = shortfall(summary) <= 1
+            if (not results[tar]['converged']) and summary['runs'] < max_runs:
+                if worst is None or shortfall(summary) > shortfall(results[worst]):
+                    worst = tar
+        if worst is None or used >= budget:
+            break
+        nrun = min(batch, max_runs - results[worst]['runs'], budget - used)
+        for i in range(nrun):
+            results[worst]['data'].append(intervention_adaptation_simulation(
+                G, node_attributes, worst, worst not in NO_ADAPT_TARGETS, p,
+                ignore_equipment))
+        used += nrun
+
+    return results
+
+
+def format_report(results, confidence):
+    """
+    A plain text table of the precision reached by sequential_sweep().
+    """
+
+    lines = ['%-26s %6s %10s %12s %10s %s' % ('Strategy', 'runs', 'mean',
+                                               '+/-', 'step ratio', '')]
+    for tar in sorted(results.keys()):
+        r = results[tar]
+        if r['data'] == []:
+            lines.append('%-26s %6d' % (OUTPUT_FILENAME_BY_TARGET[tar], 0))
+            continue
+        step = '-' if r['step_ratio'] is None else '%.3f' % r['step_ratio']
+        lines.append('%-26s %6d %10.3f %12.3f %10s %s' % (
+            OUTPUT_FILENAME_BY_TARGET[tar], r['runs'], r['mean'],
+            r['half_width'], step,
+            'converged' if r['converged'] else 'NOT converged'))
+    lines.append('Confidence level %g' % confidence)
+
+    return '\n'.join(lines)
+
+
+def main():
+    (G, node_attributes) = initialise_network('criminal.txt')
+    ntarget = len(OUTPUT_FILENAME_BY_TARGET)
+    confidence = 0.95
+
+    random.seed()
+
+    results = sequential_sweep(G, node_attributes, range(ntarget),
+                               confidence=confidence, half_width=0.5,
+                               budget=100*ntarget)
+    print(format_report(results, confidence))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A local simulation service for the criminal_networks app.
+
+Jobs (a network, the strategies to run, the number of runs of each, p and
+ignore_equipment) are posted over HTTP and queued.  One pool of worker
+processes serves all jobs: the dispatcher keeps it busy with single runs,
+taking them from the queued jobs in turn, so several users can share the
+box and a small job is not stuck behind a large one.  As runs come back,
+each job keeps partial aggregates for every strategy (the number of runs
+done, the run lengths, the per-step averages of the recorded measures and
+how often each node was deleted), and these are streamed to the browser
+as server-sent events, so results appear as they converge.
+
+API (JSON throughout):
+
+  GET    /api/networks           the network files that can be simulated
+  GET    /api/strategies         [{tar, name, adapt}, ..]
+  POST   /api/jobs               {network, strategies, runs, p,
+                                  ignore_equipment} -> {id}
+  GET    /api/jobs               all jobs, without aggregates (finished
+                                 jobs are kept FINISHED_TIMEOUT seconds,
+                                 and at most MAX_FINISHED_JOBS of them)
+  GET    /api/jobs/ID            one job with its aggregates
+  DELETE /api/jobs/ID            cancel a job
+  GET    /api/jobs/ID/events     text/event-stream of 'progress' events
+                                 (the job with its aggregates) ending with
+                                 a 'done' event
+
+  POST   /api/sessions           {network, p, ignore_equipment, seed}
+                                 -> {id, graph, metrics}
+  GET    /api/sessions/ID        {graph, metrics}
+  POST   /api/sessions/ID        {command: 'delete', node: id} or
+                                 {command: 'step', strategy: tar} -> delta
+  DELETE /api/sessions/ID        close the session
+
+Sessions (see session.py) are interactive explorations of a network: each
+command deletes one node, applies adaptation and pruning, and answers
+with what changed and the updated metrics.
+
+Usage: python server.py [--port 8000] [--workers N] [--networks DIR]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from network import load_network
+from snapshot import MAGIC
+from session import SessionStore, SessionError
+from simple import intervention_adaptation_simulation, STRATEGIES
+
+
+# Number of measures recorded per step: betweenness centralisation,
+# degree centralisation, number of components, maximal component size
+NMEASURES = 4
+
+# Largest number of runs a job may ask for, per strategy
+MAX_RUNS = 10000
+
+# Shortest interval between progress events of a job, in seconds
+EVENT_INTERVAL = 0.5
+
+# Finished jobs are dropped, with their aggregates, this long (in seconds)
+# after they finish, or sooner when more than MAX_FINISHED_JOBS have
+# finished
+FINISHED_TIMEOUT = 3600
+MAX_FINISHED_JOBS = 100
+
+
+# The networks loaded by a worker process, by filename: [file_key(),
+# graph, node attributes]
+_networks = {}
+
+
+def file_key(path):
+    """
+    (path, modification time, size): a file edited or replaced in place gets
+    a new key.
+    """
+
+    st = os.stat(path)
+
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+def run_one(filename, tar, p, ignore_equipment, seed):
+    """
+    One run in a worker process: the list of step records of
+    intervention_adaptation_simulation().  The network is loaded again
+    if its file has changed since it was last loaded.
+    """
+
+    key = file_key(filename)
+    if filename not in _networks or _networks[filename][0] != key:
+        network = load_network(filename)
+        _networks[filename] = [key, network.to_graph(), network.node_attributes()]
+    (key, G, node_attributes) = _networks[filename]
+    random.seed(seed)
+
+    return intervention_adaptation_simulation(G, node_attributes, tar, None,
+                                              p, ignore_equipment)
+
+
+def is_network_file(path):
+    """
+    Whether path holds a network that loads: JSON as criminal.txt, or a
+    snapshot.
+    """
+
+    f = open(path, 'rb')
+    start = f.read(len(MAGIC)).lstrip()
+    f.close()
+    if not (start.startswith(b'{') or start == MAGIC):
+        return False
+    try:
+        load_network(path)
+    except (ValueError, KeyError, TypeError, OSError):
+        return False
+
+    return True
+
+
+class Aggregate(object):
+    """
+    Partial results of one strategy in a job.
+    """
+
+    def __init__(self, tar, runs):
+        self.tar = tar
+        self.runs = runs
+        self.done = 0
+        self.lengths = {}
+        self.sums = []
+        self.counts = []
+        self.deleted = {}
+
+    def add(self, values):
+        self.done += 1
+        self.lengths[len(values)] = self.lengths.get(len(values), 0) + 1
+        for (k, step) in enumerate(values):
+            if k == len(self.sums):
+                self.sums.append([0.0]*NMEASURES)
+                self.counts.append(0)
+            self.counts[k] += 1
+            for j in range(NMEASURES):
+                self.sums[k][j] += step[j+1]
+            self.deleted[step[0]] = self.deleted.get(step[0], 0) + 1
+
+    def summary(self):
+        total = sum([length*count for (length, count) in self.lengths.items()])
+        return {'tar': self.tar, 'name': STRATEGIES[self.tar].name,
+                'runs': self.runs, 'done': self.done,
+                'mean_length': float(total)/self.done if self.done > 0 else None,
+                'lengths': dict([(str(k), v) for (k, v) in self.lengths.items()]),
+                'step_averages': [[s/c for s in sums] for (sums, c) in zip(self.sums, self.counts)],
+                'step_counts': self.counts,
+                'deleted': dict([(str(k), v) for (k, v) in self.deleted.items()])}
+
+
+class Job(object):
+    """
+    A queued simulation job and its partial aggregates.
+    """
+
+    def __init__(self, id, network, strategies, runs, p, ignore_equipment):
+        self.id = id
+        self.network = network
+        self.strategies = strategies
+        self.runs = runs
+        self.p = p
+        self.ignore_equipment = ignore_equipment
+        self.state = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.ended = None
+        self.aggregates = dict([(tar, Aggregate(tar, runs)) for tar in strategies])
+        self.pending = deque([(tar, i) for i in range(runs) for tar in strategies])
+        self.in_flight = 0
+        self.seeds = random.Random()
+        self.version = 0
+        self.changed = threading.Condition()
+
+    def finished(self):
+        return self.state in ('done', 'cancelled', 'failed')
+
+    def describe(self, aggregates=False):
+        result = {'id': self.id, 'network': self.network, 'strategies': self.strategies,
+                  'runs': self.runs, 'p': self.p, 'ignore_equipment': self.ignore_equipment,
+                  'state': self.state, 'error': self.error, 'created': self.created,
+                  'done': sum([a.done for a in self.aggregates.values()]),
+                  'total': self.runs*len(self.strategies)}
+        if aggregates:
+            result['aggregates'] = [self.aggregates[tar].summary() for tar in self.strategies]
+
+        return result
+
+    def notify(self):
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
+
+class JobQueue(object):
+    """
+    The jobs of the service, and the dispatcher feeding their runs to one
+    process pool, a job at a time in turn.  waiting holds the jobs with
+    runs pending, in the order of their turns, and finished the finished
+    jobs in the order they finished, until they expire.
+    """
+
+    def __init__(self, workers, networks_dir, timeout=FINISHED_TIMEOUT,
+                 max_finished=MAX_FINISHED_JOBS):
+        self.workers = workers
+        self.networks_dir = networks_dir
+        self.timeout = timeout
+        self.max_finished = max_finished
+        self.pool = ProcessPoolExecutor(workers)
+        self.jobs = {}
+        self.order = []
+        self.valid = {}
+        self.waiting = deque()
+        self.finished = deque()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.in_flight = 0
+        self.thread = threading.Thread(target=self.dispatch, daemon=True)
+        self.thread.start()
+
+    def networks(self):
+        """
+        The network files (JSON as criminal.txt, or snapshots) in the
+        networks directory.  Other JSON files (profiles, aggregates,
+        manifests) are left out: a file is only offered if it loads as a
+        network, which is checked once per version of the file (see
+        file_key()).  The files are loaded without the lock held.
+        """
+
+        with self.lock:
+            known = self.valid
+        names = []
+        valid = {}
+        for name in sorted(os.listdir(self.networks_dir)):
+            path = os.path.join(self.networks_dir, name)
+            if not os.path.isfile(path):
+                continue
+            key = file_key(path)
+            valid[key] = known[key] if key in known else is_network_file(path)
+            if valid[key]:
+                names.append(name)
+        with self.lock:
+            # Forget the files since removed or changed
+            self.valid = valid
+
+        return names
+
+    def submit(self, spec):
+        """
+        Queue a job from its JSON spec; returns the Job.  Raises ValueError
+        if the spec is not valid.
+        """
+
+        network = spec.get('network', 'criminal.txt')
+        if network not in self.networks():
+            raise ValueError("Unknown network %r" % network)
+        strategies = spec.get('strategies', sorted(STRATEGIES))
+        if (not isinstance(strategies, list) or strategies == []
+                or any([type(tar) is not int or tar not in STRATEGIES for tar in strategies])
+                or len(set(strategies)) < len(strategies)):
+            raise ValueError("strategies must be a list of %s" % sorted(STRATEGIES))
+        runs = spec.get('runs', 100)
+        if type(runs) is not int or not 1 <= runs <= MAX_RUNS:
+            raise ValueError("runs must be an integer from 1 to %d" % MAX_RUNS)
+        p = spec.get('p', 0.5)
+        if type(p) not in (int, float) or not 0 <= p <= 1:
+            raise ValueError("p must be between 0 and 1")
+        ignore_equipment = spec.get('ignore_equipment', 0)
+        if ignore_equipment not in (0, 1):
+            raise ValueError("ignore_equipment must be 0 or 1")
+
+        with self.lock:
+            job = Job(next(self.ids), network, list(strategies), runs, float(p),
+                      int(ignore_equipment))
+            self.expire()
+            self.jobs[job.id] = job
+            self.order.append(job)
+            self.waiting.append(job)
+            self.wakeup.notify()
+
+        return job
+
+    def get(self, id):
+        with self.lock:
+            self.expire()
+            return self.jobs[id]
+
+    def describe_all(self):
+        with self.lock:
+            self.expire()
+            return [job.describe() for job in self.order]
+
+    def cancel(self, job):
+        with self.lock:
+            if not job.finished():
+                self.finish(job, 'cancelled')
+        job.notify()
+
+    def finish(self, job, state):
+        # Called with the lock held
+        job.state = state
+        job.ended = time.time()
+        job.pending.clear()
+        if job in self.waiting:
+            self.waiting.remove(job)
+        self.finished.append(job)
+        self.expire()
+
+    def expire(self):
+        # Called with the lock held
+        now = time.time()
+        while self.finished and (len(self.finished) > self.max_finished
+                                 or now - self.finished[0].ended > self.timeout):
+            job = self.finished.popleft()
+            del self.jobs[job.id]
+            self.order.remove(job)
+
+    def next_run(self):
+        """
+        The next (job, tar) to run, taking the jobs with runs pending in
+        turn, or None.  Called with the lock held.
+        """
+
+        if not self.waiting:
+            return None
+        job = self.waiting.popleft()
+        tar = job.pending.popleft()[0]
+        if job.pending:
+            self.waiting.append(job)
+
+        return (job, tar)
+
+    def dispatch(self):
+        while True:
+            with self.lock:
+                while self.in_flight >= 2*self.workers or not self.waiting:
+                    self.wakeup.wait()
+                (job, tar) = self.next_run()
+                job.state = 'running'
+                job.in_flight += 1
+                self.in_flight += 1
+                seed = job.seeds.getrandbits(64)
+            future = self.pool.submit(run_one, os.path.join(self.networks_dir, job.network),
+                                      tar, job.p, job.ignore_equipment, seed)
+            future.add_done_callback(lambda future, job=job, tar=tar: self.collect(job, tar, future))
+
+    def collect(self, job, tar, future):
+        with self.lock:
+            self.in_flight -= 1
+            job.in_flight -= 1
+            if job.finished():
+                pass
+            elif future.exception() is not None:
+                job.error = repr(future.exception())
+                self.finish(job, 'failed')
+            else:
+                job.aggregates[tar].add(future.result())
+                if len(job.pending) == 0 and job.in_flight == 0:
+                    self.finish(job, 'done')
+            self.wakeup.notify()
+        job.notify()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    queue = None
+    sessions = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def job(self, parts):
+        try:
+            return self.queue.get(int(parts[2]))
+        except (ValueError, KeyError):
+            self.send_json({'error': 'no such job'}, 404)
+            return None
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['api', 'networks']:
+            return self.send_json(self.queue.networks())
+        if parts == ['api', 'strategies']:
+            return self.send_json([{'tar': tar, 'name': STRATEGIES[tar].name,
+                                    'adapt': STRATEGIES[tar].adapt}
+                                   for tar in sorted(STRATEGIES)])
+        if parts == ['api', 'jobs']:
+            return self.send_json(self.queue.describe_all())
+        if len(parts) == 3 and parts[:2] == ['api', 'jobs']:
+            job = self.job(parts)
+            if job is not None:
+                with self.queue.lock:
+                    description = job.describe(aggregates=True)
+                self.send_json(description)
+            return
+        if len(parts) == 3 and parts[:2] == ['api', 'sessions']:
+            session = self.session(parts)
+            if session is not None:
+                with session.lock:
+                    self.send_json({'graph': session.graph(), 'metrics': session.metrics()})
+            return
+        if len(parts) == 4 and parts[:2] == ['api', 'jobs'] and parts[3] == 'events':
+            job = self.job(parts)
+            if job is not None:
+                self.stream(job)
+            return
+        self.send_json({'error': 'not found'}, 404)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            value = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        except ValueError:
+            raise ValueError("The request body is not valid JSON")
+        if not isinstance(value, dict):
+            raise ValueError("The request body must be a JSON object")
+
+        return value
+
+    def session(self, parts):
+        try:
+            return self.sessions.get(parts[2])
+        except KeyError:
+            self.send_json({'error': 'no such session'}, 404)
+            return None
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        try:
+            if parts == ['api', 'jobs']:
+                job = self.queue.submit(self.read_json())
+                return self.send_json({'id': job.id}, 201)
+            if parts == ['api', 'sessions']:
+                return self.open_session(self.read_json())
+            if len(parts) == 3 and parts[:2] == ['api', 'sessions']:
+                session = self.session(parts)
+                if session is not None:
+                    self.run_command(session, self.read_json())
+                return
+        except ValueError as error:
+            return self.send_json({'error': str(error)}, 400)
+        self.send_json({'error': 'not found'}, 404)
+
+    def open_session(self, spec):
+        network = spec.get('network', 'criminal.txt')
+        if network not in self.queue.networks():
+            raise ValueError("Unknown network %r" % network)
+        p = spec.get('p', 0.5)
+        if type(p) not in (int, float) or not 0 <= p <= 1:
+            raise ValueError("p must be between 0 and 1")
+        ignore_equipment = spec.get('ignore_equipment', 0)
+        if ignore_equipment not in (0, 1):
+            raise ValueError("ignore_equipment must be 0 or 1")
+        (id, session) = self.sessions.open(os.path.join(self.queue.networks_dir, network),
+                                           float(p), int(ignore_equipment), spec.get('seed'))
+        with session.lock:
+            self.send_json({'id': id, 'graph': session.graph(),
+                            'metrics': session.metrics()}, 201)
+
+    def run_command(self, session, spec):
+        with session.lock:
+            if spec.get('command') == 'delete':
+                delta = session.delete(spec.get('node'))
+            elif spec.get('command') == 'step':
+                delta = session.step(spec.get('strategy'))
+            else:
+                raise SessionError("command must be 'delete' or 'step'")
+        self.send_json(delta)
+
+    def do_DELETE(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 3 and parts[:2] == ['api', 'jobs']:
+            job = self.job(parts)
+            if job is not None:
+                self.queue.cancel(job)
+                self.send_json(job.describe())
+            return
+        if len(parts) == 3 and parts[:2] == ['api', 'sessions']:
+            self.sessions.close(parts[2])
+            return self.send_json({})
+        self.send_json({'error': 'not found'}, 404)
+
+    def stream(self, job):
+        """
+        Server-sent events: the job with its aggregates whenever it has
+        changed (at most every EVENT_INTERVAL seconds), then 'done'.
+        """
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        seen = -1
+        try:
+            while True:
+                with job.changed:
+                    if job.version == seen and not job.finished():
+                        job.changed.wait(15)
+                    idle = job.version == seen and not job.finished()
+                    seen = job.version
+                if idle:
+                    # Keep the connection (and any proxy) alive; written
+                    # with the condition released, so that a stalled client
+                    # cannot hold up Job.notify()
+                    self.wfile.write(b': keep-alive\n\n')
+                    self.wfile.flush()
+                    continue
+                with self.queue.lock:
+                    data = json.dumps(job.describe(aggregates=True))
+                    finished = job.finished()
+                event = 'done' if finished else 'progress'
+                self.wfile.write(('event: %s\ndata: %s\n\n' % (event, data)).encode('utf-8'))
+                self.wfile.flush()
+                if finished:
+                    return
+                time.sleep(EVENT_INTERVAL)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Local simulation service')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--networks', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='directory of the network files offered')
+    args = parser.parse_args(argv[1:])
+
+    Handler.queue = JobQueue(args.workers, args.networks)
+    Handler.sessions = SessionStore()
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print('Serving on http://%s:%d/api/ with %d workers' % (args.host, args.port, args.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    Handler.queue.pool.shutdown(cancel_futures=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Interactive sessions on a network, for the criminal_networks app.
+
+A Session holds the current graph of one user's exploration.  Each command
+deletes one node, either the one the user clicked (delete()) or the one a
+targeting strategy picks (step()), and then applies the same rules as
+intervention_adaptation_simulation(): deficient components may adapt,
+then components lacking attributes are pruned.  The command returns a
+compact delta
+
+  {'removed': v, 'added': [[u, w], ..], 'pruned': [[nodes], ..],
+   'metrics': {...}}
+
+in the original node IDs of the network, so the client applies it to the
+graph it is drawing instead of recomputing anything.
+
+The work of a command is confined to the component the deleted node was
+in: adaptation can only link nodes of that component, and only its pieces
+can become inactive, so it is split, adapted and pruned on its own, and
+the metrics are kept up to date incrementally:
+
+  degree_histogram   {degree: number of nodes}
+  nCC, Cmax          from the sizes of the components
+  degree_centralisation   from the maximum degree and the number of edges
+  betweenness_centralisation   recomputed: exactly while the graph has at
+                     most BETWEENNESS_LIMIT nodes, then estimated from
+                     APPROXIMATE_SOURCES sources (see simple.py) up to
+                     APPROXIMATE_LIMIT nodes, and None above that;
+                     betweenness_approximate says which
+
+The first command prunes the whole graph, as the first step of a
+simulation does.
+"""
+
+import time
+import random
+import secrets
+import threading
+
+import networkx as nx
+
+from network import load_network, ALL_ATTRIBUTES, EQUIPMENT
+from simple import (STRATEGIES, SimulationState, APPROXIMATE_SOURCES, adapt_components,
+                    attribute_masks, betweenness_centralisation)
+
+
+# Largest graph whose betweenness centralisation is recomputed exactly
+# after each command (about 0.1 s at 300 nodes and 900 edges; 6 s at 2000
+# nodes)
+BETWEENNESS_LIMIT = 300
+
+# Largest graph whose betweenness centralisation is estimated from a
+# sample of sources instead (about 0.5 s at 5000 nodes and 15000 edges)
+APPROXIMATE_LIMIT = 5000
+
+# Sessions left idle for longer than this (in seconds) are dropped
+SESSION_TIMEOUT = 3600
+
+
+class SessionError(ValueError):
+    pass
+
+
+class Session(object):
+    """
+    The state of one interactive exploration of a network.
+    """
+
+    def __init__(self, network, p=0.5, ignore_equipment=0, seed=None):
+        self.network = network
+        self.G = network.to_graph()
+        self.GG = self.G.copy()
+        self.node_attributes = network.node_attributes()
+        self.masks = attribute_masks(self.node_attributes)
+        self.p = p
+        self.ignore_equipment = ignore_equipment
+        self.random = random.Random(seed)
+        self.strategies = {}
+        self.pruned_once = False
+        self.steps = 0
+
+        # The strategies and adaptation draw from the session's own
+        # generator, never the random module's, which other sessions (and
+        # threads) share
+        self.state = SimulationState(self.G, self.GG, self.node_attributes,
+                                     ignore_equipment, random=self.random)
+        self.degree = dict(self.GG.degree_iter())
+        self.histogram = {}
+        for d in self.degree.values():
+            self.histogram[d] = self.histogram.get(d, 0) + 1
+        self.edges = self.GG.number_of_edges()
+        self.component = {}
+        self.members = {}
+        self.next_component = 0
+        for nodes in nx.connected_components(self.GG):
+            self._new_component(nodes)
+
+    # Node IDs at the boundary: the graph is labelled 1..n
+
+    def node_id(self, v):
+        return int(self.network.ids[v-1])
+
+    def label(self, node_id):
+        try:
+            return int(self.network.index([node_id])[0]) + 1
+        except KeyError:
+            raise SessionError("Unknown node %r" % node_id)
+
+    def graph(self):
+        """
+        The current graph as {'nodes': [id, ..], 'links': [[id, id], ..],
+        'attributes': {id: [b1, .., b8]}}.
+        """
+
+        return {'nodes': [self.node_id(v) for v in self.GG.nodes()],
+                'links': [[self.node_id(u), self.node_id(w)] for (u, w) in self.GG.edges_iter()],
+                'attributes': dict([(str(self.node_id(v)), self.node_attributes[v-1][1:])
+                                    for v in self.GG.nodes()])}
+
+    # Incremental bookkeeping
+
+    def _new_component(self, nodes):
+        c = self.next_component
+        self.next_component += 1
+        for u in nodes:
+            self.component[u] = c
+        self.members[c] = set(nodes)
+
+        return c
+
+    def _set_degree(self, u, d):
+        old = self.degree.get(u)
+        if old is not None:
+            self.histogram[old] -= 1
+            if self.histogram[old] == 0:
+                del self.histogram[old]
+        if d is None:
+            del self.degree[u]
+        else:
+            self.degree[u] = d
+            self.histogram[d] = self.histogram.get(d, 0) + 1
+
+    def _remove_nodes(self, nodes):
+        nodes = set(nodes)
+        for u in nodes:
+            for w in self.GG.neighbors(u):
+                if w not in nodes:
+                    self._set_degree(w, self.degree[w] - 1)
+            self.edges -= self.GG.degree(u)
+        # Edges among the removed nodes were counted twice
+        self.edges += self.GG.subgraph(nodes).number_of_edges()
+        for u in nodes:
+            self._set_degree(u, None)
+        self.GG.remove_nodes_from(nodes)
+
+    def _inactive(self, nodes):
+        cover = 0
+        for u in nodes:
+            cover |= int(self.masks[u-1])
+        if self.ignore_equipment == 1:
+            cover |= EQUIPMENT
+
+        return cover != ALL_ATTRIBUTES
+
+    # Commands
+
+    def delete(self, node_id):
+        """
+        Delete the node with the given ID, let the network respond, and
+        return the delta.
+        """
+
+        v = self.label(node_id)
+        if not self.GG.has_node(v):
+            raise SessionError("Node %r has already been removed" % node_id)
+
+        return self._delete(v, None)
+
+    def step(self, tar):
+        """
+        Delete the node the strategy tar picks (the strategy keeps its
+        state between steps of the session), and return the delta.
+        """
+
+        if tar not in STRATEGIES:
+            raise SessionError("Unknown strategy %r" % tar)
+        if self.GG.number_of_nodes() == 0:
+            raise SessionError("The network is empty")
+        if tar not in self.strategies:
+            self.strategies[tar] = STRATEGIES[tar](self.state)
+        strategy = self.strategies[tar]
+        v = strategy.select(self.state)
+
+        return self._delete(v, strategy if strategy.adapt else False)
+
+    def _delete(self, v, strategy):
+        """
+        Delete v and apply adaptation (unless strategy is False, a no-adapt
+        strategy) and pruning to its component.
+        """
+
+        self.steps += 1
+        c = self.component.pop(v)
+        old = self.members.pop(c)
+        old.discard(v)
+        neighbours = self.GG.neighbors(v)
+        self._remove_nodes([v])
+        self._notify('on_node_removed', v, neighbours)
+
+        # Split what is left of v's component: every piece contains one of
+        # v's former neighbours
+        pieces = []
+        seen = set()
+        for u in neighbours:
+            if u not in seen:
+                piece = nx.node_connected_component(self.GG, u)
+                seen.update(piece)
+                pieces.append(list(piece))
+        added = []
+        deficient = [nodes for nodes in pieces if self._inactive(nodes)]
+        if strategy is not False and len(self.members) + len(pieces) > 1 and deficient != []:
+            H = self.GG.subgraph(old)
+            # The component before the deletion (subgraph() copies the
+            # adjacency, far faster than copy())
+            Hprev = H.subgraph(old)
+            Hprev.add_edges_from([(v, u) for u in neighbours])
+            LC = [H.subgraph(nodes) for nodes in deficient]
+            added = adapt_components(H, Hprev, v, LC, self.node_attributes,
+                                     self.p, self.ignore_equipment, random=self.random)
+            # Two deficient pieces may link to each other's nodes with the
+            # same edge
+            added = [(u, w) for (k, (u, w)) in enumerate(added)
+                     if (u, w) not in added[:k] and (w, u) not in added[:k]]
+            for (u, w) in added:
+                self.GG.add_edge(u, w)
+                self.edges += 1
+                self._set_degree(u, self.degree[u] + 1)
+                self._set_degree(w, self.degree[w] + 1)
+                self._notify('on_edge_added', u, w)
+            if added != []:
+                pieces = [list(nodes) for nodes in nx.connected_components(H)]
+        for nodes in pieces:
+            self._new_component(nodes)
+
+        # Prune: the whole graph the first time, then only the pieces
+        if not self.pruned_once:
+            self.pruned_once = True
+            candidates = sorted(self.members)
+        else:
+            candidates = [self.component[nodes[0]] for nodes in pieces]
+        pruned = []
+        for cid in candidates:
+            if self._inactive(self.members[cid]):
+                nodes = sorted(self.members.pop(cid))
+                pruned.append(nodes)
+                for u in nodes:
+                    del self.component[u]
+        if pruned != []:
+            removed = set([u for nodes in pruned for u in nodes])
+            self._remove_nodes(removed)
+            self._notify('on_pruned', removed)
+
+        return {'removed': self.node_id(v),
+                'added': [[self.node_id(u), self.node_id(w)] for (u, w) in added],
+                'pruned': [[self.node_id(u) for u in nodes] for nodes in pruned],
+                'metrics': self.metrics()}
+
+    def _notify(self, hook, *args):
+        for strategy in self.strategies.values():
+            getattr(strategy, hook)(*(args + (self.state,)))
+
+    def metrics(self):
+        nn = len(self.degree)
+        if nn <= 2:
+            dc = 0
+        else:
+            dc = float(nn*max(self.histogram) - 2*self.edges)/((nn - 1)*(nn - 2))
+        bc = None
+        if nn <= BETWEENNESS_LIMIT:
+            bc = betweenness_centralisation(self.GG)
+        elif nn <= APPROXIMATE_LIMIT:
+            bc = betweenness_centralisation(self.GG, None, APPROXIMATE_SOURCES)
+
+        return {'step': self.steps, 'nodes': nn, 'edges': self.edges,
+                'degree_histogram': dict([(str(d), k) for (d, k) in sorted(self.histogram.items())]),
+                'nCC': len(self.members),
+                'Cmax': max(map(len, self.members.values())) if self.members else 0,
+                'degree_centralisation': dc,
+                'betweenness_centralisation': bc,
+                'betweenness_approximate': bc is not None and nn > BETWEENNESS_LIMIT}
+
+
+def open_session(filename, p=0.5, ignore_equipment=0, seed=None):
+    return Session(load_network(filename), p, ignore_equipment, seed)
+
+
+class SessionStore(object):
+    """
+    The open sessions of a server, by (unguessable) ID, each with a lock so
+    that its commands are applied one at a time.
+    """
+
+    def __init__(self, timeout=SESSION_TIMEOUT):
+        self.timeout = timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def open(self, filename, p=0.5, ignore_equipment=0, seed=None):
+        """
+        Open a session on a network file; returns [id, session].
+        """
+
+        session = open_session(filename, p, ignore_equipment, seed)
+        session.lock = threading.Lock()
+        session.used = time.time()
+        id = secrets.token_hex(8)
+        with self.lock:
+            self.expire()
+            self.sessions[id] = session
+
+        return [id, session]
+
+    def get(self, id):
+        with self.lock:
+            self.expire()
+            session = self.sessions.get(id)
+        if session is None:
+            raise KeyError(id)
+        session.used = time.time()
+
+        return session
+
+    def close(self, id):
+        with self.lock:
+            self.sessions.pop(id, None)
+
+    def expire(self):
+        # Called with the lock held
+        now = time.time()
+        for id in [id for (id, session) in self.sessions.items()
+                   if now - session.used > self.timeout]:
+            del self.sessions[id]
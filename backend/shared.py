@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+The initial network in shared memory, for parallel sweeps.
+
+Handing G and node_attributes to every task of a process pool pickles
+them once per task, and every worker ends up holding its own copies.
+Instead publish_network() writes the network once into a block of OS
+shared memory, laid out as a snapshot (see snapshot.py), and the workers
+attach to it: their Network arrays are read-only views of the shared
+pages, so the compact form of the network exists once on the host however
+many workers there are.  Tasks carry only (tar, adaptation, p,
+ignore_equipment, seed), and each run builds its graph from the shared
+arrays and deletes from it (copy=False, see simple.py), so a worker
+holds no graph of its own between runs: what it costs is one networkx
+graph of the network while a run is going, where keeping G in the
+worker and copying it for each run cost two.  That graph is still big:
+about 13 times the shared arrays, 104 MB against 8 MB for 100000 nodes
+and 400000 edges, so a sweep needs roughly that much per worker.  Code
+that needs the initial graph itself (the reference engine, replays, p
+sweeps) gets a per-worker copy from worker_graph().
+
+    results = run_parallel(load_network('criminal.txt'), tasks, processes=8)
+
+Usage: python shared.py [nn] [processes] [network_file]
+"""
+
+import sys
+import time
+import random
+import resource
+from multiprocessing import Pool, cpu_count, shared_memory, util
+
+import numpy as np
+
+from network import load_network
+from snapshot import snapshot_layout, network_from_buffer
+from simple import (intervention_adaptation_simulation, NO_ADAPT_TARGETS,
+                    OUTPUT_FILENAME_BY_TARGET)
+from telemetry import Telemetry
+
+
+def publish_network(network):
+    """
+    Copy the Network network into a new block of shared memory, and return
+    the SharedMemory object; its name is what workers attach to.  The
+    caller must close() and unlink() it when the workers are done.
+    """
+
+    (header, blobs, size) = snapshot_layout(network)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    block.buf[:len(header)] = header
+    for (start, blob) in blobs:
+        block.buf[start:start+len(blob)] = blob
+
+    return block
+
+
+def attach_network(name):
+    """
+    [block, network]: the shared memory block published under name, and the
+    Network whose arrays are read-only views of it.  The block must be kept
+    (and not closed) for as long as the network is used.
+    """
+
+    block = shared_memory.SharedMemory(name=name)
+    data = np.frombuffer(block.buf, dtype=np.uint8)
+
+    return [block, network_from_buffer(data, 'shared memory %s' % name)]
+
+
+# The state of a worker process, set up once by init_worker()
+_worker = {}
+
+
+def init_worker(name):
+    """
+    Pool initializer: attach to the published network and build the
+    worker's node_attributes from it.
+    """
+
+    (block, network) = attach_network(name)
+    _worker['block'] = block
+    _worker['network'] = network
+    _worker['node_attributes'] = network.node_attributes()
+    util.Finalize(None, release_worker, exitpriority=10)
+
+
+def worker_graph():
+    """
+    The initial graph of the worker's network, built on first use and kept
+    for the life of the worker.  Runs should not delete from it.
+    """
+
+    if 'G' not in _worker:
+        _worker['G'] = _worker['network'].to_graph()
+
+    return _worker['G']
+
+
+def release_worker():
+    """
+    Drop the worker's views of the shared memory and close it, as the
+    worker exits.
+    """
+
+    block = _worker.pop('block', None)
+    _worker.clear()
+    if block is not None:
+        block.close()
+
+
+def run_task(task):
+    """
+    One run of the simulation in a worker, on a graph of its own built from
+    the shared arrays.  task is (tar, adaptation, p, ignore_equipment,
+    seed); returns the run's values.
+    """
+
+    (tar, adaptation, p, ignore_equipment, seed) = task
+    random.seed(seed)
+
+    return intervention_adaptation_simulation(
+        _worker['network'].to_graph(), _worker['node_attributes'], tar, adaptation, p,
+        ignore_equipment, copy=False)
+
+
+def timed_task(task):
+    """
+    run_task(), returning [values, seconds, memory high-water mark of the
+    worker in bytes].
+    """
+
+    start = time.perf_counter()
+    values = run_task(task)
+
+    return [values, time.perf_counter() - start,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024]
+
+
+def run_parallel(network, tasks, processes=None, chunksize=1, telemetry=None):
+    """
+    Run the tasks (see run_task()) on a pool of processes sharing the
+    Network network, and return their values in the order of tasks.  If
+    telemetry (a telemetry.Telemetry) is given, each run is reported to it
+    as it finishes.
+    """
+
+    block = publish_network(network)
+    try:
+        pool = Pool(processes, initializer=init_worker, initargs=(block.name,))
+        try:
+            if telemetry is None:
+                results = pool.map(run_task, tasks, chunksize)
+            else:
+                results = []
+                for (task, (values, seconds, memory)) in zip(
+                        tasks, pool.imap(timed_task, tasks, chunksize)):
+                    telemetry.observe_run(task[0], seconds, steps=len(values),
+                                          worker_memory=memory)
+                    results.append(values)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        block.close()
+        block.unlink()
+
+    return results
+
+
+def main(argv):
+    nn = int(argv[1]) if len(argv) > 1 else 10
+    processes = int(argv[2]) if len(argv) > 2 else None
+    filename = argv[3] if len(argv) > 3 else 'criminal.txt'
+
+    network = load_network(filename)
+    random.seed()
+    tasks = []
+    for tar in range(len(OUTPUT_FILENAME_BY_TARGET)):
+        for i in range(nn):
+            tasks.append((tar, tar not in NO_ADAPT_TARGETS, 0.5, 0,
+                          random.getrandbits(64)))
+
+    telemetry = Telemetry('sweep.prom', total=len(tasks), workers=processes or cpu_count())
+    start = time.perf_counter()
+    results = run_parallel(network, tasks, processes, telemetry=telemetry)
+    elapsed = time.perf_counter() - start
+    telemetry.close()
+
+    for tar in range(len(OUTPUT_FILENAME_BY_TARGET)):
+        lengths = [len(values) for (task, values) in zip(tasks, results) if task[0] == tar]
+        print('%-28s mean length %6.2f over %d runs'
+              % (OUTPUT_FILENAME_BY_TARGET[tar], float(sum(lengths))/len(lengths), len(lengths)))
+    print('%d runs in %.2f s' % (len(tasks), elapsed))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -23,11 +23,20 @@ import sys
 import json
 import random
 import itertools
+import numpy as np
 import networkx as nx
 #import matplotlib.pyplot as plt
 #import matplotlib.ticker as mtick
 from operator import itemgetter
 import pprint as pp
+from statecache import cached, GraphStateCache
+from profiling import NULL_PROFILER
+from network import load_network, component_labels, ALL_ATTRIBUTES, EQUIPMENT
+
+# Sources sampled for the betweenness in the step measures of a run that
+# has gone over its memory budget (see memory.py)
+APPROXIMATE_SOURCES = 32
+
 
 def initialise_network(filename):
     """
@@ -44,25 +53,15 @@ def initialise_network(filename):
     Here v is the node ID, b1, .., b8 are boolean representing attributes:
     money, drugs, premises, equipment, precursors, information,
     skills/knowledge, labour.  The order matches the master spreadsheet.
-    """
 
-    with open(filename, 'r') as f:
-        data = json.load(f)
-
-    ID1 = data['ID1']
-    ID2 = data['ID2']
-    node_attributes = data['node_attributes']
+    Nodes may have any IDs: they are relabelled 1..n in increasing order of
+    ID, node_attributes is given in that order, and
+    network.load_network(filename).ids[v-1] is the original ID of node v.
+    """
 
-    # Create the original criminal network
-    n = 128  # the number of vertices: equals 128 for our network
-    m = len(ID1)  # the number of edges
-    G = nx.Graph()
-    nodelist = [i for i in range(1, n+1)]  # 129 = 128 + 1
-    edgelist = [(ID1[i], ID2[i]) for i in range(m)]
-    G.add_nodes_from(nodelist)
-    G.add_edges_from(edgelist)
+    network = load_network(filename)
 
-    return (G, node_attributes)
+    return (network.to_graph(), network.node_attributes())
 
 
 def degree_centralisation(H):
@@ -87,17 +86,24 @@ def degree_centralisation(H):
     return (nn*centrality_max - sum([centrality_values[j] for j in range(nn)]))/norm
 
 
-def betweenness_centralisation(H):
+def betweenness_centralisation(H, cache=None, sources=None):
     """
     Calculate betweenness centralization of a graph H.
 
     Calculate the list of vertex betweenness centrality dictionaries,
     following [Freeman 1979]'s definition of C_B
+
+    With sources, the betweenness is estimated from the shortest paths from
+    that many sources (see approximate_betweenness_dict()) if H has more
+    nodes.
     """
 
     if len(H.nodes()) <= 2:
         return 0
-    centralities = nx.betweenness_centrality(H, None, False)
+    if sources is not None and len(H) > sources:
+        centralities = approximate_betweenness_dict(H, sources)
+    else:
+        centralities = betweenness_dict(H, cache)
     centrality_values = [centralities[u] for u in list(centralities.keys())]
     centrality_max = max(centrality_values)
     nn = len(centrality_values)
@@ -106,6 +112,76 @@ def betweenness_centralisation(H):
     return (nn*centrality_max - sum([centrality_values[j] for j in range(nn)]))/norm
 
 
+def betweenness_dict(H, cache=None):
+    """
+    The (unnormalised) betweenness centrality of every node of H, looked up
+    in cache (a statecache.GraphStateCache) if one is given.
+    """
+
+    return cached(cache, 'betweenness', H,
+                  lambda: nx.betweenness_centrality(H, None, False))
+
+
+def approximate_betweenness_dict(H, k):
+    """
+    An estimate of the (unnormalised) betweenness of every node of H from
+    the shortest paths from k sampled sources, scaled up by n/k.  The
+    sample is drawn from a generator of its own, seeded by the size of H,
+    so the random module the simulation draws from is left alone.
+    """
+
+    sources = random.Random(len(H)).sample(sorted(H.nodes()), k)
+    betweenness = nx.betweenness_centrality_subset(H, sources, H.nodes(), False)
+    scale = len(H)/float(k)
+
+    return dict([(u, b*scale) for (u, b) in betweenness.items()])
+
+
+def distances_from(H, sources):
+    """
+    The distance in H from the nearest of sources to every node reachable
+    from them, as a dict, by one breadth-first search.
+    """
+
+    distances = dict.fromkeys(sources, 0)
+    frontier = list(sources)
+    d = 0
+    while frontier:
+        d += 1
+        following = []
+        for u in frontier:
+            for w in H.adj[u]:
+                if w not in distances:
+                    distances[w] = d
+                    following.append(w)
+        frontier = following
+
+    return distances
+
+
+def sorted_degrees(H, cache=None):
+    """
+    The (node, degree) list of H in decreasing order of degree, looked up in
+    cache if one is given.
+    """
+
+    # CSG: I found the line below on
+    # https://groups.google.com/forum/#!topic/networkx-discuss/Bai-YcHQdqg
+    # It returns the (node, degree) list in decreasing order of degree
+    return cached(cache, 'degrees', H,
+                  lambda: sorted(H.degree_iter(), key=itemgetter(1), reverse=True))
+
+
+def component_nodes(H, cache=None):
+    """
+    The list of node lists of the connected components of H, looked up in
+    cache if one is given.
+    """
+
+    return cached(cache, 'components', H,
+                  lambda: [list(c) for c in nx.connected_components(H)])
+
+
 def calc_attributes(V, node_attributes, ignore_equipment):
     """
     Calculate set of attributes for a set of vertices.
@@ -176,7 +252,7 @@ CSG, March 2016, added some new "no adapt" strategies here
 """
 
 
-def cut_set_targeting(H, cutset):
+def cut_set_targeting(H, cutset, cache=None, random=random):
     """
     Cut set targeting.  First, an essay by Thomas (-:
 
@@ -217,38 +293,31 @@ def cut_set_targeting(H, cutset):
 
     We will work through deleting the elements of "cutset" until none are left,
     so we need to pass this set in as a parameter if it's already been found.
-    Initially, set "cutset" = {}, and only look for a cutset in that case.
+    Initially, set "cutset" = set(), and only look for a cutset in that case.
     Discard any inactive vertices from the cutset before proceeding.
     (This seems to work well, compared with starting from scratch at each step)
+
+    random is the generator to draw from (the random module by default).
     """
 
     if len(cutset) == 0:
         # Find two non-adjacent vertices with highest possible degrees
         # print('looking for a new cutset')
-        LC = list(nx.connected_component_subgraphs(H))
+        LC = component_nodes(H, cache)
         # find max component, break ties randomly
-        Cmax = max([len(Ctemp.nodes()) for Ctemp in LC])
-        CC = random.choice([Ctemp for Ctemp in LC if len(Ctemp.nodes()) == Cmax])
-        degree_sequence = sorted(CC.degree_iter(), key=itemgetter(1), reverse=True)
-        all_non_equal_pairs = itertools.combinations(degree_sequence, 2)
-        max_so_far = 0
-        for uv in all_non_equal_pairs:
-            u = uv[0]
-            v = uv[1]
-            # nonadjacent pair
-            if ((u[0], v[0]) not in CC.edges()) and ((v[0], u[0]) not in CC.edges()):
-                uNbsNotv = list(set(CC.neighbors(u[0])) - set(CC.neighbors(v[0])))
-                vNbsNotu = list(set(CC.neighbors(v[0])) - set(CC.neighbors(u[0])))
-                if len(uNbsNotv)*len(vNbsNotu) > max_so_far:
-                    max_so_far = len(uNbsNotv)*len(vNbsNotu)
-                    uu = u[0]
-                    vv = v[0]
-        cutset = {}
+        Cmax = max([len(Ctemp) for Ctemp in LC])
+        CC = H.subgraph(random.choice([Ctemp for Ctemp in LC if len(Ctemp) == Cmax]))
+        (uu, vv, max_so_far, top) = cached(cache, 'cutpair', CC,
+                                           lambda: cut_set_pair(CC))
+        cutset = set()
         # If two such vertices were found, then find a minimum cutset that
         # separates these vertices
         if max_so_far > 0:
             # print('highest degree-product pair ', uu, ',', vv, ', degree product', maxdegsofar)
-            cutset = nx.minimum_node_cut(H, uu, vv)
+            # (a copy, since we discard vertices from it as we go)
+            cutset = set(cached(cache, 'cutset', H,
+                                lambda: nx.minimum_node_cut(H, uu, vv),
+                                extra=(uu, vv)))
             # print('cutset vertices', cutset)
 
     # If Cutset is not empty, then choose from it a random vertex
@@ -258,13 +327,43 @@ def cut_set_targeting(H, cutset):
         cutset.discard(v)
         # print('Now cutset equals ', cutset)
     else:
-        v = degree_sequence[0][0]
+        v = top
         # print('Cutset was empty! We chose highest degree vertex ', v)
 
     return [v, cutset]
 
 
-def max_degree_targeting(H):
+def cut_set_pair(CC):
+    """
+    For cut_set_targeting: find two non-adjacent vertices uu and vv of the
+    component CC with |N(uu) \ N(vv)| x |N(vv) \ N(uu)| maximal.
+
+    Returns [uu, vv, max_so_far, top] where max_so_far is that product
+    (0 if there is no such pair, and then uu and vv are None) and top is a
+    vertex of highest degree in CC.
+    """
+
+    degree_sequence = sorted(CC.degree_iter(), key=itemgetter(1), reverse=True)
+    all_non_equal_pairs = itertools.combinations(degree_sequence, 2)
+    max_so_far = 0
+    uu = None
+    vv = None
+    for uv in all_non_equal_pairs:
+        u = uv[0]
+        v = uv[1]
+        # nonadjacent pair
+        if ((u[0], v[0]) not in CC.edges()) and ((v[0], u[0]) not in CC.edges()):
+            uNbsNotv = list(set(CC.neighbors(u[0])) - set(CC.neighbors(v[0])))
+            vNbsNotu = list(set(CC.neighbors(v[0])) - set(CC.neighbors(u[0])))
+            if len(uNbsNotv)*len(vNbsNotu) > max_so_far:
+                max_so_far = len(uNbsNotv)*len(vNbsNotu)
+                uu = u[0]
+                vv = v[0]
+
+    return [uu, vv, max_so_far, degree_sequence[0][0]]
+
+
+def max_degree_targeting(H, cache=None):
     """
     Given a graph H, this function returns a randomly chosen node of maximum
     degree.  This simulates targeting the most visible actor in the criminal
@@ -274,43 +373,58 @@ def max_degree_targeting(H):
     CSG: now breaks ties randomly
     """
 
+    v = random.choice(max_degree_candidates(H, cache))
+    # print('deleting', v)
+
+    return v
+
+
+def max_degree_candidates(H, cache=None):
+    """
+    The list of nodes of maximum degree in H: max_degree_targeting chooses
+    uniformly at random from this list.
+    """
+
     if H.nodes() == []:
         raise ValueError("Graph is empty")
 
-    # CSG: I found the line below on
-    # https://groups.google.com/forum/#!topic/networkx-discuss/Bai-YcHQdqg
-    # It returns the (node,degree) list in decreasing order of degree
-    degree_sequence = sorted(H.degree_iter(), key=itemgetter(1), reverse=True)
+    degree_sequence = sorted_degrees(H, cache)
     max_degree = degree_sequence[0][1]
-    highest_degree_nodes = [n for (n, d) in degree_sequence if d == max_degree]
-    v = random.choice(highest_degree_nodes)
-    # print('deleting', v)
 
-    return v
+    return [n for (n, d) in degree_sequence if d == max_degree]
 
 
-def max_betweenness_targeting(H):
+def max_betweenness_targeting(H, cache=None, random=random):
     """
     Given a graph H, this function returns a randomly chosen node of maximum
     betweenness.  This simulates targeting the brokers in the criminal network.
 
     Find a vertex with highest possible betweenness, breaking ties randomly
-    (though ties are unlikely)
+    (though ties are unlikely), drawing from random
+    """
+
+    v = random.choice(max_betweenness_candidates(H, cache))
+
+    return v
+
+
+def max_betweenness_candidates(H, cache=None):
+    """
+    The list of nodes of maximum betweenness in H: max_betweenness_targeting
+    chooses uniformly at random from this list.
     """
 
     if H.nodes() == []:
         raise ValueError("Graph is empty")
 
-    centralities = nx.betweenness_centrality(H, None, False)
+    centralities = betweenness_dict(H, cache)
     betweenness_sequence = sorted(centralities.items(), key=itemgetter(1), reverse=True)
     max_betweenness = betweenness_sequence[0][1]
-    highest_betweenness_nodes = [n for (n, d) in betweenness_sequence if d == max_betweenness]
-    v = random.choice(highest_betweenness_nodes)
 
-    return v
+    return [n for (n, d) in betweenness_sequence if d == max_betweenness]
 
 
-def money_targeting(H, node_attributes, ignore_equipment):
+def money_targeting(H, node_attributes, ignore_equipment, cache=None):
     """
     Given a graph H, this function returns a node with the "Money" attribute,
     chosen by highest degree in H, and breaking ties randomly.  This simulates
@@ -321,27 +435,12 @@ def money_targeting(H, node_attributes, ignore_equipment):
     Break ties randomly.
     """
 
-    if H.nodes() == []:
-        raise ValueError("Graph is empty")
-
-    # CSG: I found the line below on
-    # https://groups.google.com/forum/#!topic/networkx-discuss/Bai-YcHQdqg
-    # It returns the (node, degree) list in decreasing order of degree
-    degree_sequence = sorted(H.degree_iter(), key=itemgetter(1), reverse=True)
-    money_degree_sequence = [(n, d) for (n, d) in degree_sequence if (1 in calc_attributes([n], node_attributes, ignore_equipment))]
-
-    if money_degree_sequence == []:
-        # no more vertices with attribute "Money" left
-        v = random.choice(H.nodes())
-    else:
-        max_degree = money_degree_sequence[0][1]
-        highest_degree_money_nodes = [n for (n, d) in money_degree_sequence if d == max_degree]
-        v = random.choice(highest_degree_money_nodes)
+    v = random.choice(attribute_candidates(H, 1, node_attributes, ignore_equipment, cache))
 
     return v
 
 
-def precursor_targeting(H, node_attributes, ignore_equipment):
+def precursor_targeting(H, node_attributes, ignore_equipment, cache=None):
     """
     Added, 8 July 2015, but just noticed that the attribute_targeting function
     would have done the job.  Should be the same as
@@ -355,28 +454,14 @@ def precursor_targeting(H, node_attributes, ignore_equipment):
     degree.  Break ties randomly.
     """
 
-    if H.nodes() == []:
-        raise ValueError("Graph is empty")
-
-    # CSG: I found the line below on
-    # https://groups.google.com/forum/#!topic/networkx-discuss/Bai-YcHQdqg
-    # It returns the (node, degree) list in decreasing order of degree
-    degree_sequence = sorted(H.degree_iter(), key=itemgetter(1), reverse=True)
-    precursor_degree_sequence = [(n, d) for (n, d) in degree_sequence if (5 in calc_attributes([n], node_attributes, ignore_equipment))]
-
-    if precursor_degree_sequence == []:
-        # no more vertices with attribute "precursor" left
-        v = random.choice(H.nodes())
-    else:
-        max_degree = precursor_degree_sequence[0][1]
-        highest_degree_precursor_nodes = [n for (n, d) in precursor_degree_sequence if d == max_degree]
-        v = random.choice(highest_degree_precursor_nodes)
-        # print("deleting", v)
+    v = random.choice(attribute_candidates(H, 5, node_attributes, ignore_equipment, cache))
+    # print("deleting", v)
 
     return v
 
 
-def attribute_targeting(H, attribute, node_attributes, ignore_equipment):
+def attribute_targeting(H, attribute, node_attributes, ignore_equipment,
+                        cache=None):
     """
     Given a graph H, this function returns a node with a specified attribute
     (between 1 and 8), chosen by highest degree in H, and breaking ties
@@ -387,33 +472,44 @@ def attribute_targeting(H, attribute, node_attributes, ignore_equipment):
     degree.  Break ties randomly.
     """
 
+    v = random.choice(attribute_candidates(H, attribute, node_attributes, ignore_equipment, cache))
+
+    return v
+
+
+def attribute_candidates(H, attribute, node_attributes, ignore_equipment,
+                         cache=None):
+    """
+    The list of nodes with the given attribute which have highest degree
+    among such nodes in H.  If no node with the attribute is left, this is
+    the list of all nodes of H.  attribute_targeting (and so money_targeting
+    and precursor_targeting) chooses uniformly at random from this list.
+    """
+
     if H.nodes() == []:
         raise ValueError("Graph is empty")
 
-    # CSG: I found the line below on
-    # https://groups.google.com/forum/#!topic/networkx-discuss/Bai-YcHQdqg
-    # It returns the (node, degree) list in decreasing order of degree
-    degree_sequence = sorted(H.degree_iter(), key=itemgetter(1), reverse=True)
+    degree_sequence = sorted_degrees(H, cache)
     attribute_degree_sequence = [(n, d) for (n, d) in degree_sequence if (attribute in calc_attributes([n], node_attributes, ignore_equipment))]
 
     if attribute_degree_sequence == []:
         # no more vertices with the chosen attribute left
-        v = random.choice(H.nodes())
-    else:
-        max_degree = attribute_degree_sequence[0][1]
-        highest_degree_attribute_nodes = [n for (n, d) in attribute_degree_sequence if d == max_degree]
-        v = random.choice(highest_degree_attribute_nodes)
+        return H.nodes()
 
-    return v
+    max_degree = attribute_degree_sequence[0][1]
 
+    return [n for (n, d) in attribute_degree_sequence if d == max_degree]
 
-def random_targeting(H):
+
+def random_targeting(H, random=random):
     """
     Given a graph G, this function returns a randomly chosen node
     (no other conditions: just random choice over all nodes)
 
     This acts as a baseline for all other simulations: it could be argued
     that this simulates non-strategic law enforcement interventions.
+
+    random is the generator to draw from (the random module by default).
     """
 
     if H.nodes() == []:
@@ -423,8 +519,517 @@ def random_targeting(H):
     return v
 
 
+"""
+The targeting strategies as objects, registered by their number tar.
+
+The simulation loop makes one strategy object per run and asks it for the
+node to delete at each step with select(state), where state is the
+SimulationState of the run.  It tells the strategy what happens to the
+graph through the hooks on_node_removed() (the targeted node has been
+deleted), on_edge_added() (adaptation has added an edge) and on_pruned()
+(inactive components have been removed), so that a strategy can keep its
+own index of the graph up to date instead of recomputing it every step.
+The adapt attribute says whether the network adapts under the strategy.
+
+A new strategy is a subclass of Strategy registered under a new number:
+
+    @register_strategy(14, 'MyStrategy')
+    class MyStrategy(Strategy):
+        def select(self, state):
+            ...
+
+and needs no change to simulation_steps().
+"""
+
+
+STRATEGIES = {}
+
+
+def register_strategy(tar, name):
+    """
+    Class decorator registering a strategy class as STRATEGIES[tar], with
+    its output file name.
+    """
+
+    def register(cls):
+        cls.tar = tar
+        cls.name = name
+        STRATEGIES[tar] = cls
+        return cls
+
+    return register
+
+
+class SimulationState(object):
+    """
+    What a strategy can see of a run: the initial graph G (None if the run
+    was handed its graph to delete from, see simulation_steps()) and its
+    number of nodes n, the current graph GG, node_attributes,
+    ignore_equipment, the cache and profiler of the run, and random, the
+    generator its strategies and adaptation draw from (the random module,
+    unless the run has one of its own, as a session does).
+    """
+
+    def __init__(self, G, GG, node_attributes, ignore_equipment, cache=None,
+                 profiler=None, random=random):
+        self.G = G
+        self.n = nx.number_of_nodes(G if G is not None else GG)
+        self.GG = GG
+        self.node_attributes = node_attributes
+        self.ignore_equipment = ignore_equipment
+        self.cache = cache
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
+        self.random = random
+        self._masks = None
+
+    @property
+    def masks(self):
+        """
+        attribute_masks(node_attributes), worked out on first use and kept
+        for the run.
+        """
+
+        if self._masks is None:
+            self._masks = attribute_masks(self.node_attributes)
+
+        return self._masks
+
+
+class Strategy(object):
+    """
+    Base class of the targeting strategies.  The hooks do nothing here.
+    """
+
+    tar = None
+    name = None
+    adapt = True
+
+    def __init__(self, state):
+        pass
+
+    def select(self, state):
+        raise NotImplementedError
+
+    def on_node_removed(self, v, neighbours, state):
+        """
+        The targeted node v, with the given neighbours, has been deleted.
+        """
+
+        pass
+
+    def on_edge_added(self, u, v, state):
+        pass
+
+    def on_pruned(self, nodes, state):
+        pass
+
+
+class DegreeBuckets(object):
+    """
+    The nodes of a graph (or those of them in a given subset) grouped by
+    degree, kept up to date as nodes and edges change, so that the nodes of
+    maximum degree are found without sorting.
+
+    Candidates are listed in the node order of the graph the buckets were
+    built from, which is the order sorted_degrees() gives ties in: so
+    choosing among them uses the random numbers exactly as the sorting
+    version did.
+    """
+
+    def __init__(self, H, nodes=None):
+        self.position = dict([(u, k) for (k, u) in enumerate(H.nodes())])
+        self.degree = {}
+        self.buckets = {}
+        self.max_degree = 0
+        for u in (H.nodes() if nodes is None else nodes):
+            self._insert(u, H.degree(u))
+
+    def __len__(self):
+        return len(self.degree)
+
+    def _insert(self, u, d):
+        self.degree[u] = d
+        self.buckets.setdefault(d, set()).add(u)
+        if d > self.max_degree:
+            self.max_degree = d
+
+    def discard(self, u):
+        d = self.degree.pop(u, None)
+        if d is not None:
+            self.buckets[d].discard(u)
+
+    def update(self, u, d):
+        """
+        Record that the tracked node u now has degree d.
+        """
+
+        if u in self.degree:
+            self.discard(u)
+            self._insert(u, d)
+
+    def candidates(self):
+        """
+        The tracked nodes of maximum degree, in graph order.
+        """
+
+        while self.max_degree > 0 and not self.buckets.get(self.max_degree):
+            self.max_degree -= 1
+
+        return sorted(self.buckets.get(self.max_degree, ()), key=self.position.get)
+
+
+class DegreeIndexed(Strategy):
+    """
+    A strategy choosing among tracked nodes of maximum degree, its
+    DegreeBuckets kept up to date by the hooks.  tracked() gives the nodes
+    to track, all of them by default.
+    """
+
+    def __init__(self, state):
+        self.buckets = DegreeBuckets(state.GG, self.tracked(state))
+
+    def tracked(self, state):
+        return None
+
+    def on_node_removed(self, v, neighbours, state):
+        self.buckets.discard(v)
+        for u in neighbours:
+            self.buckets.update(u, state.GG.degree(u))
+
+    def on_edge_added(self, u, v, state):
+        self.buckets.update(u, state.GG.degree(u))
+        self.buckets.update(v, state.GG.degree(v))
+
+    def on_pruned(self, nodes, state):
+        # Pruned nodes are whole components, so no degree left changes
+        for u in nodes:
+            self.buckets.discard(u)
+
+
+@register_strategy(0, 'CutSet')
+class CutSet(Strategy):
+    """
+    cut_set_targeting, working through one cutset before looking for the
+    next.
+    """
+
+    def __init__(self, state):
+        self.cutset = set()
+
+    def select(self, state):
+        if len(self.cutset) == 0:
+            state.profiler.count('cutset_searches')
+        (v, self.cutset) = cut_set_targeting(state.GG, self.cutset, state.cache,
+                                             state.random)
+
+        return v
+
+    def on_node_removed(self, v, neighbours, state):
+        # (A no-op when v came from the cutset; needed when the node was
+        # picked some other way)
+        self.cutset.discard(v)
+
+    def on_pruned(self, nodes, state):
+        for u in nodes:
+            self.cutset.discard(u)
+
+
+@register_strategy(1, 'MaxDegree')
+class MaxDegree(DegreeIndexed):
+
+    def select(self, state):
+        if len(self.buckets) == 0:
+            raise ValueError("Graph is empty")
+
+        return state.random.choice(self.buckets.candidates())
+
+
+@register_strategy(2, 'MaxBetweenness')
+class MaxBetweenness(Strategy):
+
+    def select(self, state):
+        return max_betweenness_targeting(state.GG, state.cache, state.random)
+
+
+@register_strategy(3, 'Money')
+class Money(DegreeIndexed):
+    """
+    Nodes with the attribute, by highest degree (see attribute_targeting);
+    once none is left, any node.
+    """
+
+    attribute = 1
+
+    def tracked(self, state):
+        return [u for u in state.GG.nodes()
+                if self.attribute in calc_attributes([u], state.node_attributes,
+                                                     state.ignore_equipment)]
+
+    def select(self, state):
+        if state.GG.nodes() == []:
+            raise ValueError("Graph is empty")
+        if len(self.buckets) == 0:
+            # no more vertices with the chosen attribute left
+            return state.random.choice(state.GG.nodes())
+
+        return state.random.choice(self.buckets.candidates())
+
+
+@register_strategy(4, 'Random')
+class Random(Strategy):
+
+    def select(self, state):
+        return random_targeting(state.GG, state.random)
+
+
+@register_strategy(5, 'Precursor')
+class Precursor(Money):
+    attribute = 5
+
+
+@register_strategy(6, 'MaxDegreeNoAdapt')
+class MaxDegreeNoAdapt(MaxDegree):
+    adapt = False
+
+
+class CutSetThen(Strategy):
+    """
+    Hybrid strategies: cutset targeting while more than half of the nodes
+    of G are left, then the strategy then_strategy.
+    """
+
+    then_strategy = None
+
+    def __init__(self, state):
+        self.first = CutSet(state)
+        self.then = self.then_strategy(state)
+
+    def select(self, state):
+        if nx.number_of_nodes(state.GG) > state.n/2.0:
+            return self.first.select(state)
+
+        return self.then.select(state)
+
+    def on_node_removed(self, v, neighbours, state):
+        self.first.on_node_removed(v, neighbours, state)
+        self.then.on_node_removed(v, neighbours, state)
+
+    def on_edge_added(self, u, v, state):
+        self.then.on_edge_added(u, v, state)
+
+    def on_pruned(self, nodes, state):
+        # The hybrids have never discarded pruned nodes from the cutset
+        self.then.on_pruned(nodes, state)
+
+
+@register_strategy(7, 'CutSetThenMaxDegree')
+class CutSetThenMaxDegree(CutSetThen):
+    then_strategy = MaxDegree
+
+
+@register_strategy(8, 'CutSetThenMaxBetweenness')
+class CutSetThenMaxBetweenness(CutSetThen):
+    then_strategy = MaxBetweenness
+
+
+@register_strategy(9, 'MaxBetweenessNoAdapt')
+class MaxBetweennessNoAdapt(MaxBetweenness):
+    adapt = False
+
+
+@register_strategy(10, 'CutSetNoAdapt')
+class CutSetNoAdapt(CutSet):
+    adapt = False
+
+
+@register_strategy(11, 'MoneyNoAdapt')
+class MoneyNoAdapt(Money):
+    adapt = False
+
+
+@register_strategy(12, 'PrecursorsNoAdapt')
+class PrecursorsNoAdapt(Precursor):
+    adapt = False
+
+
+@register_strategy(13, 'RandomNoAdapt')
+class RandomNoAdapt(Random):
+    adapt = False
+
+
+OUTPUT_FILENAME_BY_TARGET = [STRATEGIES[tar].name for tar in sorted(STRATEGIES)]
+
+# Targeting strategies run without letting the network adapt
+NO_ADAPT_TARGETS = tuple([tar for tar in sorted(STRATEGIES) if not STRATEGIES[tar].adapt])
+
+
+def attribute_masks(node_attributes):
+    """
+    The attribute bitmasks of the nodes (bit j-1 for attribute j) as an
+    array indexed by v-1.  Callers that need them at every step keep them
+    (as SimulationState.masks does) rather than work them out again.
+    """
+
+    bits = np.asarray(node_attributes, dtype=np.int64)[:, 1:9] != 0
+
+    return (bits << np.arange(8)).sum(axis=1).astype(np.uint8)
+
+
+def prune_inactive_components(GG, node_attributes, ignore_equipment, masks=None):
+    """
+    Remove from GG every component that is too small or that lacks some
+    attributes (i.e., its attempt to recover has failed).  GG is changed in
+    place, and the set of removed nodes is returned.  masks, if given, is
+    attribute_masks(node_attributes).
+
+    The components are labelled in one union-find pass over the edges, the
+    attribute masks ORed together per label, and the nodes of every
+    failing label removed at once.
+    """
+
+    nodes = GG.nodes()
+    if nodes == []:
+        return set()
+    if masks is None:
+        masks = attribute_masks(node_attributes)
+    # The nodes are 1..n (as in node_attributes), so they serve as array
+    # indices directly; each edge is taken in both directions
+    adjacency = list(map(GG.adj.__getitem__, nodes))
+    live = np.array(nodes)
+    ends = np.repeat(live, list(map(len, adjacency)))
+    neighbours = np.fromiter(itertools.chain.from_iterable(adjacency),
+                             dtype=live.dtype, count=len(ends))
+    labels = component_labels(len(node_attributes) + 1, ends, neighbours)[live]
+
+    cover = np.zeros(len(node_attributes) + 1, dtype=np.uint8)
+    np.bitwise_or.at(cover, labels, masks[live - 1])
+    if ignore_equipment == 1:
+        # Let's test what happens if we ignore the "Equipment" attribute
+        cover |= EQUIPMENT
+    # The components lacking some attributes
+    bad_vertices = set(live[cover[labels] != ALL_ATTRIBUTES].tolist())
+    if bad_vertices:
+        GG.remove_nodes_from(bad_vertices)
+
+    return bad_vertices
+
+
+def step_measures(GG, cache=None, sources=None):
+    """
+    The measures recorded after each deletion step:
+    [betweenness centralisation, degree centralisation, number of
+    components, maximal component size]
+    With sources, the betweenness is estimated from that many sources (see
+    betweenness_centralisation()).
+    """
+
+    # Recalculate Cmax in case it has changed.
+    LC = component_nodes(GG, cache)
+    nCC = len(LC)
+    if LC == []:
+        Cmax = 0
+    else:
+        Cmax = max([len(Ctemp) for Ctemp in LC])
+
+    return [betweenness_centralisation(GG, cache, sources), degree_centralisation(GG), nCC, Cmax]
+
+
+def adaptation_proposals(GG, Gprev, v, LC, node_attributes, ignore_equipment,
+                         profiler=None, random=random):
+    """
+    The edges that adaptation may add to GG after v has been deleted, with
+    the random number deciding each, whatever p is.
+
+    GG is the graph after deleting v, Gprev the graph before, and LC the list
+    of component subgraphs of GG.  For a component lacking attributes, find
+    the vertices AddNodes (elsewhere in v's old component) whose attributes
+    make up what is missing, choose one, vadd, with probability proportional
+    to the inverse of its distance to the component, and propose to link
+    each former neighbour cv of v in the component to vadd.  A proposal is
+    (vadd, cv, CutOff), and the edge is added if CutOff < p (see
+    apply_proposals()).
+
+    The random numbers are drawn as adapt_components() always has, so
+    nothing here depends on p: runs with the same seed and different p
+    make the same draws until an edge is added for one p and not another.
+    They come from random, the random module by default.
+    """
+
+    if profiler is None:
+        profiler = NULL_PROFILER
+    proposals = []
+    for CC in LC:
+        profiler.count('components_examined')
+        CCnodes = CC.nodes()
+        Att = calc_attributes(CCnodes, node_attributes, ignore_equipment)
+        # TEST!!
+        # Let's test what happens if we ignore the "Equipment"
+        # attribute
+        if len(Att) + ignore_equipment < 8:
+            profiler.count('adaptation_attempts')
+            # print('adapt? Attributes = ', Att, 'nr nodes in component = ', len(CCnodes))
+            # Try this: OK to adapt to vt if it replaces all missing
+            # attributes, with the possible exception of equipment (4)
+            # The distance in Gprev from CC to every node it can reach, by
+            # one search from all of CC (the same minimum distances, and
+            # reachability, as a search from each candidate used to give,
+            # without a distance dict per candidate)
+            dminAll = distances_from(Gprev, CCnodes)
+            AddNodes = [vt for vt in GG.nodes() if (vt not in CCnodes) and (len(set(Att + [j for j in range(1, 9) if node_attributes[vt-1][j] > 0])) + ignore_equipment == 8) and vt in dminAll]
+            # Choose a vertex from AddNodes with probability
+            # proportional to the inverse of the min distance to CC
+            if AddNodes != []:
+                weightsCC = [1.0/dminAll[vtemp3] for vtemp3 in AddNodes]
+                j = weighted_choice(weightsCC, random)
+                vadd = AddNodes[j]
+                # print('vertex to add = ', vadd, ', attributes ', calc_attributes([vadd], node_attributes))
+                for cv in CCnodes:
+                    # only allow former neighbours of v to link to
+                    # vadd (a number is drawn for every node all the same)
+                    CutOff = random.random()
+                    if (cv in Gprev.neighbors(v)):
+                        proposals.append((vadd, cv, CutOff))
+
+    return proposals
+
+
+def apply_proposals(GG, proposals, p, profiler=None):
+    """
+    Add to GG the proposed edges whose CutOff is below p, in order, and
+    return the list of edges added.
+    """
+
+    if profiler is None:
+        profiler = NULL_PROFILER
+    added = []
+    for (vadd, cv, CutOff) in proposals:
+        if CutOff < p:
+            GG.add_edge(vadd, cv)
+            added.append((vadd, cv))
+            profiler.count('edges_added')
+
+    return added
+
+
+def adapt_components(GG, Gprev, v, LC, node_attributes, p, ignore_equipment,
+                     profiler=None, random=random):
+    """
+    Give every component of GG that now lacks attributes a chance to adapt,
+    after v has been deleted: each proposed edge (see
+    adaptation_proposals()) is added with probability p.
+
+    GG is changed in place; the list of edges added is returned.  The
+    random numbers come from random, the random module by default.
+    """
+
+    return apply_proposals(GG, adaptation_proposals(GG, Gprev, v, LC, node_attributes,
+                                                    ignore_equipment, profiler, random),
+                           p, profiler)
+
+
 def intervention_adaptation_simulation(G, node_attributes, tar, badapt, p,
-                                       ignore_equipment):
+                                       ignore_equipment, cache=None,
+                                       profiler=None, trace=None, copy=True):
     """
     This simulation deletes a node chosen according to one of the strategies
     above.
@@ -441,8 +1046,8 @@ def intervention_adaptation_simulation(G, node_attributes, tar, badapt, p,
     G is a graph
     node_attributes is a list of [v, b1,.., b8] indicating whether a given
     attribute is present (as described above initialise_network())
-    tar indicates which targeting method is to be used:  There are now 14,
-    including no-adapt variations:
+    tar indicates which targeting method is to be used, a key of STRATEGIES.
+    There are now 14, including no-adapt variations:
 
      (0) cut set
      (1) max degree
@@ -459,133 +1064,150 @@ def intervention_adaptation_simulation(G, node_attributes, tar, badapt, p,
     (12) precursors no adapt
     (13) random no adapt
 
-    badapt is True if the network is allowed to adapt at each step
+    badapt is True if the network is allowed to adapt at each step, None to
+    follow the strategy (STRATEGIES[tar].adapt)
     i is the given number of the run (out of 100, for instance), used in the
     output file name
     p scales the probability that an edge is added between added vertices
     and each attribute-deficient component vertex
+    cache, if given, is a statecache.GraphStateCache (or a proxy for a
+    shared one) in which betweenness, degree orderings, components and
+    cutsets are memoised across steps and runs
+    profiler, if given, is a profiling.Profiler recording the time spent in
+    each phase of a step, and counts of what was done
+    trace, if given, is a traces.TraceRecorder to which the events of each
+    step (the deletion, the edges added and the nodes pruned) are handed,
+    so that the run can be replayed later without the targeting and
+    adaptation
+    copy False hands G over to the run, which deletes from it instead of
+    from a copy (G is left empty): for callers that build a graph for
+    each run anyway, as shared.run_task() does
+
+    The run is returned as the list S of step records
+    [v, betweenness centralisation, degree centralisation, nCC, Cmax],
+    one for each deletion; see simulation_steps() to consume them one at a
+    time instead.
+    """
+
+    return list(simulation_steps(G, node_attributes, tar, badapt, p,
+                                 ignore_equipment, cache, profiler, trace, copy))
+
+
+def simulation_steps(G, node_attributes, tar, badapt, p, ignore_equipment,
+                     cache=None, profiler=None, trace=None, copy=True):
     """
-    print "in simulation"
-    GG = G.copy()
-    S = []
-    cutset = {}
+    The simulation of intervention_adaptation_simulation(), as a generator
+    yielding one step record [v, betweenness centralisation, degree
+    centralisation, nCC, Cmax] at a time.  The arguments are the same.
+
+    Nothing is computed beyond the step last asked for, so a consumer that
+    stops early does not pay for the rest of the run.  For instance, the
+    steps until the largest component drops below 20 nodes are
+
+        itertools.takewhile(lambda step: step[4] >= 20, simulation_steps(..))
+
+    and the first k deletions are itertools.islice(simulation_steps(..), k).
+    """
+
+    if profiler is None:
+        profiler = NULL_PROFILER
+    profiler.set_strategy(tar)
+    profiler.begin_run()
+    profiler.count('runs')
+    if copy:
+        with profiler.phase('copy'):
+            GG = G.copy()
+    else:
+        (G, GG) = (None, G)
+    state = SimulationState(G, GG, node_attributes, ignore_equipment, cache,
+                            profiler)
+    strategy = STRATEGIES[tar](state)
+    if badapt is None:
+        badapt = strategy.adapt
     while GG.nodes() != []:
-        # Remove node v from G, using the indicated targeting method
-        # Find components and record v and components' centralization measures
-        # [and whatever other information that one might wish to add]
-        # The following is revolting but it has evolved this way.
-        if (tar == 0) or (tar == 10):
-            vS = cut_set_targeting(GG, cutset)
-            v = vS[0]
-            cutset = vS[1]
-        elif (tar == 1) or (tar == 6):
-            v = max_degree_targeting(GG)
-        elif (tar == 2) or (tar == 9):
-            v = max_betweenness_targeting(GG)
-        elif (tar == 3) or (tar == 11):
-            v = money_targeting(GG, node_attributes, ignore_equipment)
-        elif (tar == 4) or (tar == 13):
-            v = random_targeting(GG)
-        elif (tar == 5) or (tar == 12):
-            v = precursor_targeting(GG, node_attributes, ignore_equipment)
-        elif tar == 7:
-            if nx.number_of_nodes(GG) > nx.number_of_nodes(G)/2.0:
-                vS = cut_set_targeting(GG, cutset)
-                v = vS[0]
-                cutset = vS[1]
-            else:
-                v = max_degree_targeting(GG)
-        else:
-            # tar == 8:
-            if nx.number_of_nodes(GG) > nx.number_of_nodes(G)/2.0:
-                vS = cut_set_targeting(GG, cutset)
-                v = vS[0]
-                cutset = vS[1]
-            else:
-                v = max_betweenness_targeting(GG)
-        Gprev = GG.copy()
-        GG.remove_node(v)
-        LC = list(nx.connected_component_subgraphs(GG))
-        # If network is allowed to adapt (badapt = True),
-        # then for any component lacking attributes,
-        # find the vertices AddNodes with these missing attributes.
-        if badapt and (len(LC) > 1):
-            for CC in LC:
-                CCnodes = CC.nodes()
-                Att = calc_attributes(CCnodes, node_attributes, ignore_equipment)
-                # TEST!!
-                # Let's test what happens if we ignore the "Equipment"
-                # attribute
-                if len(Att) + ignore_equipment < 8:
-                    # print('adapt? Attributes = ', Att, 'nr nodes in component = ', len(CCnodes))
-                    # Try this: OK to adapt to vt if it replaces all missing
-                    # attributes, with the possible exception of equipment (4)
-                    AddNodes = [vt for vt in GG.nodes() if (vt not in CCnodes) and (len(set(Att + [j for j in range(1, 9) if node_attributes[vt-1][j] > 0])) + ignore_equipment == 8) and nx.has_path(Gprev, vt, CCnodes[0])]
-                    # Choose a vertex from AddNodes with probability
-                    # proportional to the inverse of the min distance to CC
-                    if AddNodes != []:
-                        distAll = {vtemp1: nx.single_source_shortest_path_length(Gprev, vtemp1) for vtemp1 in AddNodes}
-                        dminAll = {vtemp2: min([distAll[vtemp2][vv] for vv in CCnodes]) for vtemp2 in AddNodes}
-                        weightsCC = [1.0/dminAll[vtemp3] for vtemp3 in AddNodes]
-                        j = weighted_choice(weightsCC)
-                        vadd = AddNodes[j]
-                        # print('vertex to add = ', vadd, ', attributes ', calc_attributes([vadd], node_attributes))
-                        for cv in CCnodes:
-                            # only allow former neighbours of v to link to
-                            # vadd, and only with probability p
-                            CutOff = random.random()
-                            if (cv in Gprev.neighbors(v)):
-                                # print('?')
-                                if CutOff < p:
-                                    GG.add_edge(vadd, cv)
-                                    # for debugging purposes CSG 1.4.2016
-                                    # print("*")
-
-        # Now all ailing components have had a chance to adapt. Let's see if
-        # they have succeeded.
-        # Remove components that are too small or that still lack some
-        # attributes (i.e., their attempt to recover has failed)
-        # Calculate connected components again, since GG may have changed.
-        LC = list(nx.connected_component_subgraphs(GG))
-        # print('After adaptation, before pruning, now # components =',len(LC))
-        bad_vertices = []
-        for CC in LC:
-            CCnodes = CC.nodes()
-            Att = calc_attributes(CCnodes, node_attributes, ignore_equipment)
-
-            # TEST!!
-            # Let's test what happens if we ignore the "Equipment" attribute
-            # The component lacks some attributes
-            if len(Att) + ignore_equipment < 8:
-                bad_vertices = bad_vertices + CCnodes
-                # This may seem repetitive but it will also show what
-                # components are missing at the very last step of the
-                # simulation.
-                # print('Component of size',len(CCnodes),'now inactive, delete: attributes',Att)
-                # print('Components consisted of vertices',CCnodes)
-        if bad_vertices != []:
-            # Remove nodes bad_vertices from G
-            GG.remove_nodes_from(bad_vertices)
-            # We should also remove any bad_vertices nodes from the cutset,
-            # if we are doing cutset targeting
-            if (tar == 0) or (tar == 10):
-                for j in bad_vertices:
-                    cutset.discard(j)
-
-        # The tidy-up is finished now, so we can add the data from the current
-        # graph to the list
-        # Recalculate Cmax in case it has changed.
-        LC = list(nx.connected_component_subgraphs(GG))
-        nCC = nx.number_connected_components(GG)
-        if nCC > 1:
-          print('More than 1 component, actually ',nCC)
-        if LC == []:
-            Cmax = 0
-        else:
-            Cmax = max([len(Ctemp.nodes()) for Ctemp in LC])
-        S = S + [[v, betweenness_centralisation(GG), degree_centralisation(GG), nCC, Cmax]]
-
-    return S
+        (v, proposals) = begin_step(state, strategy, badapt)
+        yield finish_step(state, strategy, v, proposals, p, trace)
+
+
+def begin_step(state, strategy, badapt):
+    """
+    The first half of a step of simulation_steps(), up to the random draws
+    of adaptation: select and delete a node, and if badapt, draw the
+    adaptation proposals (see adaptation_proposals()).  Nothing here
+    depends on p.  Returns [v, proposals].
+    """
+
+    profiler = state.profiler
+    GG = state.GG
+    profiler.count('steps')
+    # Remove node v from G, using the indicated targeting method
+    # Find components and record v and components' centralization measures
+    # [and whatever other information that one might wish to add]
+    with profiler.phase('targeting'):
+        v = strategy.select(state)
+    if profiler.degraded:
+        # Over its memory budget (see memory.py), the run stops caching
+        state.cache = None
+    neighbours = GG.neighbors(v)
+    GG.remove_node(v)
+    strategy.on_node_removed(v, neighbours, state)
+    with profiler.phase('components'):
+        # (Views, not copies: only their nodes are used)
+        LC = list(nx.connected_component_subgraphs(GG, copy=False))
+    # If network is allowed to adapt (badapt = True),
+    # then for any component lacking attributes,
+    # find the vertices AddNodes with these missing attributes.
+    proposals = []
+    if badapt and (len(LC) > 1):
+        # The graph before the deletion, only needed here, so only rebuilt
+        # here rather than copied at every step
+        with profiler.phase('copy'):
+            Gprev = GG.copy()
+            Gprev.add_edges_from([(v, u) for u in neighbours])
+        with profiler.phase('adaptation'):
+            proposals = adaptation_proposals(GG, Gprev, v, LC, state.node_attributes,
+                                             state.ignore_equipment, profiler, state.random)
+
+    return [v, proposals]
+
+
+def finish_step(state, strategy, v, proposals, p, trace=None):
+    """
+    The second half of a step: add the proposed edges for p, prune, and
+    return the step record [v, betweenness centralisation, degree
+    centralisation, nCC, Cmax].
+    """
+
+    profiler = state.profiler
+    GG = state.GG
+    added = []
+    if proposals:
+        with profiler.phase('adaptation'):
+            added = apply_proposals(GG, proposals, p, profiler)
+    for (vadd, cv) in added:
+        strategy.on_edge_added(vadd, cv, state)
+
+    # Now all ailing components have had a chance to adapt. Let's see if
+    # they have succeeded.
+    with profiler.phase('pruning'):
+        bad_vertices = prune_inactive_components(GG, state.node_attributes,
+                                                 state.ignore_equipment, state.masks)
+    if bad_vertices:
+        profiler.count('nodes_pruned', len(bad_vertices))
+        strategy.on_pruned(bad_vertices, state)
+    if trace is not None:
+        trace.step(v, added, bad_vertices)
+
+    # The tidy-up is finished now, so we can add the data from the current
+    # graph to the list
+    with profiler.phase('metrics'):
+        measures = step_measures(GG, state.cache,
+                                 APPROXIMATE_SOURCES if profiler.degraded else None)
+    if measures[2] > 1:
+        # (used to be printed: 'More than 1 component, actually ')
+        profiler.count('multi_component_steps')
+
+    return [v] + measures
 
 
 def main():
@@ -610,23 +1232,29 @@ def main():
     # To ignore it, put 1 here.
     ignoreEquip = 0
 
+    # Betweenness, components and cutsets shared between runs
+    cache = GraphStateCache()
+
+    # Progress (strategy, runs done, rate and ETA) on the terminal, and
+    # rates, latencies and memory in sweep.prom (see telemetry.py)
+    from telemetry import Telemetry, TimedSteps
+    telemetry = Telemetry('sweep.prom', total=ntarget*nn)
+
 #    SS = [[0 for i in range(nn)] for tar in range(ntarget)]
 
     # Simulate for each targeting method, allowing adaptation
     for tar in range(ntarget):
-        # CSG 16.7.2015, added as a check that program is progressing
-#        print(OUTPUT_FILENAME_BY_TARGET[tar])
         for i in range(nn):
-            print('Run number ', i)
-
             # No-adaptation strategies
-            if tar in (6, 9, 10, 11, 12, 13):
+            if tar in NO_ADAPT_TARGETS:
                 adaptation = False
             else:
                 adaptation = True
 
-            RunValues = intervention_adaptation_simulation(
-                G, node_attributes, tar, adaptation, 0.5, ignoreEquip)
+            steps = TimedSteps(simulation_steps(
+                G, node_attributes, tar, adaptation, 0.5, ignoreEquip, cache))
+            RunValues = list(steps)
+            telemetry.observe_run(tar, steps.seconds, steps.step_seconds)
 
 #            # Adding zeros here makes averaging easier
 #            SS[tar][i] = RunValues + [[0, 0, 0, 0, 0] for j in range(padding)]
@@ -652,6 +1280,8 @@ def main():
     #nmaxglobal = [nmaxglobal1,nmaxglobal2,nmaxglobal3]
 #    nmaxglobal = [nmaxglobal1, nmaxglobal2]
 
+    telemetry.close()
+    print(cache.report())
     print("All good!")
 
     return 0
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Binary network snapshots, loaded by memory-mapping.
+
+Parsing a network file and relabelling it (see network.py) is paid by
+every process that starts a sweep, and on large synthetic networks it
+dominates short jobs.  compile_snapshot() does it once and writes the
+resulting arrays to a binary file; load_snapshot() maps that file into
+memory, so loading takes no time beyond reading a header, pages are only
+read when touched, and all processes on a host that load the same
+snapshot share one copy of them.
+
+File layout (all integers little-endian):
+
+  header    magic b'CNETSNAP', format version (u4), n, m, duplicate_edges
+            (u8 each), then for each section its offset and length in
+            bytes (u8 each), then the 32 byte BLAKE2b hash of the sections
+  sections  each starting at a multiple of ALIGNMENT bytes:
+              offsets  (n+1,) int64   CSR offsets
+              indices  (2m,)  int32   CSR neighbour indices
+              masks    (n,)   uint8   attribute bitmasks
+              ids      (n,)   int64   original node IDs, increasing
+              edges    (m, 2) int32   undirected edges, i < j, sorted
+
+The arrays are those of a network.Network, so a loaded snapshot is a
+Network whose arrays are read-only views of the mapped file.
+load_network() recognises snapshots by their magic, so
+initialise_network() takes either a network file or a snapshot.
+
+Usage: python snapshot.py compile criminal.txt criminal.snap
+       python snapshot.py info criminal.snap [--verify]
+"""
+
+import sys
+import struct
+import hashlib
+
+import numpy as np
+
+from network import Network, NetworkError, load_network
+
+
+MAGIC = b'CNETSNAP'
+VERSION = 1
+ALIGNMENT = 64
+
+# (name, dtype) of the sections, in file order
+SECTIONS = [('offsets', np.dtype('<i8')),
+            ('indices', np.dtype('<i4')),
+            ('masks', np.dtype('u1')),
+            ('ids', np.dtype('<i8')),
+            ('edges', np.dtype('<i4'))]
+
+_HEADER = struct.Struct('<8sIQQQ' + 'QQ'*len(SECTIONS) + '32s')
+
+
+class SnapshotError(NetworkError):
+    pass
+
+
+def _section_arrays(network):
+    (offsets, indices) = network.csr()
+
+    return {'offsets': offsets, 'indices': indices, 'masks': network.masks,
+            'ids': network.ids, 'edges': network.edges}
+
+
+def _aligned(position):
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+def snapshot_layout(network):
+    """
+    [header, blobs, size] for a snapshot of the Network network: the packed
+    header, the list of [offset, bytes] of the sections and the total size
+    in bytes.
+    """
+
+    arrays = _section_arrays(network)
+    blobs = []
+    table = []
+    position = _aligned(_HEADER.size)
+    digest = hashlib.blake2b(digest_size=32)
+    for (name, dtype) in SECTIONS:
+        blob = np.ascontiguousarray(arrays[name], dtype=dtype).tobytes()
+        digest.update(blob)
+        blobs.append([position, blob])
+        table.extend([position, len(blob)])
+        position += len(blob)
+        if name != SECTIONS[-1][0]:
+            position = _aligned(position)
+
+    header = _HEADER.pack(MAGIC, VERSION, network.n, network.m,
+                          network.duplicate_edges, *(table + [digest.digest()]))
+
+    return [header, blobs, position]
+
+
+def compile_snapshot(network, filename):
+    """
+    Write the Network network to filename as a snapshot, and return the hex
+    digest of its content hash.
+    """
+
+    (header, blobs, size) = snapshot_layout(network)
+    f = open(filename, 'wb')
+    f.write(header)
+    for (start, blob) in blobs:
+        f.write(b'\0' * (start - f.tell()))
+        f.write(blob)
+    f.close()
+
+    return _HEADER.unpack(header)[-1].hex()
+
+
+def parse_header(raw, source='snapshot'):
+    """
+    The header of a snapshot, given its first bytes, as a dict with
+    version, n, m, duplicate_edges, sections ({name: [offset, length]}) and
+    hash (hex).  Raises SnapshotError if it is not a snapshot this code can
+    read; source names it in the message.
+    """
+
+    raw = bytes(raw[:_HEADER.size])
+    if len(raw) < _HEADER.size or raw[:len(MAGIC)] != MAGIC:
+        raise SnapshotError("%s is not a network snapshot" % source)
+    fields = _HEADER.unpack(raw)
+    if fields[1] != VERSION:
+        raise SnapshotError("%s has snapshot version %d, expected %d"
+                            % (source, fields[1], VERSION))
+    table = fields[5:-1]
+    sections = {}
+    for (k, (name, dtype)) in enumerate(SECTIONS):
+        sections[name] = [table[2*k], table[2*k+1]]
+
+    return {'version': fields[1], 'n': fields[2], 'm': fields[3],
+            'duplicate_edges': fields[4], 'sections': sections,
+            'hash': fields[-1].hex()}
+
+
+def read_header(filename):
+    f = open(filename, 'rb')
+    raw = f.read(_HEADER.size)
+    f.close()
+
+    return parse_header(raw, filename)
+
+
+def network_from_buffer(data, source='snapshot', verify=False):
+    """
+    The Network stored in data, a uint8 array holding a snapshot (a mapped
+    file or a block of shared memory), its arrays read-only views of data.
+    With verify True, every section is read and its content hash checked.
+    """
+
+    header = parse_header(data, source)
+    (n, m) = (header['n'], header['m'])
+    shapes = {'offsets': (n+1,), 'indices': (2*m,), 'masks': (n,),
+              'ids': (n,), 'edges': (m, 2)}
+
+    arrays = {}
+    digest = hashlib.blake2b(digest_size=32)
+    for (name, dtype) in SECTIONS:
+        (start, length) = header['sections'][name]
+        if length != dtype.itemsize * int(np.prod(shapes[name])) or start + length > len(data):
+            raise SnapshotError("%s: section %s is truncated or inconsistent"
+                                % (source, name))
+        arrays[name] = data[start:start+length].view(dtype).reshape(shapes[name])
+        arrays[name].flags.writeable = False
+        if verify:
+            digest.update(arrays[name].tobytes())
+    if verify and digest.hexdigest() != header['hash']:
+        raise SnapshotError("%s: content hash mismatch" % source)
+
+    network = Network(arrays['ids'], arrays['edges'], arrays['masks'],
+                      header['duplicate_edges'])
+    network._csr = (arrays['offsets'], arrays['indices'])
+
+    return network
+
+
+def load_snapshot(filename, verify=False):
+    """
+    The Network stored in a snapshot, its arrays read-only views of the
+    memory-mapped file.  With verify True, every section is read and its
+    content hash checked (which touches every page).
+    """
+
+    return network_from_buffer(np.memmap(filename, dtype=np.uint8, mode='r'),
+                               filename, verify)
+
+
+def is_snapshot(filename):
+    f = open(filename, 'rb')
+    magic = f.read(len(MAGIC))
+    f.close()
+
+    return magic == MAGIC
+
+
+def main(argv):
+    if len(argv) == 4 and argv[1] == 'compile':
+        network = load_network(argv[2])
+        digest = compile_snapshot(network, argv[3])
+        print('%d nodes, %d edges written to %s (hash %s)'
+              % (network.n, network.m, argv[3], digest))
+        return 0
+
+    if len(argv) in (3, 4) and argv[1] == 'info':
+        header = read_header(argv[2])
+        print('version %d: %d nodes, %d edges, %d duplicate edges merged'
+              % (header['version'], header['n'], header['m'], header['duplicate_edges']))
+        for (name, dtype) in SECTIONS:
+            print('  %-8s offset %10d, %12d bytes' % ((name,) + tuple(header['sections'][name])))
+        print('hash %s' % header['hash'])
+        if argv[3:] == ['--verify']:
+            load_snapshot(argv[2], verify=True)
+            print('content hash verified')
+        return 0
+
+    print('Usage: python snapshot.py compile NETWORK_FILE SNAPSHOT')
+    print('       python snapshot.py info SNAPSHOT [--verify]')
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A memo table for the expensive per-state results of the simulation.
+
+Many runs of the same strategy pass through identical intermediate graphs
+(early on, and all the way along for the no-adapt strategies), and each
+time they recompute betweenness, degree orderings, components and
+cutsets from scratch.  GraphStateCache stores these results keyed by a
+canonical fingerprint of the graph: the sorted node list and the sorted
+edge list, hashed.  It is bounded, evicting the least recently used
+entry, and counts hits and misses for each kind of result so that we can
+see where the savings come from.
+
+The kinds of result stored are
+
+  'betweenness'  the (unnormalised) betweenness dict of a graph
+  'degrees'      the (node, degree) list in decreasing order of degree
+  'components'   the list of node lists of the connected components
+  'cutpair'      the pair (uu, vv) chosen by cut_set_targeting in a
+                 component, with its neighbourhood product and the
+                 highest degree node of the component
+  'cutset'       the minimum node cut separating a given (uu, vv)
+
+To share one table between worker processes, start a CacheManager and
+hand its GraphStateCache proxy to the workers (see shared_cache()).
+"""
+
+import hashlib
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+
+
+def graph_fingerprint(H):
+    """
+    A canonical fingerprint of the graph H: two graphs have the same
+    fingerprint exactly when they have the same nodes and the same edges
+    (up to hash collisions, which at 128 bits we ignore).
+    """
+
+    nodes = sorted(H.nodes())
+    edges = sorted([(u, v) if u <= v else (v, u) for (u, v) in H.edges_iter()])
+
+    return hashlib.blake2b(repr((nodes, edges)).encode('ascii'),
+                           digest_size=16).hexdigest()
+
+
+class GraphStateCache(object):
+    """
+    A bounded least-recently-used table of per-state results, with hit and
+    miss counts for each kind of result.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.table = OrderedDict()
+        self.hits = {}
+        self.misses = {}
+        self.evictions = 0
+
+    def get(self, kind, key):
+        """
+        The stored result of the given kind for key, or None.
+        """
+
+        try:
+            value = self.table[(kind, key)]
+        except KeyError:
+            self.misses[kind] = self.misses.get(kind, 0) + 1
+            return None
+        self.table.move_to_end((kind, key))
+        self.hits[kind] = self.hits.get(kind, 0) + 1
+
+        return value
+
+    def put(self, kind, key, value):
+        self.table[(kind, key)] = value
+        self.table.move_to_end((kind, key))
+        while len(self.table) > self.maxsize:
+            self.table.popitem(last=False)
+            self.evictions += 1
+
+    def size(self):
+        return len(self.table)
+
+    def stats(self):
+        """
+        {kind: [hits, misses]} for every kind looked up so far.
+        """
+
+        kinds = set(self.hits.keys()) | set(self.misses.keys())
+
+        return dict([(kind, [self.hits.get(kind, 0), self.misses.get(kind, 0)])
+                     for kind in kinds])
+
+    def report(self):
+        """
+        A plain text table of hit rates by kind of result.
+        """
+
+        lines = ['%-12s %10s %10s %8s' % ('kind', 'hits', 'misses', 'rate')]
+        stats = self.stats()
+        for kind in sorted(stats.keys()):
+            (hits, misses) = stats[kind]
+            lines.append('%-12s %10d %10d %7.1f%%' % (
+                kind, hits, misses, 100.0*hits/max(hits + misses, 1)))
+        lines.append('%d entries (at most %d), %d evicted' % (
+            len(self.table), self.maxsize, self.evictions))
+
+        return '\n'.join(lines)
+
+
+def cached(cache, kind, H, compute, extra=None):
+    """
+    Look up the result of the given kind for the graph H (and, if given,
+    the extra key such as a pair of nodes) in cache, calling compute() and
+    storing its result on a miss.  With cache None this is just compute(),
+    and no fingerprint is taken.
+    """
+
+    if cache is None:
+        return compute()
+    key = graph_fingerprint(H)
+    if extra is not None:
+        key = (key, extra)
+    value = cache.get(kind, key)
+    if value is None:
+        value = compute()
+        cache.put(kind, key, value)
+
+    return value
+
+
+class CacheManager(BaseManager):
+    pass
+
+
+CacheManager.register('GraphStateCache', GraphStateCache)
+
+
+def shared_cache(maxsize=100000):
+    """
+    Start a CacheManager serving one GraphStateCache, and return
+    [manager, proxy].  The proxy can be passed to worker processes (for
+    instance as an argument of Pool.map) and used wherever a cache is
+    expected; call manager.shutdown() when the sweep is over.
+    """
+
+    manager = CacheManager()
+    manager.start()
+
+    return [manager, manager.GraphStateCache(maxsize)]
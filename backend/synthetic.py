@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic criminal-network-like graphs of any size, for scaling tests.
+
+initialise_network() can only load criminal.txt, so to see how the
+strategies (and our own infrastructure) behave on 10k-1M node networks we
+generate networks that resemble it:
+
+ - degrees are drawn from the degree distribution of the loaded network;
+ - clustering is matched by putting a fraction q of the nodes into small
+   cliques, sized by their degree, and wiring all other edges at random
+   across the whole network as in a configuration model.  q is calibrated
+   on instances the size of the loaded network so that the average
+   clustering coefficient matches it;
+ - the 8 attribute bits of each node are drawn as one pattern from the
+   patterns of the loaded network with their observed frequencies, so
+   both the marginal frequency of each attribute and the joint
+   frequencies (which attributes occur together) are matched.
+
+Everything is done on NumPy arrays, so a million-node network takes a few
+seconds.  Self-loops and repeated edges are dropped, so degrees come out
+slightly below the drawn ones for the largest hubs.
+
+The result is written in the same format as criminal.txt (ID1, ID2 and
+node_attributes, with nodes numbered from 1), so initialise_network() can
+read it:
+
+    python synthetic.py N output.txt [--seed S] [--source criminal.txt]
+"""
+
+import sys
+import json
+import argparse
+
+import numpy as np
+import networkx as nx
+
+from simple import initialise_network
+from network import Network
+
+
+# Largest clique used to build the local structure
+MAX_CLIQUE = 6
+
+
+def network_profile(G, node_attributes):
+    """
+    The statistics of G and node_attributes that generate() matches:
+    the degree sequence, the average clustering coefficient, and the
+    attribute patterns (as 8-bit codes, bit j-1 for attribute j) with their
+    frequencies.
+    """
+
+    nodes = sorted(G.nodes())
+    degrees = np.array([G.degree(v) for v in nodes], dtype=np.int64)
+    bits = np.array([row[1:9] for row in node_attributes], dtype=np.uint8)
+    codes = bits_to_codes(bits)
+    (patterns, counts) = np.unique(codes, return_counts=True)
+
+    return {'degrees': degrees,
+            'clustering': nx.average_clustering(G),
+            'patterns': patterns,
+            'frequencies': counts/float(counts.sum())}
+
+
+def bits_to_codes(bits):
+    """
+    Rows of 8 attribute bits to 8-bit codes.
+    """
+
+    return (bits.astype(np.uint8) << np.arange(8, dtype=np.uint8)).sum(axis=1).astype(np.uint8)
+
+
+def codes_to_bits(codes):
+    """
+    8-bit codes back to rows of 8 attribute bits.
+    """
+
+    return ((codes[:, None] >> np.arange(8, dtype=np.uint8)) & 1).astype(np.uint8)
+
+
+def generate_edges(n, profile, q, rng):
+    """
+    The (m, 2) edge array (nodes numbered 0..n-1) of a synthetic network on
+    n nodes.
+
+    Each node draws a degree k from the profile.  With probability q it
+    joins a clique of min(k, MAX_CLIQUE-1) + 1 nodes, formed with other
+    nodes wanting a clique of the same size; its remaining edges (all of
+    them, if it joins no clique) are single edges, wired at random as in a
+    configuration model.  This gives the low degree nodes the near-complete
+    neighbourhoods seen in criminal.txt, and the hubs low clustering.
+    """
+
+    degrees = rng.choice(profile['degrees'], size=n)
+    size = np.minimum(degrees, MAX_CLIQUE-1) + 1
+    size[(rng.random(n) >= q) | (degrees < 2)] = 0
+
+    # Group the nodes wanting cliques of each size into consecutive blocks
+    # of that size; a short block left over at the end is dropped
+    edges = []
+    joined = np.zeros(n, dtype=bool)
+    for s in range(3, MAX_CLIQUE+1):
+        members = rng.permutation(np.flatnonzero(size == s))
+        members = members[:len(members) - len(members) % s].reshape(-1, s)
+        joined[members.ravel()] = True
+        for i in range(s):
+            for j in range(i+1, s):
+                edges.append(members[:, [i, j]])
+    singles = degrees - np.where(joined, size - 1, 0)
+
+    stubs = rng.permutation(np.repeat(np.arange(n), singles))
+    edges.append(stubs[:len(stubs) - len(stubs) % 2].reshape(-1, 2))
+    edges = np.concatenate(edges)
+
+    # Drop self-loops and repeated edges
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    edges = np.sort(edges, axis=1)
+    keys = np.unique(edges[:, 0].astype(np.int64)*n + edges[:, 1])
+
+    return np.column_stack((keys // n, keys % n))
+
+
+def generate_attributes(n, profile, rng):
+    """
+    The (n, 8) array of attribute bits for n synthetic nodes.
+    """
+
+    codes = rng.choice(profile['patterns'], size=n, p=profile['frequencies'])
+
+    return codes_to_bits(codes)
+
+
+def calibrate(profile, seed, steps=12):
+    """
+    Find q so that the average clustering of generated networks the size of
+    the profiled one matches the profile, by bisection.
+    """
+
+    n = len(profile['degrees'])
+    (low, high) = (0.0, 1.0)
+    for i in range(steps):
+        q = (low + high)/2.0
+        # Average over a few instances: small graphs are noisy
+        values = []
+        for r in range(4):
+            rng = np.random.default_rng([seed, i, r])
+            G = nx.Graph()
+            G.add_nodes_from(range(n))
+            G.add_edges_from(generate_edges(n, profile, q, rng).tolist())
+            values.append(nx.average_clustering(G))
+        if np.mean(values) < profile['clustering']:
+            low = q
+        else:
+            high = q
+
+    return (low + high)/2.0
+
+
+def generate(n, profile, seed, q=None):
+    """
+    A synthetic network on n nodes matching profile (see network_profile()),
+    with a fraction q of the nodes in cliques.
+
+    Returns [edges, bits]: the (m, 2) array of edges, nodes numbered 0..n-1,
+    and the (n, 8) array of attribute bits.  If q is None it is calibrated
+    first.
+    """
+
+    if q is None:
+        q = calibrate(profile, seed)
+    rng = np.random.default_rng(seed)
+
+    return [generate_edges(n, profile, q, rng), generate_attributes(n, profile, rng)]
+
+
+def to_data(edges, bits):
+    """
+    The network as a dict in the format of criminal.txt, nodes numbered
+    from 1.
+    """
+
+    ids = np.arange(1, len(bits)+1)
+    rows = np.column_stack((ids, bits)).tolist()
+
+    return {'ID1': (edges[:, 0] + 1).tolist(), 'ID2': (edges[:, 1] + 1).tolist(),
+            'node_attributes': rows}
+
+
+def to_network(edges, bits):
+    """
+    The network as a network.Network, node IDs 1..n.
+    """
+
+    n = len(bits)
+
+    return Network(np.arange(1, n+1), edges.astype(np.int32), bits_to_codes(bits))
+
+
+def to_graph(edges, bits):
+    """
+    The network as a graph on nodes 1..n and a node_attributes list, as
+    initialise_network() would return it.
+    """
+
+    network = to_network(edges, bits)
+
+    return (network.to_graph(), network.node_attributes())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate a synthetic network')
+    parser.add_argument('n', type=int)
+    parser.add_argument('output')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--source', default='criminal.txt')
+    parser.add_argument('--q', type=float, default=None,
+                        help='fraction of nodes put into cliques (default: calibrate)')
+    args = parser.parse_args(argv[1:])
+
+    (G, node_attributes) = initialise_network(args.source)
+    profile = network_profile(G, node_attributes)
+    (edges, bits) = generate(args.n, profile, args.seed, args.q)
+
+    f = open(args.output, 'w')
+    json.dump(to_data(edges, bits), f)
+    f.close()
+    print('%d nodes, %d edges written to %s' % (args.n, len(edges), args.output))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Throughput telemetry for sweeps of many runs.
+
+A Telemetry object is told about each finished run (observe_run()) and
+keeps, for each strategy, the number of runs and steps and histograms of
+the run and step latencies, together with the busy time of the workers
+and the memory high-water marks of the process and its children.  While
+the sweep goes on, a background thread
+
+  - rewrites a metrics file in the Prometheus text exposition format
+    every interval seconds (written to a temporary file and renamed, so a
+    reader never sees half of it), which node_exporter's textfile
+    collector or a plain `cat` can pick up, and
+  - redraws a one-line progress view on the terminal: the strategy being
+    run, runs done, rate and ETA.
+
+The metrics (all prefixed sweep_):
+
+  runs_total, steps_total                counters, by strategy
+  run_seconds, step_seconds              histograms, by strategy
+  strategy_runs_per_second               runs per busy second, by strategy
+  runs_per_second                        runs per second of wall time
+  runs_expected, eta_seconds             if the total is known
+  worker_utilisation                     busy time / (wall time x workers)
+  memory_max_bytes                       by process (main, workers)
+  start_time_seconds, last_progress_time_seconds
+                                         a stalled sweep shows as a
+                                         growing gap between the latter
+                                         and the time of the file
+
+    telemetry = Telemetry('sweep.prom', total=1400)
+    ...
+    telemetry.observe_run(tar, seconds, step_seconds)
+    ...
+    telemetry.close()
+"""
+
+import os
+import sys
+import time
+import bisect
+import resource
+import threading
+
+from simple import OUTPUT_FILENAME_BY_TARGET
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+RUN_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 150, 300]
+STEP_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+INTERVAL = 5.0
+
+
+class Histogram(object):
+    """
+    Counts of observations by bucket, with their sum, as Prometheus
+    histograms have them.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, x):
+        self.counts[bisect.bisect_left(self.bounds, x)] += 1
+        self.sum += x
+        self.count += 1
+
+    def exposition(self, name, labels):
+        lines = []
+        cumulative = 0
+        for (bound, count) in zip(self.bounds + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+        lines.append('%s_sum{%s} %.6f' % (name, labels, self.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, self.count))
+
+        return lines
+
+
+class Telemetry(object):
+    """
+    Telemetry of one sweep (see above).  filename None skips the metrics
+    file, progress False the terminal view; workers is the number of
+    processes running the runs.
+    """
+
+    def __init__(self, filename='sweep.prom', total=None, workers=1,
+                 interval=INTERVAL, progress=True, stream=None):
+        self.filename = filename
+        self.total = total
+        self.workers = workers
+        self.interval = interval
+        self.progress = progress
+        self.stream = stream if stream is not None else sys.stderr
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_progress = self.start
+        self.strategies = {}
+        self.runs = 0
+        self.busy = 0.0
+        self.current = None
+        self.worker_memory = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _strategy(self, tar):
+        entry = self.strategies.get(tar)
+        if entry is None:
+            entry = self.strategies[tar] = {'runs': 0, 'steps': 0, 'busy': 0.0,
+                                            'run_seconds': Histogram(RUN_BUCKETS),
+                                            'step_seconds': Histogram(STEP_BUCKETS)}
+        return entry
+
+    def observe_run(self, tar, seconds, step_seconds=(), steps=None, worker_memory=None):
+        """
+        Record a finished run of strategy tar that took seconds, with the
+        latencies of its steps if known (otherwise its number of steps),
+        and the memory high-water mark in bytes of the worker that ran it.
+        """
+
+        with self.lock:
+            entry = self._strategy(tar)
+            entry['runs'] += 1
+            entry['busy'] += seconds
+            entry['run_seconds'].observe(seconds)
+            for x in step_seconds:
+                entry['step_seconds'].observe(x)
+            entry['steps'] += len(step_seconds) if steps is None else steps
+            self.runs += 1
+            self.busy += seconds
+            self.current = tar
+            self.last_progress = time.time()
+            if worker_memory is not None:
+                self.worker_memory = max(self.worker_memory, worker_memory)
+
+    def eta(self):
+        if not self.total or self.runs == 0:
+            return None
+        return (time.time() - self.start) * (self.total - self.runs) / self.runs
+
+    def exposition(self):
+        """
+        The metrics, in the Prometheus text format.
+        """
+
+        with self.lock:
+            now = time.time()
+            elapsed = max(now - self.start, 1e-9)
+            lines = []
+
+            def header(name, kind, text):
+                lines.append('# HELP sweep_%s %s' % (name, text))
+                lines.append('# TYPE sweep_%s %s' % (name, kind))
+
+            strategies = [(tar, 'strategy="%s"' % OUTPUT_FILENAME_BY_TARGET[tar], self.strategies[tar])
+                          for tar in sorted(self.strategies)]
+            header('runs_total', 'counter', 'Runs finished.')
+            for (tar, labels, entry) in strategies:
+                lines.append('sweep_runs_total{%s} %d' % (labels, entry['runs']))
+            header('steps_total', 'counter', 'Deletion steps of the runs finished.')
+            for (tar, labels, entry) in strategies:
+                lines.append('sweep_steps_total{%s} %d' % (labels, entry['steps']))
+            header('run_seconds', 'histogram', 'Wall time of a run.')
+            for (tar, labels, entry) in strategies:
+                lines.extend(entry['run_seconds'].exposition('sweep_run_seconds', labels))
+            header('step_seconds', 'histogram', 'Wall time of a deletion step.')
+            for (tar, labels, entry) in strategies:
+                if entry['step_seconds'].count > 0:
+                    lines.extend(entry['step_seconds'].exposition('sweep_step_seconds', labels))
+            header('strategy_runs_per_second', 'gauge', 'Runs per second of busy worker time.')
+            for (tar, labels, entry) in strategies:
+                lines.append('sweep_strategy_runs_per_second{%s} %.6f'
+                             % (labels, entry['runs'] / max(entry['busy'], 1e-9)))
+            header('runs_per_second', 'gauge', 'Runs per second of wall time.')
+            lines.append('sweep_runs_per_second %.6f' % (self.runs / elapsed))
+            if self.total:
+                header('runs_expected', 'gauge', 'Runs in the sweep.')
+                lines.append('sweep_runs_expected %d' % self.total)
+                eta = self.eta()
+                if eta is not None:
+                    header('eta_seconds', 'gauge', 'Estimated time to the end of the sweep.')
+                    lines.append('sweep_eta_seconds %.1f' % eta)
+            header('worker_utilisation', 'gauge', 'Busy time over wall time of the workers.')
+            lines.append('sweep_worker_utilisation %.4f' % (self.busy / (elapsed * self.workers)))
+            header('memory_max_bytes', 'gauge', 'Resident memory high-water mark.')
+            lines.append('sweep_memory_max_bytes{process="main"} %d'
+                         % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+            workers = max(self.worker_memory,
+                          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+            if workers > 0:
+                lines.append('sweep_memory_max_bytes{process="workers"} %d' % workers)
+            header('start_time_seconds', 'gauge', 'Start of the sweep, in seconds since the epoch.')
+            lines.append('sweep_start_time_seconds %.3f' % self.start)
+            header('last_progress_time_seconds', 'gauge', 'Time the last run finished.')
+            lines.append('sweep_last_progress_time_seconds %.3f' % self.last_progress)
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        if self.filename is None:
+            return
+        with open(self.filename + '.tmp', 'w') as f:
+            f.write(self.exposition())
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def status(self):
+        """
+        The one-line progress view.
+        """
+
+        with self.lock:
+            elapsed = max(time.time() - self.start, 1e-9)
+            name = OUTPUT_FILENAME_BY_TARGET[self.current] if self.current is not None else '-'
+            entry = self.strategies.get(self.current)
+            done = '%d' % self.runs
+            if self.total:
+                done = '%d/%d' % (self.runs, self.total)
+            line = '%-26s %3d runs | %s runs, %.2f runs/s' % (
+                name, entry['runs'] if entry else 0, done, self.runs / elapsed)
+        eta = self.eta()
+        if eta is not None:
+            line += ', ETA %d:%02d:%02d' % (eta // 3600, eta % 3600 // 60, eta % 60)
+
+        return line
+
+    def show(self, final=False):
+        if not self.progress:
+            return
+        if self.stream.isatty():
+            self.stream.write('\r\x1b[K' + self.status() + ('\n' if final else ''))
+        else:
+            self.stream.write(self.status() + '\n')
+        self.stream.flush()
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+            self.show()
+
+    def close(self):
+        """
+        Stop the background thread and write the final metrics.
+        """
+
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        self.show(final=True)
+
+
+class TimedSteps(object):
+    """
+    Iterates over a simulation_steps() generator, timing each step;
+    seconds and step_seconds are set once it is exhausted.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.step_seconds = []
+
+    def __iter__(self):
+        # The time the consumer spends between steps is not counted
+        last = time.perf_counter()
+        for step in self.steps:
+            self.step_seconds.append(time.perf_counter() - last)
+            yield step
+            last = time.perf_counter()
+        self.seconds = sum(self.step_seconds)
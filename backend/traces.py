@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compact traces of simulation runs, and metrics computed by replaying them.
+
+A run of intervention_adaptation_simulation() is fully determined by its
+events: the node deleted at each step, the edges adaptation added and the
+nodes pruned.  Handed a TraceRecorder, the simulation reports these, and
+the recorder encodes them; replay() rebuilds the graph after each step
+from a trace alone, with no targeting and no adaptation search, so any
+measure of the graph states of a corpus of runs can be computed long
+after the runs were made.  The measures are computed lazily: only those
+asked for, and only up to the step a consumer stops at.
+
+    corpus = TraceWriter('runs.trace', network)
+    recorder = TraceRecorder(tar, badapt, p, ignore_equipment)
+    intervention_adaptation_simulation(G, node_attributes, tar, badapt, p,
+                                       ignore_equipment, trace=recorder)
+    corpus.write(recorder)
+
+    for trace in read_traces('runs.trace', network):
+        for row in replay_metrics(G, trace, ['nCC', 'Cmax']): ..
+
+replay_parallel() replays a whole trace file on a pool of processes
+sharing the network (see shared.py).
+
+File layout (integers are unsigned LEB128 varints unless noted):
+
+  header    magic b'CNETTRAC', format version, n, m, then the 16 byte
+            BLAKE2b hash of the network's edges and attribute masks
+  records   each its length in bytes followed by:
+              tar, flags (1 adaptation, 2 ignore_equipment), p (<f8),
+              the number of steps, then for each step
+                v                        zigzag delta from the previous v
+                number of edges added, then each edge (vadd, cv) as
+                                         two zigzag deltas from v
+                number of nodes pruned, then the nodes in increasing
+                                         order as gaps from the previous
+
+Nodes are labelled 1..n, as in the simulation.  On the criminal network
+a step takes about 8 bytes, most of them the nodes pruned; 280 runs (20
+of each strategy) make a 57 kB file, and replaying them for nCC, Cmax and
+density takes a second where recording them took five minutes.
+
+Usage: python traces.py record NN TRACE_FILE [network_file] [processes]
+       python traces.py replay TRACE_FILE METRIC[,METRIC..] [network_file] [processes]
+       python traces.py info TRACE_FILE
+"""
+
+import sys
+import time
+import struct
+import random
+import hashlib
+from multiprocessing import Pool
+
+import networkx as nx
+
+from network import NetworkError, load_network
+from simple import (intervention_adaptation_simulation, component_nodes,
+                    betweenness_centralisation, degree_centralisation,
+                    NO_ADAPT_TARGETS, OUTPUT_FILENAME_BY_TARGET)
+import shared
+
+
+MAGIC = b'CNETTRAC'
+VERSION = 1
+
+ADAPT = 1
+IGNORE_EQUIPMENT = 2
+
+_P = struct.Struct('<d')
+
+
+class TraceError(NetworkError):
+    pass
+
+
+# Varints
+
+def encode_varint(k, out):
+    while k >= 0x80:
+        out.append((k & 0x7F) | 0x80)
+        k >>= 7
+    out.append(k)
+
+
+def decode_varint(data, position):
+    """
+    [value, position after it] of the varint at position in data.
+    """
+
+    k = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[position]
+        except IndexError:
+            raise TraceError("Truncated trace")
+        position += 1
+        k |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return [k, position]
+        shift += 7
+
+
+def zigzag(k):
+    return 2*k if k >= 0 else -2*k - 1
+
+
+def unzigzag(k):
+    return k >> 1 if k & 1 == 0 else -((k + 1) >> 1)
+
+
+def network_digest(network):
+    """
+    The hash identifying the network a trace was recorded on.
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(network.edges.tobytes())
+    digest.update(network.masks.tobytes())
+
+    return digest.digest()
+
+
+# Recording
+
+class TraceRecorder(object):
+    """
+    Encodes the events of one run as the simulation reports them (through
+    step()).
+    """
+
+    def __init__(self, tar, badapt, p, ignore_equipment):
+        self.tar = tar
+        self.badapt = badapt
+        self.p = p
+        self.ignore_equipment = ignore_equipment
+        self.steps = 0
+        self.body = bytearray()
+        self.previous = 0
+
+    def step(self, v, added, pruned):
+        out = self.body
+        encode_varint(zigzag(v - self.previous), out)
+        self.previous = v
+        encode_varint(len(added), out)
+        for (vadd, cv) in added:
+            encode_varint(zigzag(vadd - v), out)
+            encode_varint(zigzag(cv - v), out)
+        encode_varint(len(pruned), out)
+        last = 0
+        for u in sorted(pruned):
+            encode_varint(u - last, out)
+            last = u
+        self.steps += 1
+
+    def payload(self):
+        """
+        The encoded record (without its length).
+        """
+
+        out = bytearray()
+        encode_varint(self.tar, out)
+        out.append((ADAPT if self.badapt else 0)
+                   | (IGNORE_EQUIPMENT if self.ignore_equipment else 0))
+        out += _P.pack(self.p)
+        encode_varint(self.steps, out)
+        out += self.body
+
+        return bytes(out)
+
+
+class Trace(object):
+    """
+    A decoded record: the parameters of the run and its list of steps
+    [v, added, pruned].
+    """
+
+    def __init__(self, tar, badapt, p, ignore_equipment, steps):
+        self.tar = tar
+        self.badapt = badapt
+        self.p = p
+        self.ignore_equipment = ignore_equipment
+        self.steps = steps
+
+
+def decode_trace(payload):
+    (tar, position) = decode_varint(payload, 0)
+    flags = payload[position]
+    p = _P.unpack_from(payload, position + 1)[0]
+    (nsteps, position) = decode_varint(payload, position + 1 + _P.size)
+    steps = []
+    v = 0
+    for i in range(nsteps):
+        (delta, position) = decode_varint(payload, position)
+        v += unzigzag(delta)
+        (k, position) = decode_varint(payload, position)
+        added = []
+        for j in range(k):
+            (a, position) = decode_varint(payload, position)
+            (b, position) = decode_varint(payload, position)
+            added.append((v + unzigzag(a), v + unzigzag(b)))
+        (k, position) = decode_varint(payload, position)
+        pruned = []
+        u = 0
+        for j in range(k):
+            (gap, position) = decode_varint(payload, position)
+            u += gap
+            pruned.append(u)
+        steps.append([v, added, pruned])
+    if position != len(payload):
+        raise TraceError("Trailing bytes in a trace record")
+
+    return Trace(tar, bool(flags & ADAPT), p, 1 if flags & IGNORE_EQUIPMENT else 0, steps)
+
+
+# Trace files
+
+class TraceWriter(object):
+    """
+    Appends records to a trace file of the Network network.
+    """
+
+    def __init__(self, filename, network):
+        self.file = open(filename, 'wb')
+        header = bytearray(MAGIC)
+        encode_varint(VERSION, header)
+        encode_varint(network.n, header)
+        encode_varint(network.m, header)
+        header += network_digest(network)
+        self.file.write(header)
+        self.records = 0
+
+    def write(self, record):
+        """
+        Append a record, given as a TraceRecorder or its payload.
+        """
+
+        if isinstance(record, TraceRecorder):
+            record = record.payload()
+        length = bytearray()
+        encode_varint(len(record), length)
+        self.file.write(length)
+        self.file.write(record)
+        self.records += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def read_header(data, filename='trace'):
+    """
+    [header, position of the first record] of the contents of a trace file.
+    """
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise TraceError("%s is not a trace file" % filename)
+    (version, position) = decode_varint(data, len(MAGIC))
+    if version != VERSION:
+        raise TraceError("%s has trace format version %d, expected %d"
+                         % (filename, version, VERSION))
+    (n, position) = decode_varint(data, position)
+    (m, position) = decode_varint(data, position)
+    digest = bytes(data[position:position+16])
+
+    return [{'version': version, 'n': n, 'm': m, 'digest': digest}, position + 16]
+
+
+def read_payloads(filename, network=None):
+    """
+    The encoded records of a trace file, one at a time; decode_trace()
+    decodes one.  If network is given, the file must have been recorded on
+    it.
+    """
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    (header, position) = read_header(data, filename)
+    if network is not None and header['digest'] != network_digest(network):
+        raise TraceError("%s was recorded on a different network" % filename)
+    while position < len(data):
+        (length, position) = decode_varint(data, position)
+        if position + length > len(data):
+            raise TraceError("Truncated trace")
+        yield data[position:position+length]
+        position += length
+
+
+def read_traces(filename, network=None):
+    for payload in read_payloads(filename, network):
+        yield decode_trace(payload)
+
+
+# Replay
+
+def replay(G, trace):
+    """
+    Rebuild the graph after each step of the run trace of G, as a
+    generator yielding [v, GG].  GG is the same graph each time, changed in
+    place, so a consumer that needs a state later must copy it.
+    """
+
+    GG = G.copy()
+    for (v, added, pruned) in trace.steps:
+        GG.remove_node(v)
+        GG.add_edges_from(added)
+        if pruned:
+            GG.remove_nodes_from(pruned)
+        yield [v, GG]
+
+
+METRICS = {}
+
+
+def register_metric(name):
+    """
+    Decorator making metric(GG) available to replay_metrics() as name.
+    """
+
+    def register(metric):
+        METRICS[name] = metric
+        return metric
+
+    return register
+
+
+register_metric('betweenness_centralisation')(betweenness_centralisation)
+register_metric('degree_centralisation')(degree_centralisation)
+
+
+@register_metric('nCC')
+def number_of_components(GG):
+    return len(component_nodes(GG))
+
+
+@register_metric('Cmax')
+def largest_component(GG):
+    return max([0] + [len(nodes) for nodes in component_nodes(GG)])
+
+
+@register_metric('nodes')
+def number_of_nodes(GG):
+    return GG.number_of_nodes()
+
+
+@register_metric('edges')
+def number_of_edges(GG):
+    return GG.number_of_edges()
+
+
+@register_metric('density')
+def density(GG):
+    return nx.density(GG)
+
+
+def replay_metrics(G, trace, names):
+    """
+    The rows [v, metric, ..] of the metrics names (keys of METRICS) after
+    each step of trace, as a generator.
+    """
+
+    metrics = [METRICS[name] for name in names]
+    for (v, GG) in replay(G, trace):
+        yield [v] + [metric(GG) for metric in metrics]
+
+
+def _replay_task(task):
+    (payload, names) = task
+
+    return list(replay_metrics(shared.worker_graph(), decode_trace(payload), names))
+
+
+def _record_task(task):
+    (tar, adaptation, p, ignore_equipment, seed) = task
+    random.seed(seed)
+    recorder = TraceRecorder(tar, adaptation, p, ignore_equipment)
+    intervention_adaptation_simulation(shared._worker['network'].to_graph(),
+                                       shared._worker['node_attributes'], tar, adaptation, p,
+                                       ignore_equipment, trace=recorder, copy=False)
+
+    return recorder.payload()
+
+
+def _pool_map(network, function, tasks, processes, chunksize):
+    # As shared.run_parallel(), for the functions of this module
+    block = shared.publish_network(network)
+    try:
+        pool = Pool(processes, initializer=shared.init_worker, initargs=(block.name,))
+        try:
+            for result in pool.imap(function, tasks, chunksize):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        block.close()
+        block.unlink()
+
+
+def replay_parallel(network, filename, names, processes=None, chunksize=16):
+    """
+    Replay every trace in filename on a pool of processes, and return the
+    rows of the metrics names of each (see replay_metrics()), in file
+    order.
+    """
+
+    tasks = ((payload, names) for payload in read_payloads(filename, network))
+
+    return list(_pool_map(network, _replay_task, tasks, processes, chunksize))
+
+
+def record_parallel(network, filename, tasks, processes=None, chunksize=1):
+    """
+    Run the tasks (tar, adaptation, p, ignore_equipment, seed) on a pool of
+    processes and write their traces to filename, in the order of tasks.
+    Returns the number of bytes written.
+    """
+
+    with TraceWriter(filename, network) as writer:
+        for payload in _pool_map(network, _record_task, tasks, processes, chunksize):
+            writer.write(payload)
+        writer.file.flush()
+        size = writer.file.tell()
+
+    return size
+
+
+def main(argv):
+    if len(argv) in (4, 5, 6) and argv[1] == 'record':
+        nn = int(argv[2])
+        network = load_network(argv[4] if len(argv) > 4 else 'criminal.txt')
+        processes = int(argv[5]) if len(argv) > 5 else None
+        random.seed()
+        tasks = [(tar, tar not in NO_ADAPT_TARGETS, 0.5, 0, random.getrandbits(64))
+                 for tar in range(len(OUTPUT_FILENAME_BY_TARGET)) for i in range(nn)]
+        start = time.perf_counter()
+        size = record_parallel(network, argv[3], tasks, processes)
+        print('%d runs recorded in %.2f s, %d bytes' % (len(tasks), time.perf_counter() - start, size))
+        return 0
+
+    if len(argv) in (4, 5, 6) and argv[1] == 'replay':
+        names = argv[3].split(',')
+        for name in names:
+            if name not in METRICS:
+                print('Unknown metric %s; known: %s' % (name, ', '.join(sorted(METRICS))))
+                return 2
+        network = load_network(argv[4] if len(argv) > 4 else 'criminal.txt')
+        processes = int(argv[5]) if len(argv) > 5 else None
+        start = time.perf_counter()
+        runs = replay_parallel(network, argv[2], names, processes)
+        elapsed = time.perf_counter() - start
+        steps = sum(map(len, runs))
+        print('%d runs, %d steps replayed in %.2f s' % (len(runs), steps, elapsed))
+        for (k, name) in enumerate(names):
+            values = [row[k+1] for run in runs for row in run]
+            print('%-28s mean %.4f' % (name, float(sum(values))/max(len(values), 1)))
+        return 0
+
+    if len(argv) == 3 and argv[1] == 'info':
+        with open(argv[2], 'rb') as f:
+            header = read_header(f.read(), argv[2])[0]
+        counts = {}
+        steps = 0
+        for trace in read_traces(argv[2]):
+            counts[trace.tar] = counts.get(trace.tar, 0) + 1
+            steps += len(trace.steps)
+        print('version %d: network of %d nodes, %d edges (hash %s)'
+              % (header['version'], header['n'], header['m'], header['digest'].hex()))
+        for tar in sorted(counts):
+            print('  %-28s %d runs' % (OUTPUT_FILENAME_BY_TARGET[tar], counts[tar]))
+        print('%d steps' % steps)
+        return 0
+
+    print('Usage: python traces.py record NN TRACE_FILE [network_file] [processes]')
+    print('       python traces.py replay TRACE_FILE METRIC[,METRIC..] [network_file] [processes]')
+    print('       python traces.py info TRACE_FILE')
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))